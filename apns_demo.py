@@ -37,14 +37,29 @@ def send_apns_message(apns_token, payload):
 
     APNS_SERVICE.send_message(apns_token, payload)
 
-APNS_SERVICE = apns.APNSService(CERTIFICATE_FILE, KEY_FILE,
-                                     handle_apns_send_failure,
-                                     USE_SANDBOX, APNS_QUEUE_SIZE)
-APNS_FEEDBACK = apns_feedback.APNFeedbackService(CERTIFICATE_FILE,
-                                KEY_FILE, process_failed_tokens,
-                                USE_SANDBOX)
+def create_providers(worker_index=0, worker_count=1):
+    """ Creates the services used to send messages, returning them keyed by
+        provider. When running with several worker processes (see
+        pushpy/cluster.py) each worker has its own APNS connections, but
+        only the first polls the feedback service. """
+
+    global APNS_SERVICE, APNS_FEEDBACK
+
+    APNS_SERVICE = apns.APNSService(CERTIFICATE_FILE, KEY_FILE,
+                                         handle_apns_send_failure,
+                                         USE_SANDBOX, APNS_QUEUE_SIZE)
+    if worker_index == 0:
+        APNS_FEEDBACK = apns_feedback.APNFeedbackService(CERTIFICATE_FILE,
+                                        KEY_FILE, process_failed_tokens,
+                                        USE_SANDBOX)
+
+    return {"apns" : APNS_SERVICE}
+
+APNS_SERVICE = None
+APNS_FEEDBACK = None
 
 if __name__ == "__main__":
     log.startLogging(sys.stdout)
+    create_providers()
     reactor.run()
 
@@ -0,0 +1,2 @@
+"""benchmarks: Throughput and latency benchmarks for pushpy, which run
+against local stand-ins for the push services. """
@@ -0,0 +1,584 @@
+"""fake_servers.py: Local stand-ins for the APNS (binary protocol over TLS,
+and the HTTP/2 API over plain TCP), GCM and Blackberry push services, used by
+the benchmarks. Run as a separate process so that its CPU use is not counted
+against the client:
+
+python -m benchmarks.fake_servers --certificate cert.pem --key key.pem
+
+Once listening, a single JSON line containing the ports is written to
+stdout. The statistics collected by the servers can be fetched as JSON from
+/stats on the HTTP port. """
+
+import os
+import sys
+import json
+import time
+import uuid
+import struct
+import argparse
+from OpenSSL import crypto, SSL
+from twisted.internet import reactor, ssl
+from twisted.internet.protocol import Factory, Protocol
+from twisted.web import resource, server
+from twisted.python import log
+from pushpy import metrics
+
+try:
+    from h2.config import H2Configuration
+    from h2.connection import H2Connection
+    from h2 import events as h2_events
+except ImportError:
+    H2Connection = None
+
+# Geometric buckets from 50us to roughly 10 minutes, each 25% wider than the
+# last, so that the reported percentiles are within 25% of the true value
+LATENCY_BUCKETS = tuple(0.00005 * (1.25 ** index) for index in range(74))
+
+LISTEN_INTERFACE = "127.0.0.1"
+CERTIFICATE_BITS = 2048
+CERTIFICATE_LIFETIME_SECONDS = 24 * 60 * 60
+
+# Binary APNS protocol
+SIMPLE_COMMAND = 1
+FRAME_COMMAND = 2
+SIMPLE_HEADER = struct.Struct("!BIIH")
+LENGTH_STRUCT = struct.Struct("!H")
+FRAME_HEADER = struct.Struct("!BI")
+FRAME_ITEM_HEADER = struct.Struct("!BH")
+IDENTIFIER_STRUCT = struct.Struct("!I")
+ERROR_RESPONSE = struct.Struct("!BBI")
+ERROR_RESPONSE_COMMAND = 8
+INVALID_TOKEN_STATUS = 8
+PAYLOAD_ITEM = 2
+NOTIFICATION_ID_ITEM = 3
+ERROR_CLOSE_TIMEOUT = 0.5
+
+# APNS HTTP/2 API
+HTTP2_STATUS_SUCCESS = 200
+HTTP2_STATUS_BAD_REQUEST = 400
+HTTP2_STATUS_UNREGISTERED = 410
+HTTP2_BAD_TOKEN_REASON = "BadDeviceToken"
+HTTP2_UNREGISTERED_REASON = "Unregistered"
+HTTP2_TOKEN_PATH = "/3/device/"
+
+GCM_TOKEN_ERROR = "NotRegistered"
+BLACKBERRY_CONTENT_HEADER = "Content-Type: text/html"
+BLACKBERRY_RESPONSE = """<?xml version="1.0"?>
+<!DOCTYPE pap PUBLIC "-//WAPFORUM//DTD PAP 2.1//EN"
+"http://www.openmobilealliance.org/tech/DTD/pap_2.1.dtd">
+<pap>
+  <push-response push-id="{push_id}" sender-address="{address}"
+                 sender-name="pushpy benchmark" reply-time="{reply_time}">
+    <response-result code="1001" desc="The request has been accepted for
+                                       processing."/>
+  </push-response>
+</pap>
+"""
+
+def create_certificate(directory):
+    """ Writes a self signed certificate and its private key to the
+        directory, returning the paths of the two files. The same pair is
+        used by the fake APNS and by the client when benchmarking. """
+
+    key = crypto.PKey()
+    key.generate_key(crypto.TYPE_RSA, CERTIFICATE_BITS)
+
+    certificate = crypto.X509()
+    certificate.get_subject().CN = LISTEN_INTERFACE
+    certificate.set_serial_number(int(uuid.uuid4().int >> 64))
+    certificate.gmtime_adj_notBefore(0)
+    certificate.gmtime_adj_notAfter(CERTIFICATE_LIFETIME_SECONDS)
+    certificate.set_issuer(certificate.get_subject())
+    certificate.set_pubkey(key)
+    certificate.sign(key, "sha256")
+
+    certificate_file = os.path.join(directory, "benchmark_cert.pem")
+    key_file = os.path.join(directory, "benchmark_key.pem")
+
+    with open(certificate_file, "wb") as output:
+        output.write(crypto.dump_certificate(crypto.FILETYPE_PEM, certificate))
+    with open(key_file, "wb") as output:
+        output.write(crypto.dump_privatekey(crypto.FILETYPE_PEM, key))
+
+    return certificate_file, key_file
+
+def sent_time(payload):
+    """ Returns the time at which the benchmark created the payload, or None
+        if the payload does not carry one. """
+
+    try:
+        return float(json.loads(payload)["sent"])
+    except (ValueError, KeyError, TypeError):
+        return None
+
+class ServerStats(object):
+    """ Counts the messages received by one of the fake services and the
+        time taken for them to arrive. """
+
+    def __init__(self):
+        self.received = 0
+        self.requests = 0
+        self.connections = 0
+        self.errors_injected = 0
+        self.disconnects_injected = 0
+        self.first_received = None
+        self.last_received = None
+        self.latency = metrics.Histogram(LATENCY_BUCKETS)
+
+    def message_received(self, payload):
+        """ Records the arrival of a message with the payload provided. """
+
+        now = time.time()
+        if self.first_received is None:
+            self.first_received = now
+        self.last_received = now
+        self.received += 1
+
+        created = sent_time(payload)
+        if created is not None:
+            self.latency.observe(now - created)
+
+    def snapshot(self):
+        """ Returns a dict describing the statistics. """
+
+        return {"received" : self.received,
+                "requests" : self.requests,
+                "connections" : self.connections,
+                "errors_injected" : self.errors_injected,
+                "disconnects_injected" : self.disconnects_injected,
+                "first_received" : self.first_received,
+                "last_received" : self.last_received,
+                "latency" : self.latency.snapshot()}
+
+class FakeAPNSProtocol(Protocol):
+    """ Reads binary protocol notifications (command 1 or command 2 frames)
+        and discards them, optionally replying with an error response or
+        dropping the connection after a number of messages. """
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.closing = False
+        self.closed = False
+
+    def connectionMade(self):
+        self.factory.stats.connections += 1
+
+    def connectionLost(self, reason):
+        self.closing = True
+        self.closed = True
+
+    def dataReceived(self, data):
+        """ Parses every complete notification in the data received. """
+
+        if self.closing is True:
+            return
+
+        self.buffer.extend(data)
+        buffer = self.buffer
+        offset = 0
+
+        while self.closing is False:
+            if len(buffer) - offset < 1:
+                break
+
+            if buffer[offset] == SIMPLE_COMMAND:
+                notification = self._parse_simple(buffer, offset)
+            elif buffer[offset] == FRAME_COMMAND:
+                notification = self._parse_frame(buffer, offset)
+            else:
+                log.err("Unknown APNS command {0}; closing the " \
+                        "connection".format(buffer[offset]))
+                self.closing = True
+                self.transport.loseConnection()
+                break
+
+            if notification is None:
+                break
+
+            offset, identifier, payload = notification
+            self.factory.notification_received(self, identifier, payload)
+
+        del buffer[:offset]
+
+    def _parse_simple(self, buffer, offset):
+        """ Returns (next offset, identifier, payload) for the command 1
+            notification at the offset, or None if it is incomplete. """
+
+        header_end = offset + SIMPLE_HEADER.size
+        if len(buffer) < header_end:
+            return None
+
+        _, identifier, _, token_length = SIMPLE_HEADER.unpack_from(buffer,
+                                                                   offset)
+        length_offset = header_end + token_length
+        if len(buffer) < length_offset + LENGTH_STRUCT.size:
+            return None
+
+        payload_length = LENGTH_STRUCT.unpack_from(buffer, length_offset)[0]
+        payload_offset = length_offset + LENGTH_STRUCT.size
+        end = payload_offset + payload_length
+        if len(buffer) < end:
+            return None
+
+        return end, identifier, bytes(buffer[payload_offset:end])
+
+    def _parse_frame(self, buffer, offset):
+        """ Returns (next offset, identifier, payload) for the command 2
+            notification at the offset, or None if it is incomplete. """
+
+        if len(buffer) < offset + FRAME_HEADER.size:
+            return None
+
+        frame_length = FRAME_HEADER.unpack_from(buffer, offset)[1]
+        item_offset = offset + FRAME_HEADER.size
+        end = item_offset + frame_length
+        if len(buffer) < end:
+            return None
+
+        identifier = 0
+        payload = ""
+        while item_offset < end:
+            item_id, item_length = FRAME_ITEM_HEADER.unpack_from(buffer,
+                                                                 item_offset)
+            item_offset += FRAME_ITEM_HEADER.size
+            if item_id == PAYLOAD_ITEM:
+                payload = bytes(buffer[item_offset:item_offset + item_length])
+            elif item_id == NOTIFICATION_ID_ITEM:
+                identifier = IDENTIFIER_STRUCT.unpack_from(buffer,
+                                                           item_offset)[0]
+            item_offset += item_length
+
+        return end, identifier, payload
+
+    def send_error(self, identifier):
+        """ Replies with an invalid token error for the notification and
+            closes the connection, as the APNS does. A TLS shutdown cannot
+            complete whilst the client is still writing, so the connection
+            is aborted if it has not closed shortly afterwards. """
+
+        self.closing = True
+        self.transport.write(ERROR_RESPONSE.pack(ERROR_RESPONSE_COMMAND,
+                                                 INVALID_TOKEN_STATUS,
+                                                 identifier))
+        self.transport.loseConnection()
+        reactor.callLater(ERROR_CLOSE_TIMEOUT, self.disconnect)
+
+    def disconnect(self):
+        """ Drops the connection without warning, ignoring any data still to
+            be parsed. """
+
+        self.closing = True
+        if self.closed is False:
+            self.transport.abortConnection()
+
+class FakeAPNSFactory(Factory):
+    """ Creates the fake APNS connections and decides which notifications
+        trigger an injected error or disconnect. """
+
+    protocol = FakeAPNSProtocol
+
+    def __init__(self, error_every=0, disconnect_every=0):
+        self.error_every = error_every
+        self.disconnect_every = disconnect_every
+        self.stats = ServerStats()
+
+    def notification_received(self, connection, identifier, payload):
+        """ Records the notification, injecting a failure if one is due. """
+
+        self.stats.message_received(payload)
+        received = self.stats.received
+
+        if self.error_every > 0 and received % self.error_every == 0:
+            self.stats.errors_injected += 1
+            connection.send_error(identifier)
+        elif self.disconnect_every > 0 and \
+                received % self.disconnect_every == 0:
+            self.stats.disconnects_injected += 1
+            connection.disconnect()
+
+class FakeAPNSHTTP2Protocol(Protocol):
+    """ Accepts notifications sent to the APNS HTTP/2 API, using HTTP/2
+        with prior knowledge rather than TLS, and answers each stream with
+        the status chosen by the factory. """
+
+    def connectionMade(self):
+        self.factory.stats.connections += 1
+        self.connection = H2Connection(H2Configuration(client_side=False))
+        self.connection.initiate_connection()
+        self.streams = {}
+        self.transport.write(self.connection.data_to_send())
+
+    def dataReceived(self, data):
+        """ Collects the headers and payload of each stream, and responds
+            once the stream has ended. """
+
+        for event in self.connection.receive_data(data):
+            if isinstance(event, h2_events.RequestReceived):
+                self.streams[event.stream_id] = (dict(event.headers), [])
+            elif isinstance(event, h2_events.DataReceived):
+                stream = self.streams.get(event.stream_id)
+                if stream is not None:
+                    stream[1].append(event.data)
+                self.connection.acknowledge_received_data(
+                    event.flow_controlled_length, event.stream_id)
+            elif isinstance(event, h2_events.StreamEnded):
+                self._respond(event.stream_id)
+
+        self.transport.write(self.connection.data_to_send())
+
+    def _respond(self, stream_id):
+        """ Sends the response to a complete notification. """
+
+        headers, body = self.streams.pop(stream_id)
+        token = headers.get(":path", "")[len(HTTP2_TOKEN_PATH):]
+        status, reason = self.factory.notification_received(token,
+                                                            "".join(body))
+
+        if reason is None:
+            self.connection.send_headers(stream_id,
+                                         [(":status", str(status))],
+                                         end_stream=True)
+            return
+
+        response = {"reason" : reason}
+        if status == HTTP2_STATUS_UNREGISTERED:
+            response["timestamp"] = int(time.time() * 1000)
+        response = json.dumps(response)
+
+        self.connection.send_headers(stream_id,
+                                     [(":status", str(status)),
+                                      ("content-type", "application/json"),
+                                      ("content-length", str(len(response)))])
+        self.connection.send_data(stream_id, response, end_stream=True)
+
+class FakeAPNSHTTP2Factory(Factory):
+    """ Creates the fake APNS HTTP/2 connections. Every error_every-th
+        notification is rejected with 400 BadDeviceToken and every
+        unregistered_every-th with 410 Unregistered, both of which the
+        client treats as an invalid token; the rest are accepted. The
+        tokens rejected are recorded, so that suppression can be checked. """
+
+    protocol = FakeAPNSHTTP2Protocol
+
+    def __init__(self, error_every=0, unregistered_every=0):
+        if H2Connection is None:
+            raise RuntimeError("The h2 package is required for the fake " \
+                               "APNS HTTP/2 API")
+
+        self.error_every = error_every
+        self.unregistered_every = unregistered_every
+        self.rejected_tokens = set()
+        self.stats = ServerStats()
+
+    def notification_received(self, token, payload):
+        """ Records the notification, returning the (status, reason) of the
+            response. """
+
+        self.stats.message_received(payload)
+        received = self.stats.received
+
+        if self.error_every > 0 and received % self.error_every == 0:
+            status, reason = HTTP2_STATUS_BAD_REQUEST, HTTP2_BAD_TOKEN_REASON
+        elif self.unregistered_every > 0 and \
+                received % self.unregistered_every == 0:
+            status, reason = HTTP2_STATUS_UNREGISTERED, \
+                HTTP2_UNREGISTERED_REASON
+        else:
+            return HTTP2_STATUS_SUCCESS, None
+
+        self.stats.errors_injected += 1
+        self.rejected_tokens.add(token)
+
+        return status, reason
+
+class DelayedResource(resource.Resource):
+    """ Base class for the fake HTTP services, which can hold each response
+        back for a fixed time to simulate the latency of the real service. """
+
+    isLeaf = True
+
+    def __init__(self, response_delay=0.0):
+        resource.Resource.__init__(self)
+        self.response_delay = response_delay
+        self.stats = ServerStats()
+
+    def render_POST(self, request):
+        """ Builds the response and writes it, after the delay if one is
+            configured. """
+
+        self.stats.requests += 1
+        body = self.respond(request, request.content.read())
+
+        if self.response_delay <= 0:
+            return body
+
+        reactor.callLater(self.response_delay, self._finish, request, body)
+        return server.NOT_DONE_YET
+
+    def render_HEAD(self, request):
+        """ Answers the HEAD requests used to warm up connections. """
+
+        return ""
+
+    def _finish(self, request, body):
+        """ Writes the delayed response. """
+
+        request.write(body)
+        request.finish()
+
+    def respond(self, request, body):
+        """ Returns the body of the response to the request. """
+
+        raise NotImplementedError()
+
+class FakeGCMResource(DelayedResource):
+    """ Accepts GCM JSON requests, reporting every nth registration id as
+        no longer registered if error_every is set. """
+
+    def __init__(self, response_delay=0.0, error_every=0):
+        DelayedResource.__init__(self, response_delay)
+        self.error_every = error_every
+        self.tokens = 0
+
+    def respond(self, request, body):
+        message = json.loads(body)
+        registration_ids = message.get("registration_ids") or [message["to"]]
+        payload = json.dumps(message.get("data", {}))
+
+        results = []
+        failure = 0
+        for _ in registration_ids:
+            self.tokens += 1
+            self.stats.message_received(payload)
+            if self.error_every > 0 and self.tokens % self.error_every == 0:
+                failure += 1
+                self.stats.errors_injected += 1
+                results.append({"error" : GCM_TOKEN_ERROR})
+            else:
+                results.append({"message_id" : "0:{0}".format(self.tokens)})
+
+        request.setHeader("Content-Type", "application/json")
+        return json.dumps({"multicast_id" : self.stats.requests,
+                           "success" : len(registration_ids) - failure,
+                           "failure" : failure,
+                           "canonical_ids" : 0,
+                           "results" : results})
+
+class FakeBlackberryResource(DelayedResource):
+    """ Accepts PAP push requests, counting one message per address. """
+
+    def respond(self, request, body):
+        payload = ""
+        content_offset = body.find(BLACKBERRY_CONTENT_HEADER)
+        if content_offset >= 0:
+            start = body.find("\n\n", content_offset) + 2
+            payload = body[start:body.find("\n\n", start)]
+
+        for _ in range(max(body.count("<address "), 1)):
+            self.stats.message_received(payload)
+
+        request.setHeader("Content-Type", "application/xml")
+        return BLACKBERRY_RESPONSE.format(push_id=uuid.uuid4(),
+            address=request.getRequestHostname(),
+            reply_time=time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()))
+
+class StatsResource(resource.Resource):
+    """ Returns the statistics of every fake service as JSON. """
+
+    isLeaf = True
+
+    def __init__(self, services):
+        resource.Resource.__init__(self)
+        self.services = services
+
+    def render_GET(self, request):
+        request.setHeader("Content-Type", "application/json")
+        return json.dumps(dict((name, stats.snapshot()) for name, stats in
+                               self.services.iteritems()))
+
+def start_servers(certificate_file, key_file, apns_port=0, http_port=0,
+                  apns_error_every=0, apns_disconnect_every=0,
+                  gcm_error_every=0, response_delay=0.0, apns_http2_port=0,
+                  apns_unregistered_every=0):
+    """ Starts listening with every fake service, returning a dict of the
+        ports in use. The GCM and Blackberry services are served under
+        /gcm and /blackberry on the HTTP port. The fake APNS HTTP/2 API is
+        only started if the h2 package is installed; apns_error_every
+        applies to it as well as to the binary protocol. """
+
+    apns_factory = FakeAPNSFactory(apns_error_every, apns_disconnect_every)
+    context_factory = ssl.DefaultOpenSSLContextFactory(key_file,
+        certificate_file, sslmethod=SSL.SSLv23_METHOD)
+    apns_listener = reactor.listenSSL(apns_port, apns_factory,
+                                      context_factory,
+                                      interface=LISTEN_INTERFACE)
+
+    services = {"apns" : apns_factory.stats}
+    ports = {"apns_port" : apns_listener.getHost().port}
+
+    if H2Connection is not None:
+        apns_http2_factory = FakeAPNSHTTP2Factory(apns_error_every,
+                                                  apns_unregistered_every)
+        apns_http2_listener = reactor.listenTCP(apns_http2_port,
+                                                apns_http2_factory,
+                                                interface=LISTEN_INTERFACE)
+        services["apns_http2"] = apns_http2_factory.stats
+        ports["apns_http2_port"] = apns_http2_listener.getHost().port
+
+    gcm_resource = FakeGCMResource(response_delay, gcm_error_every)
+    blackberry_resource = FakeBlackberryResource(response_delay)
+
+    root = resource.Resource()
+    root.putChild("gcm", gcm_resource)
+    root.putChild("blackberry", blackberry_resource)
+    services["gcm"] = gcm_resource.stats
+    services["blackberry"] = blackberry_resource.stats
+    root.putChild("stats", StatsResource(services))
+
+    site = server.Site(root)
+    site.noisy = False
+    http_listener = reactor.listenTCP(http_port, site,
+                                      interface=LISTEN_INTERFACE)
+
+    ports["http_port"] = http_listener.getHost().port
+
+    return ports
+
+def main():
+    """ Starts the fake services using the command line options. """
+
+    parser = argparse.ArgumentParser(description="Local stand-ins for the " \
+                                     "APNS, GCM and Blackberry push services")
+    parser.add_argument("--certificate", required=True)
+    parser.add_argument("--key", required=True)
+    parser.add_argument("--apns-port", type=int, default=0)
+    parser.add_argument("--http-port", type=int, default=0)
+    parser.add_argument("--apns-http2-port", type=int, default=0)
+    parser.add_argument("--apns-error-every", type=int, default=0,
+                        help="reply with an error to every nth notification")
+    parser.add_argument("--apns-unregistered-every", type=int, default=0,
+                        help="reply to every nth HTTP/2 notification with " \
+                        "410 Unregistered")
+    parser.add_argument("--apns-disconnect-every", type=int, default=0,
+                        help="drop the connection after every nth " \
+                        "notification")
+    parser.add_argument("--gcm-error-every", type=int, default=0,
+                        help="report every nth GCM token as unregistered")
+    parser.add_argument("--response-delay", type=float, default=0.0,
+                        help="seconds to hold back each HTTP response")
+    options = parser.parse_args()
+
+    ports = start_servers(options.certificate, options.key, options.apns_port,
+                          options.http_port, options.apns_error_every,
+                          options.apns_disconnect_every,
+                          options.gcm_error_every, options.response_delay,
+                          options.apns_http2_port,
+                          options.apns_unregistered_every)
+
+    sys.stdout.write(json.dumps(ports) + "\n")
+    sys.stdout.flush()
+
+    reactor.run()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,522 @@
+"""run_benchmarks.py: Drives APNSService, GCMService or BlackberryService
+against the local fake servers (see fake_servers.py) at a fixed rate, then
+reports the sustained throughput, latency percentiles, CPU time and peak
+memory of the client. For example:
+
+python -m benchmarks.run_benchmarks apns --rate 20000 --duration 30
+python -m benchmarks.run_benchmarks apns_http2 --rate 5000 --duration 30
+python -m benchmarks.run_benchmarks gcm --rate 200 --tokens-per-request 100
+
+The fake servers run in a child process, so the CPU and memory figures only
+cover pushpy and the reactor driving it. Each run should be made in a new
+process, as the peak memory reported is the peak of the whole process. """
+
+import os
+import sys
+import json
+import time
+import base64
+import shutil
+import resource
+import argparse
+import tempfile
+import subprocess
+from twisted.internet import defer, reactor, task
+from twisted.python import log
+from twisted.web.client import Agent, readBody
+from pushpy import apns, apns_http2, blackberry, common, gcm, metrics
+from benchmarks import fake_servers
+
+PROVIDERS = ("apns", "apns_http2", "gcm", "blackberry")
+TICK_INTERVAL = 0.01
+STATS_POLL_INTERVAL = 0.25
+DRAIN_TIMEOUT = 30.0
+DRAIN_IDLE_TIMEOUT = 10.0
+TOKEN_COUNT = 1000
+DEFAULT_MAX_IN_FLIGHT = 100
+APNS_QUEUE_SIZE = 1000000
+APNS_TOPIC = "com.example.pushpy.benchmark"
+APNS_PAYLOAD = '{{"aps":{{"alert":"pushpy benchmark"}},"sent":{0:.6f}}}'
+
+def start_fake_servers(options, directory):
+    """ Starts the fake servers in a child process, returning the process
+        and a dict of the ports it is listening on. """
+
+    certificate_file, key_file = fake_servers.create_certificate(directory)
+    root_directory = os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__)))
+
+    process = subprocess.Popen([sys.executable, "-m",
+        "benchmarks.fake_servers",
+        "--certificate", certificate_file, "--key", key_file,
+        "--apns-error-every", str(options.apns_error_every),
+        "--apns-disconnect-every", str(options.apns_disconnect_every),
+        "--apns-unregistered-every", str(options.apns_unregistered_every),
+        "--gcm-error-every", str(options.gcm_error_every),
+        "--response-delay", str(options.response_delay)],
+        stdout=subprocess.PIPE, cwd=root_directory)
+
+    ports = json.loads(process.stdout.readline())
+    ports["certificate_file"] = certificate_file
+    ports["key_file"] = key_file
+
+    return process, ports
+
+def resource_usage():
+    """ Returns the CPU seconds used by this process so far, and its peak
+        resident set size in megabytes. """
+
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+
+    # ru_maxrss is reported in bytes on OS X and in kilobytes elsewhere
+    if sys.platform == "darwin":
+        peak_rss = usage.ru_maxrss / (1024.0 * 1024.0)
+    else:
+        peak_rss = usage.ru_maxrss / 1024.0
+
+    return usage.ru_utime + usage.ru_stime, peak_rss
+
+def random_tokens(count=TOKEN_COUNT):
+    """ Returns a list of random base64 encoded device tokens. """
+
+    return [base64.b64encode(os.urandom(apns.DEVICE_TOKEN_LENGTH))
+            for _ in range(count)]
+
+class Benchmark(object):
+    """ Sends messages at a fixed rate for the duration specified, then waits
+        for the messages to be delivered and collects the results. Subclasses
+        implement connect, send_batch and drain. """
+
+    def __init__(self, options, ports):
+        self.options = options
+        self.ports = ports
+        self.stats_url = "http://{0}:{1}/stats".format(
+            fake_servers.LISTEN_INTERFACE, ports["http_port"])
+        self.tokens = random_tokens()
+        self.token_index = 0
+        self.sent = 0
+        self.skipped_ticks = 0
+        self.start_time = None
+        self.send_loop = None
+        self.finished = defer.Deferred()
+
+    def next_tokens(self, count):
+        """ Returns the next count device tokens, cycling through the pool. """
+
+        tokens = []
+        for _ in range(count):
+            tokens.append(self.tokens[self.token_index])
+            self.token_index = (self.token_index + 1) % len(self.tokens)
+
+        return tokens
+
+    def run(self):
+        """ Connects, sends for the configured duration and then drains.
+            Returns a Deferred which fires with the results. """
+
+        deferred = defer.maybeDeferred(self.connect)
+        deferred.addCallback(self._start_sending)
+        deferred.addCallback(lambda _: self.finished)
+        deferred.addCallback(lambda _: self.drain())
+        deferred.addCallback(self._collect)
+
+        return deferred
+
+    def _start_sending(self, _):
+        """ Starts the loop which sends the messages due at each tick. """
+
+        self.cpu_start, _ = resource_usage()
+        self.start_time = time.time()
+        self.send_loop = task.LoopingCall(self._tick)
+        self.send_loop.start(TICK_INTERVAL)
+
+    def _tick(self):
+        """ Sends the messages which are due according to the rate. """
+
+        now = time.time()
+        elapsed = now - self.start_time
+
+        if elapsed >= self.options.duration:
+            self.send_loop.stop()
+            self.send_time = elapsed
+            self.finished.callback(None)
+            return
+
+        due = int(self.options.rate * elapsed) - self.sent
+        if due > 0:
+            sent = self.send_batch(due, now)
+            if sent < due:
+                self.skipped_ticks += 1
+            self.sent += sent
+
+    def fetch_stats(self):
+        """ Returns a Deferred which fires with the fake servers' stats. """
+
+        deferred = Agent(reactor).request("GET", self.stats_url)
+        deferred.addCallback(readBody)
+        deferred.addCallback(json.loads)
+
+        return deferred
+
+    def _collect(self, delivered_time):
+        """ Builds the results once all messages have been delivered. """
+
+        cpu_end, peak_rss = resource_usage()
+        elapsed = delivered_time - self.start_time
+
+        deferred = self.fetch_stats()
+        deferred.addCallback(self.results, elapsed, cpu_end - self.cpu_start,
+                             peak_rss)
+
+        return deferred
+
+    def results(self, server_stats, elapsed, cpu_seconds, peak_rss):
+        """ Returns a dict describing the run. """
+
+        return {"provider" : self.options.provider,
+                "offered_rate" : self.options.rate,
+                "duration" : self.options.duration,
+                "sent" : self.sent,
+                "behind_schedule_ticks" : self.skipped_ticks,
+                "elapsed" : elapsed,
+                "cpu_seconds" : cpu_seconds,
+                "cpu_percent" : 100.0 * cpu_seconds / elapsed,
+                "peak_rss_mb" : peak_rss,
+                "server" : server_stats[self.options.provider],
+                "metrics" : metrics.REGISTRY.snapshot()}
+
+class APNSBenchmark(Benchmark):
+    """ Sends notifications through APNSService using the binary protocol.
+        Latency is measured by the fake APNS, from the time the payload was
+        created until the notification arrived. Tokens rejected by the fake
+        APNS are suppressed, so later sends to them are not expected to be
+        delivered. """
+
+    def connect(self):
+        self.errors = 0
+        self.service = apns.APNSService(self.ports["certificate_file"],
+            self.ports["key_file"], self.error_received,
+            apns_queue_size=APNS_QUEUE_SIZE,
+            connection_count=self.options.connections,
+            batch_writes=self.options.batch_writes,
+            use_frame_format=self.options.frame_format,
+            send_rate=self.options.send_rate,
+            connection_send_rate=self.options.connection_send_rate,
+            hostname=fake_servers.LISTEN_INTERFACE,
+            port=self.ports["apns_port"])
+
+        connected = defer.Deferred()
+
+        def check_connected():
+            if all(factory._connected is True
+                   for factory in self.service.apns_factories):
+                connect_loop.stop()
+                connected.callback(None)
+
+        connect_loop = task.LoopingCall(check_connected)
+        connect_loop.start(TICK_INTERVAL)
+
+        return connected
+
+    def error_received(self, error_tuple):
+        """ Counts the error responses injected by the fake APNS. """
+
+        self.errors += 1
+
+    def send_batch(self, count, now):
+        payload = APNS_PAYLOAD.format(now)
+        for token in self.next_tokens(count):
+            self.service.send_message(token, payload)
+
+        return count
+
+    def suppressed(self):
+        """ Returns the number of messages not sent as the fake APNS had
+            reported their tokens as invalid. """
+
+        return metrics.REGISTRY.counters.get("apns.messages_suppressed", 0)
+
+    def drain(self):
+        """ Polls the fake APNS until it has received every notification, or
+            until it stops receiving them. Fires with the time at which the
+            last notification arrived. """
+
+        drained = defer.Deferred()
+        progress = {"received" : -1, "changed" : time.time()}
+
+        def check(stats):
+            now = time.time()
+            received = stats[self.options.provider]["received"]
+            if received != progress["received"]:
+                progress["received"] = received
+                progress["changed"] = now
+
+            if received >= self.sent - self.suppressed() or \
+                    now - progress["changed"] > DRAIN_IDLE_TIMEOUT or \
+                    now - self.start_time > self.options.duration + \
+                    DRAIN_TIMEOUT:
+                drained.callback(stats[self.options.provider]["last_received"]
+                                 or now)
+            else:
+                reactor.callLater(STATS_POLL_INTERVAL, poll)
+
+        def poll():
+            self.fetch_stats().addCallbacks(check, drained.errback)
+
+        poll()
+
+        return drained
+
+    def results(self, server_stats, elapsed, cpu_seconds, peak_rss):
+        results = Benchmark.results(self, server_stats, elapsed, cpu_seconds,
+                                    peak_rss)
+        results["delivered"] = results["server"]["received"]
+        results["throughput"] = results["delivered"] / elapsed
+        results["latency"] = results["server"]["latency"]
+        results["errors"] = self.errors
+        results["suppressed"] = self.suppressed()
+
+        return results
+
+class APNSHTTP2Benchmark(APNSBenchmark):
+    """ Sends notifications through APNSService using the HTTP/2 engine,
+        connected to the fake APNS over plain TCP. """
+
+    def connect(self):
+        if "apns_http2_port" not in self.ports:
+            raise RuntimeError("The h2 package is required to benchmark " \
+                               "the APNS HTTP/2 API")
+
+        self.errors = 0
+        self.engine = apns_http2.APNSHTTP2Engine(APNS_TOPIC,
+            hostname=fake_servers.LISTEN_INTERFACE,
+            port=self.ports["apns_http2_port"], use_tls=False)
+        self.service = apns.APNSService(None, None, self.error_received,
+            http2_engine=self.engine, send_rate=self.options.send_rate,
+            connection_send_rate=self.options.connection_send_rate)
+
+        connected = defer.Deferred()
+
+        def check_connected():
+            if self.engine.protocol is not None:
+                connect_loop.stop()
+                connected.callback(None)
+
+        connect_loop = task.LoopingCall(check_connected)
+        connect_loop.start(TICK_INTERVAL)
+
+        return connected
+
+class HTTPBenchmark(Benchmark):
+    """ Base class for the HTTP providers. Each request carries
+        tokens_per_request tokens, the rate is in requests per second and
+        latency is measured by the client, from submitting a request until
+        its response arrives. At most max_in_flight requests are
+        outstanding; requests which would exceed it are not sent, and the
+        connection pool keeps up to max_in_flight connections open. """
+
+    def connect(self):
+        self.in_flight = 0
+        self.completed = 0
+        self.failed = 0
+        self.last_completed = None
+        self.latency = metrics.Histogram(fake_servers.LATENCY_BUCKETS)
+        self.connection_pool = common.create_connection_pool(
+            self.options.max_in_flight)
+        self.service = self.create_service("http://{0}:{1}/{2}".format(
+            fake_servers.LISTEN_INTERFACE, self.ports["http_port"],
+            self.options.provider))
+
+        if self.options.warm_up is True:
+            return self.service.warm_up(self.options.max_in_flight)
+
+    def send_batch(self, count, now):
+        sent = 0
+        while sent < count and self.in_flight < self.options.max_in_flight:
+            deferred = self.send_request(self.next_tokens(
+                self.options.tokens_per_request), now)
+            deferred.addBoth(self.request_complete, now)
+            self.in_flight += 1
+            sent += 1
+
+        return sent
+
+    def request_complete(self, result, sent_time):
+        """ Records the time taken to receive the response. """
+
+        now = time.time()
+        self.in_flight -= 1
+        self.completed += 1
+        self.last_completed = now
+        self.latency.observe(now - sent_time)
+
+    def drain(self):
+        """ Waits until every request has completed, firing with the time at
+            which the last response arrived. """
+
+        drained = defer.Deferred()
+
+        def check():
+            if self.in_flight == 0 or time.time() - self.start_time > \
+                    self.options.duration + DRAIN_TIMEOUT:
+                drained.callback(self.last_completed or time.time())
+            else:
+                reactor.callLater(STATS_POLL_INTERVAL, check)
+
+        check()
+
+        return drained
+
+    def results(self, server_stats, elapsed, cpu_seconds, peak_rss):
+        results = Benchmark.results(self, server_stats, elapsed, cpu_seconds,
+                                    peak_rss)
+        results["tokens_per_request"] = self.options.tokens_per_request
+        results["delivered"] = results["server"]["received"]
+        results["throughput"] = self.completed / elapsed
+        results["token_throughput"] = results["delivered"] / elapsed
+        results["latency"] = self.latency.snapshot()
+
+        return results
+
+class GCMBenchmark(HTTPBenchmark):
+    """ Sends requests through GCMService. """
+
+    def create_service(self, url):
+        return gcm.GCMService(url, "pushpy-benchmark", "benchmark-key",
+                              lambda token: None,
+                              lambda token, new_token: None,
+                              connection_pool=self.connection_pool)
+
+    def send_request(self, tokens, now):
+        return self.service.send_message(tokens, "sent", "{0:.6f}".format(now))
+
+class BlackberryBenchmark(HTTPBenchmark):
+    """ Sends push requests through BlackberryService. """
+
+    def create_service(self, url):
+        return blackberry.BlackberryService(url, "pushpy-benchmark",
+                                            "benchmark-password",
+                                            connection_pool=
+                                                self.connection_pool)
+
+    def send_request(self, tokens, now):
+        return self.service.send_message(tokens, json.dumps({"sent" : now}))
+
+BENCHMARKS = {"apns" : APNSBenchmark,
+              "apns_http2" : APNSHTTP2Benchmark,
+              "gcm" : GCMBenchmark,
+              "blackberry" : BlackberryBenchmark}
+
+def format_latency(value):
+    """ Formats a latency in seconds as milliseconds. """
+
+    if value is None:
+        return "n/a"
+
+    return "{0:.2f}ms".format(value * 1000)
+
+def print_results(results):
+    """ Writes a summary of the results to stdout. """
+
+    latency = results["latency"]
+    print "provider:        {0}".format(results["provider"])
+    print "offered rate:    {0}/s for {1}s".format(results["offered_rate"],
+                                                  results["duration"])
+    print "sent:            {0} ({1} ticks behind schedule)".format(
+        results["sent"], results["behind_schedule_ticks"])
+    print "delivered:       {0}".format(results["delivered"])
+    if "suppressed" in results:
+        print "suppressed:      {0}".format(results["suppressed"])
+    print "throughput:      {0:.1f}/s".format(results["throughput"])
+    if "token_throughput" in results:
+        print "token throughput: {0:.1f}/s".format(
+            results["token_throughput"])
+    print "latency:         p50 {0}, p90 {1}, p99 {2}".format(
+        format_latency(latency["p50"]), format_latency(latency["p90"]),
+        format_latency(latency["p99"]))
+    print "cpu:             {0:.2f}s ({1:.1f}%)".format(
+        results["cpu_seconds"], results["cpu_percent"])
+    print "peak rss:        {0:.1f}MB".format(results["peak_rss_mb"])
+
+def main():
+    """ Runs a single benchmark using the command line options. """
+
+    parser = argparse.ArgumentParser(description="Benchmarks a pushpy " \
+                                     "provider against a local fake server")
+    parser.add_argument("provider", choices=PROVIDERS)
+    parser.add_argument("--rate", type=float, default=1000,
+                        help="messages per second (requests per second " \
+                        "for gcm and blackberry)")
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--connections", type=int,
+                        default=apns.APNS_CONNECTION_COUNT)
+    parser.add_argument("--batch-writes", action="store_true")
+    parser.add_argument("--frame-format", action="store_true")
+    parser.add_argument("--send-rate", type=float,
+                        help="pace apns writes to this many messages per " \
+                        "second across all connections")
+    parser.add_argument("--connection-send-rate", type=float,
+                        help="pace apns writes to this many messages per " \
+                        "second on each connection")
+    parser.add_argument("--tokens-per-request", type=int, default=1)
+    parser.add_argument("--max-in-flight", type=int,
+                        default=DEFAULT_MAX_IN_FLIGHT)
+    parser.add_argument("--warm-up", action="store_true",
+                        help="open max-in-flight connections before " \
+                        "sending (gcm and blackberry)")
+    parser.add_argument("--apns-error-every", type=int, default=0)
+    parser.add_argument("--apns-disconnect-every", type=int, default=0)
+    parser.add_argument("--apns-unregistered-every", type=int, default=0,
+                        help="reply to every nth notification with 410 " \
+                        "Unregistered (apns_http2 only)")
+    parser.add_argument("--gcm-error-every", type=int, default=0)
+    parser.add_argument("--response-delay", type=float, default=0.0)
+    parser.add_argument("--json", help="also write the results to this file")
+    parser.add_argument("--verbose", action="store_true",
+                        help="log pushpy's output to stderr")
+    options = parser.parse_args()
+
+    # The binary protocol has no equivalent of the HTTP/2 410 response
+    if options.apns_unregistered_every > 0 and \
+            options.provider != "apns_http2":
+        parser.error("--apns-unregistered-every is only supported by the " \
+                     "apns_http2 provider")
+
+    if options.verbose is True:
+        log.startLogging(sys.stderr)
+
+    directory = tempfile.mkdtemp(prefix="pushpy-benchmark-")
+    process, ports = start_fake_servers(options, directory)
+    outcome = {}
+
+    def finished(results):
+        outcome["results"] = results
+        reactor.stop()
+
+    def failed(failure):
+        outcome["failure"] = failure
+        reactor.stop()
+
+    benchmark = BENCHMARKS[options.provider](options, ports)
+    reactor.callWhenRunning(lambda: benchmark.run().addCallbacks(finished,
+                                                                 failed))
+
+    try:
+        reactor.run()
+    finally:
+        process.terminate()
+        process.wait()
+        shutil.rmtree(directory)
+
+    if "failure" in outcome:
+        outcome["failure"].printTraceback()
+        sys.exit(1)
+
+    print_results(outcome["results"])
+
+    if options.json is not None:
+        with open(options.json, "w") as output:
+            json.dump(outcome["results"], output, indent=2, sort_keys=True)
+
+if __name__ == "__main__":
+    main()
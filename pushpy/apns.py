@@ -3,15 +3,26 @@ messages to be sent to the APNS. """
 
 import time
 import common
+import logger
+import backlog
+import coalesce
+import metrics
+import pacing
+import suppression
 import base64
 import struct
+import bisect
+import hashlib
 import datetime
+import math
+import functools
 import collections
-import Queue
 import binascii
+from zope.interface import implementer
 from twisted.internet.protocol import Protocol, ReconnectingClientFactory
+from twisted.internet.interfaces import IPushProducer
 from twisted.python import log
-from twisted.internet import error, reactor
+from twisted.internet import defer, error, reactor
 
 APNS_HOSTNAME = "gateway.push.apple.com"
 APNS_SANDBOX_HOSTNAME = "gateway.sandbox.push.apple.com"
@@ -19,11 +30,51 @@ APNS_PORT = 2195
 APNS_RECONNECT_FREQUENCY = 1800
 FORMAT_STRING = "!ciLH32sH%ds"
 COMMAND_TYPE = "\x01"
+FRAME_FORMAT_STRING = "!cLBH32sBH%dsBHiBHLBHB"
+FRAME_COMMAND_TYPE = "\x02"
+FRAME_ITEM_OVERHEAD_BYTES = 56
+COMMAND_OVERHEAD_BYTES = 45
+DEVICE_TOKEN_ITEM = 1
+PAYLOAD_ITEM = 2
+NOTIFICATION_ID_ITEM = 3
+EXPIRY_ITEM = 4
+PRIORITY_ITEM = 5
+DEFAULT_PRIORITY = 10
+FLUSH_THRESHOLD_BYTES = 65536
+DRAIN_BATCH_SIZE = 1000
+PACING_INTERVAL = 0.01
+LOG_SAMPLE_RATE = 1000
+BULK_CHUNK_SIZE = 1000
 MAX_MESSAGE_SIZE_BYTES = 256
 MESSAGE_RETRY_COUNT = 0
 TIMEOUT_CHECK_FREQUENCY = 900
 MIN_MESSAGE_ID = 1000
 MAX_MESSAGE_ID = 2147483647
+APNS_CONNECTION_COUNT = 1
+POOL_POLICY_LEAST_LOADED = "least_loaded"
+POOL_POLICY_TOKEN_HASH = "token_hash"
+HASH_RING_REPLICAS = 100
+UNCHANGED = object()
+DISCONNECTED_LOAD_PENALTY = MAX_MESSAGE_ID
+PAUSED_LOAD_PENALTY = MAX_MESSAGE_ID / 2
+MESSAGE_ID_RANGE = MAX_MESSAGE_ID - MIN_MESSAGE_ID + 1
+SENT_MESSAGE_HISTORY_SIZE = 1000
+# The sent message history is sized to hold the messages sent in the time it
+# takes for an error response to arrive, at the connection's send rate or at
+# UNPACED_SEND_RATE if it is not paced, and never below
+# SENT_MESSAGE_HISTORY_SIZE
+ERROR_ROUND_TRIP_SECONDS = 0.5
+UNPACED_SEND_RATE = 50000
+TOKEN_CACHE_SIZE = 10000
+DEVICE_TOKEN_LENGTH = 32
+MESSAGE_EXPIRY_SECONDS = 3600
+
+ERROR_RESPONSE_COMMAND = 8
+ERROR_RESPONSE_LENGTH = 6
+ERROR_RESPONSE_STRUCT = struct.Struct("!BBi")
+
+# Status of the error response sent for a notification to an invalid token
+INVALID_TOKEN_ERROR = 8
 
 # Indexes relating to error tuples received as a response from the APNS
 ERROR_VALUE_INDEX = 0
@@ -37,6 +88,281 @@ class APNSException(Exception):
         self.error_text = error_message
         super(APNSException, self).__init__(self.error_text)
 
+def encode_payload(payload):
+    """ Returns the payload as UTF-8 encoded bytes if it is unicode (for
+        example when it has been decoded from JSON), so that it is packed,
+        and its size measured, in bytes. """
+
+    if isinstance(payload, unicode):
+        return payload.encode("utf-8")
+
+    return payload
+
+def check_token(decoded_token):
+    """ Returns the decoded device token, raising an APNSException if it is
+        not DEVICE_TOKEN_LENGTH bytes long, as packing it would silently pad
+        or truncate it. """
+
+    if len(decoded_token) != DEVICE_TOKEN_LENGTH:
+        raise APNSException("The APNS device token is {0} bytes long " \
+                            "rather than {1}. Discarding message".format(
+                            len(decoded_token), DEVICE_TOKEN_LENGTH))
+
+    return decoded_token
+
+
+def sent_message_history_size(send_rate=None,
+                              round_trip=ERROR_ROUND_TRIP_SECONDS):
+    """ Returns the number of sent messages which need to be held so that
+        every message written after a failed one can be resent, given the
+        messages written per second and the seconds an error response takes
+        to arrive. """
+
+    if send_rate is None:
+        send_rate = UNPACED_SEND_RATE
+
+    size = int(math.ceil(send_rate * round_trip))
+
+    return min(max(size, SENT_MESSAGE_HISTORY_SIZE), MESSAGE_ID_RANGE)
+
+class APNSMessagePacker(object):
+    """ Packs notifications into the binary format expected by the APNS.
+        Compiled struct objects are cached per payload length, and decoded
+        device tokens are held in a bounded cache so that tokens which are
+        sent to repeatedly are only decoded once. """
+
+    def __init__(self, use_frame_format=False,
+                 token_cache_size=TOKEN_CACHE_SIZE):
+        self.use_frame_format = use_frame_format
+        self.token_cache_size = token_cache_size
+        self.structs = {}
+
+        # The token cache approximates an LRU using two generations: tokens
+        # are added to the recent generation, and when it fills up it
+        # replaces the previous generation. Tokens found in the previous
+        # generation are promoted back into the recent one.
+        self.recent_tokens = {}
+        self.previous_tokens = {}
+
+    def decode_token(self, device_token):
+        """ Returns the binary form of the base64 encoded device token. """
+
+        decoded_token = self.recent_tokens.get(device_token)
+        if decoded_token is not None:
+            return decoded_token
+
+        decoded_token = self.previous_tokens.get(device_token)
+        if decoded_token is None:
+            try:
+                decoded_token = base64.decodestring(device_token)
+            except binascii.Error:
+                raise APNSException("Unable to decode APNS device token " \
+                        "{0}. Discarding message".format(device_token))
+            check_token(decoded_token)
+
+        if len(self.recent_tokens) * 2 >= self.token_cache_size:
+            self.previous_tokens = self.recent_tokens
+            self.recent_tokens = {}
+        self.recent_tokens[device_token] = decoded_token
+
+        return decoded_token
+
+    def get_struct(self, payload_length):
+        """ Returns the compiled struct used to pack a message with a
+            payload of the specified length. """
+
+        message_struct = self.structs.get(payload_length)
+        if message_struct is None:
+            if self.use_frame_format is True:
+                message_struct = struct.Struct(FRAME_FORMAT_STRING %
+                                               payload_length)
+            else:
+                message_struct = struct.Struct(FORMAT_STRING % payload_length)
+            self.structs[payload_length] = message_struct
+
+        return message_struct
+
+    def pack(self, sequence_number, expiry, decoded_token, payload):
+        """ Packs a message with the decoded device token and payload. """
+
+        payload = encode_payload(payload)
+        message_struct = self.get_struct(len(payload))
+
+        try:
+            if self.use_frame_format is True:
+                return message_struct.pack(FRAME_COMMAND_TYPE,
+                    FRAME_ITEM_OVERHEAD_BYTES + len(payload),
+                    DEVICE_TOKEN_ITEM, DEVICE_TOKEN_LENGTH, decoded_token,
+                    PAYLOAD_ITEM, len(payload), payload,
+                    NOTIFICATION_ID_ITEM, 4, sequence_number,
+                    EXPIRY_ITEM, 4, expiry,
+                    PRIORITY_ITEM, 1, DEFAULT_PRIORITY)
+
+            return message_struct.pack(COMMAND_TYPE, sequence_number, expiry,
+                                       len(decoded_token), decoded_token,
+                                       len(payload), payload)
+        except struct.error:
+            raise APNSException("Unable to pack message with payload {0} to " \
+                                "send to device {1}. Discarding " \
+                                "message".format(payload,
+                                binascii.hexlify(decoded_token)))
+
+    def compile(self, payload):
+        """ Returns a template which packs messages with the payload provided,
+            so that the payload only has to be packed once when sending it to
+            many devices. """
+
+        payload = encode_payload(payload)
+        if len(payload) + COMMAND_OVERHEAD_BYTES > MAX_MESSAGE_SIZE_BYTES:
+            raise APNSException("The message size ({0}) exceeds the " \
+                                "maximum permitted by the APNS ({1}). " \
+                                "Discarding message".format(
+                                str(len(payload) + COMMAND_OVERHEAD_BYTES),
+                                str(MAX_MESSAGE_SIZE_BYTES)))
+
+        return APNSMessageTemplate(payload, self.use_frame_format)
+
+class APNSMessageTemplate(object):
+    """ A message with the payload already packed, leaving only the
+        identifier, expiry and device token to be filled in for each
+        device the message is sent to. """
+
+    __slots__ = ('payload', 'use_frame_format', 'head_struct',
+                 'payload_segment', 'tail_struct')
+
+    def __init__(self, payload, use_frame_format=False):
+        payload = encode_payload(payload)
+        self.payload = payload
+        self.use_frame_format = use_frame_format
+
+        try:
+            if use_frame_format is True:
+                # The identifier and expiry follow the payload in the frame
+                self.head_struct = struct.Struct("!cLBH32s")
+                self.payload_segment = struct.pack("!BH", PAYLOAD_ITEM,
+                                                   len(payload)) + payload
+                self.tail_struct = struct.Struct("!BHiBHLBHB")
+            else:
+                self.head_struct = struct.Struct("!ciLH32s")
+                self.payload_segment = struct.pack("!H", len(payload)) + \
+                    payload
+                self.tail_struct = None
+        except struct.error:
+            raise APNSException("Unable to pack payload {0}. Discarding " \
+                                "message".format(payload))
+
+    def pack(self, sequence_number, expiry, decoded_token):
+        """ Returns the message for the device with the decoded token. """
+
+        if self.use_frame_format is True:
+            return self.head_struct.pack(FRAME_COMMAND_TYPE,
+                FRAME_ITEM_OVERHEAD_BYTES + len(self.payload),
+                DEVICE_TOKEN_ITEM, DEVICE_TOKEN_LENGTH, decoded_token) + \
+                self.payload_segment + \
+                self.tail_struct.pack(NOTIFICATION_ID_ITEM, 4,
+                                      sequence_number, EXPIRY_ITEM, 4, expiry,
+                                      PRIORITY_ITEM, 1, DEFAULT_PRIORITY)
+
+        return self.head_struct.pack(COMMAND_TYPE, sequence_number, expiry,
+                                     DEVICE_TOKEN_LENGTH, decoded_token) + \
+            self.payload_segment
+
+class SentMessageHistory(object):
+    """ Fixed capacity ring buffer holding the messages most recently sent
+        to the APNS. Messages are located by sequence number in constant
+        time, taking into account the message id wrapping around from
+        MAX_MESSAGE_ID to MIN_MESSAGE_ID. """
+
+    __slots__ = ('capacity', 'count', 'last_slot', 'last_sequence_number',
+                 'sequence_numbers', 'tokens', 'messages')
+
+    def __init__(self, capacity=SENT_MESSAGE_HISTORY_SIZE):
+        if capacity < 1 or capacity > MESSAGE_ID_RANGE:
+            raise APNSException("The sent message history size must be " \
+                                "between 1 and the number of unique " \
+                                "message ids ({0})".format(MESSAGE_ID_RANGE))
+
+        self.capacity = capacity
+        self.count = 0
+        self.last_slot = -1
+        self.last_sequence_number = None
+        self.sequence_numbers = [None] * capacity
+        self.tokens = [None] * capacity
+        self.messages = [None] * capacity
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, sequence_number):
+        return self.token(sequence_number) is not None
+
+    def append(self, sequence_number, device_token, message):
+        """ Stores a sent message, overwriting the oldest message if the
+            history is full. The device token is the decoded binary token. """
+
+        slot = (self.last_slot + 1) % self.capacity
+
+        self.sequence_numbers[slot] = sequence_number
+        self.tokens[slot] = device_token
+        self.messages[slot] = message
+
+        self.last_slot = slot
+        self.last_sequence_number = sequence_number
+        if self.count < self.capacity:
+            self.count += 1
+
+    def _distance(self, sequence_number):
+        """ Returns how many messages were sent after the message with the
+            specified sequence number, or None if it is not in the history. """
+
+        if self.count == 0:
+            return None
+
+        distance = (self.last_sequence_number - sequence_number) % \
+            MESSAGE_ID_RANGE
+
+        if distance >= self.count:
+            return None
+
+        return distance
+
+    def token(self, sequence_number):
+        """ Returns the decoded device token of the message with the
+            specified sequence number, or None if it is no longer held. """
+
+        distance = self._distance(sequence_number)
+        if distance is None:
+            return None
+
+        slot = (self.last_slot - distance) % self.capacity
+        if self.sequence_numbers[slot] != sequence_number:
+            return None
+
+        return self.tokens[slot]
+
+    def messages_after(self, sequence_number):
+        """ Returns all of the messages sent after the message with the
+            specified sequence number as a single string. If the sequence
+            number is older than anything in the history, the entire history
+            is returned, although the messages sent between it and the
+            oldest message held have been lost. """
+
+        distance = self._distance(sequence_number)
+        if distance is None:
+            distance = self.count
+
+        if distance == 0:
+            return ""
+
+        first_slot = (self.last_slot - distance + 1) % self.capacity
+
+        # The messages occupy at most two contiguous runs of the buffer
+        if first_slot <= self.last_slot:
+            return "".join(self.messages[first_slot:self.last_slot + 1])
+
+        return "".join(self.messages[first_slot:] +
+                       self.messages[:self.last_slot + 1])
+
 class APNSProtocol(Protocol):
     """ Protocol class which handles connection events made to and
         received from the APNS. """
@@ -44,6 +370,8 @@ class APNSProtocol(Protocol):
     def __init__(self):
         self.connect_time = None
         self.alerted = False
+        self.receive_buffer = bytearray()
+        self.malformed_frames = 0
         self.last_message_sent = datetime.datetime.now()
 
         # Set the timeout check value to force reconnection, if a message
@@ -82,13 +410,19 @@ class APNSProtocol(Protocol):
             have not yet been sent. """
 
         self.connect_time = datetime.datetime.now()
+        del self.receive_buffer[:]
 
         # Update the time that the last message was 'sent' - i.e. reset
         # the timeout
         self.last_message_sent = datetime.datetime.now()
 
+        # The transport will pause the factory when its write buffer
+        # fills up, and resume it once the buffer has drained
+        self.transport.registerProducer(self.factory, True)
+
         if self.factory.message_error is not None:
             self.factory.process_failed_sent_messages()
+        self.factory.write_unwritten()
 
         if hasattr(self, 'message'):
             if self.factory.retry_attempts < MESSAGE_RETRY_COUNT:
@@ -124,28 +458,56 @@ class APNSProtocol(Protocol):
 
     def dataReceived(self, data):
         """ No data is received when messages are sent successfully - a
-            response is only received when something has gone wrong. """
-
-        error_tuple = struct.unpack("!bbi", data)
-
-        log.msg("Error code {0} received when sending message id {1}".format(
-            error_tuple[1], error_tuple[2]))
-
-        try:
-            if int(error_tuple[2]) == 0:
-                log.msg("Error response contained a message id of 0. Resend " \
-                        "process not being invoked.")
-            else:
-                self.factory.message_error = int(error_tuple[2])
-                self.factory.error_callback((error_tuple[1], error_tuple[2]))
-        except ValueError:
-            log.err("Could not parse the message id from the response: {0}".
-                    format(error_tuple))
+            response is only received when something has gone wrong. Error
+            responses may be split across reads, or several may arrive in
+            one read, so data is buffered and each complete 6 byte frame is
+            passed to the factory. Bytes which cannot be the start of a
+            frame are skipped and counted as malformed. """
+
+        self.receive_buffer.extend(data)
+        buffer_length = len(self.receive_buffer)
+        offset = 0
+        resynchronising = False
+        error_received = False
+
+        while buffer_length - offset >= ERROR_RESPONSE_LENGTH:
+            if self.receive_buffer[offset] != ERROR_RESPONSE_COMMAND:
+                if resynchronising is False:
+                    self.malformed_frames += 1
+                    self.factory.metrics.increment(
+                        "apns.malformed_error_frames")
+                    log.err("Malformed error response received from the " \
+                            "APNS; skipping to the next frame")
+                    resynchronising = True
+                offset += 1
+                continue
+
+            resynchronising = False
+            _, status, identifier = ERROR_RESPONSE_STRUCT.unpack_from(
+                self.receive_buffer, offset)
+            offset += ERROR_RESPONSE_LENGTH
+            error_received = True
+
+            self.factory.metrics.increment("apns.errors.{0}".format(status))
+            self.factory.handle_error_response(status, identifier)
+
+        if offset > 0:
+            del self.receive_buffer[:offset]
+
+        # The APNS closes the connection after an error response. Stop
+        # writing to it, and stop the factory being its producer, as a
+        # transport with a producer registered does not finish closing
+        if error_received is True and self.factory._connected is True:
+            self.factory.stop_writing()
+            self.transport.unregisterProducer()
+            self.transport.loseConnection()
 
     def sendMessage(self, message):
         """ Sends the fully formed message to the APNS. """
 
         self.transport.write(message)
+        self.factory.metrics.increment("apns.writes")
+        self.factory.metrics.increment("apns.bytes_written", len(message))
         self.last_message_sent = datetime.datetime.now()
 
     def shutdown(self):
@@ -153,42 +515,334 @@ class APNSProtocol(Protocol):
 
         self.reconnect_trigger.cancel()
 
+@implementer(IPushProducer)
 class APNSClientFactory(ReconnectingClientFactory):
     """ Factory which manages instances of the protocol which connect to the
-        APNS to dispatch messages to clients. """
-
-    def __init__(self, error_callback, backlog_queue_size=1):
+        APNS to dispatch messages to clients. The factory is registered as
+        a producer with the transport, so that writes stop while the
+        transport's buffer is full. Writes can also be paced to send_rate
+        messages per second, with bursts of send_burst, and to the limit
+        of a token bucket shared with other connections (service_pacer);
+        messages over the limit wait in the backlog. The backlog has a lane
+        for each of backlog_lanes, a sequence of (name, weight) pairs, and
+        the lanes are drained in proportion to their weights. Each lane has
+        the backlog limits, unless lane_limits maps its name to (max_bytes,
+        max_items); the limits are per lane. While connected, messages held
+        back by flow control or pacing are only limited by the byte budget,
+        so that they are delayed rather than dropped; backlog_queue_size
+        only limits the messages queued while disconnected, so with the
+        default three lanes up to three times that many are kept. The
+        sent message history holds sent_message_capacity messages, by
+        default enough for ERROR_ROUND_TRIP_SECONDS at send_rate. """
+
+    def __init__(self, error_callback, backlog_queue_size=1,
+                 backlog_max_bytes=backlog.DEFAULT_MAX_BYTES,
+                 overflow_policy=backlog.OVERFLOW_DROP_OLDEST,
+                 batch_writes=False, use_frame_format=False,
+                 flush_threshold_bytes=FLUSH_THRESHOLD_BYTES,
+                 sent_message_capacity=None, packer=None,
+                 metrics_registry=None, send_rate=None, send_burst=None,
+                 service_pacer=None,
+                 backlog_lanes=backlog.DEFAULT_LANES, lane_limits=None):
         log.msg("init called")
         self._connected = False
         self.message = None
         self.error_callback = error_callback
-        self.message_queue = Queue.Queue(maxsize=backlog_queue_size)
+        self.message_queue = backlog.PriorityBacklog(backlog_lanes,
+                                                     backlog_max_bytes,
+                                                     backlog_queue_size,
+                                                     overflow_policy,
+                                                     lane_limits)
+        self.drain_batch_size = DRAIN_BATCH_SIZE
+        self.drain_trigger = None
         self.protocol = APNSProtocol()
         self.retry_attempts = 0
-        self.sent_messages = collections.deque(maxlen=1000)
+        if sent_message_capacity is None:
+            sent_message_capacity = sent_message_history_size(send_rate)
+        self.sent_messages = SentMessageHistory(sent_message_capacity)
         self.sequence_number = MIN_MESSAGE_ID
         self.message_error = None
 
+        # When batching, packed messages are accumulated in the write buffer
+        # and written to the transport once per reactor iteration, or as
+        # soon as the buffer reaches the flush threshold
+        self.batch_writes = batch_writes
+        self.flush_threshold_bytes = flush_threshold_bytes
+        self.write_buffer = bytearray()
+        self.flush_trigger = None
+
+        # Messages still in the write buffer when the connection is lost
+        # have already been counted as sent, so they are held here and
+        # written once reconnected
+        self.unwritten_messages = bytearray()
+
+        if packer is None:
+            packer = APNSMessagePacker(use_frame_format)
+        self.packer = packer
+
+        # Flow control state. While paused, messages are held in the backlog
+        # rather than written, callers waiting for capacity are held until
+        # the transport resumes, and listeners are told about each change.
+        # Waiters are held per lane, under None for those waiting for the
+        # whole backlog to be sent
+        self.paused = False
+        self.capacity_waiters = {}
+        self.flow_listeners = []
+        self.pacer = pacing.TokenBucket(send_rate, send_burst, service_pacer)
+
+        if metrics_registry is None:
+            metrics_registry = metrics.REGISTRY
+        self.metrics = metrics_registry
+        self.metrics.register_gauge("apns.backlog_depth",
+                                    lambda: len(self.message_queue),
+                                    owner=self)
+        self.metrics.register_gauge("apns.backlog_bytes",
+                                    lambda: self.message_queue.size_bytes,
+                                    owner=self)
+        for lane in self.message_queue.lanes:
+            self.metrics.register_gauge("apns.backlog_depth." + lane,
+                functools.partial(self._lane_depth, lane), owner=self)
+        self.metrics.register_gauge("apns.connections_open",
+                                    lambda: int(self._connected), owner=self)
+        self.metrics.register_gauge("apns.connections_paused",
+                                    lambda: int(self.paused), owner=self)
+        self.metrics.register_gauge("apns.connections_paced",
+                                    lambda: int(self.paced()), owner=self)
+
+    def unregister_metrics(self):
+        """ Removes the gauges registered by this factory from the metrics
+            registry, for use when it is being replaced by a new one. """
+
+        self.metrics.unregister(self)
+
+    def handle_error_response(self, status, identifier):
+        """ Handles an error response from the APNS, recording the id of the
+            failed message so that the messages sent after it can be resent
+            once reconnected. """
+
+        logger.count("APNS error responses")
+        logger.info("Error code {0} received when sending message id {1}",
+                    status, identifier)
+
+        if identifier == 0:
+            log.msg("Error response contained a message id of 0. Resend " \
+                    "process not being invoked.")
+        else:
+            self.message_error = identifier
+            self.error_callback((status, identifier))
+
     def process_queue(self):
         """ Processes the messages in the backlog queue, if there
             are any that have not already been sent. Messages would be
             in the queue if they have been consumed from the MQ but no
-            connection to the APNS was available. """
+            connection to the APNS was available. At most drain_batch_size
+            messages are sent per reactor iteration, so that a large backlog
+            does not block the reactor, and no more than the pacer allows;
+            the rest are sent once the pacer has more tokens. The lanes of
+            the backlog are drained in proportion to their weights. """
 
-        log.msg(("Processing the backlog of APNS messages."))
+        if self.drain_trigger is not None and \
+                self.drain_trigger.active() is False:
+            self.drain_trigger = None
 
-        # According to the documentation, Queue.qsize() technically only
-        # returns an 'approximate' size - so it's possible that a few messages
-        # may get missed or it will try and process more messages than there
-        # are available.
-        for _ in range(0, self.message_queue.qsize()):
-            try:
-                message = self.message_queue.get(block=False)
-                self.sendMessage(message[0], message[1])
-            except Queue.Empty:
-                break
+        if len(self.message_queue) > 0:
+            logger.debug("Processing the backlog of {0} APNS messages.",
+                         len(self.message_queue))
 
-        log.msg(("Finished processing the APNS message backlog."))
+        sent = 0
+        allowed = self.pacer.available()
+        while len(self.message_queue) > 0:
+            if self._connected is False or self.paused is True:
+                return
+
+            if sent >= self.drain_batch_size:
+                self.schedule_drain()
+                self.notify_capacity()
+                return
+
+            if sent >= allowed:
+                self.metrics.increment("apns.pacing_waits")
+                self.schedule_drain()
+                return
+
+            device_token, payload = self.message_queue.get()
+            self._write_notification(device_token, payload)
+            sent += 1
+
+        if sent > 0:
+            logger.debug("Finished processing the APNS message backlog.")
+
+        self.notify_capacity()
+
+    def schedule_drain(self):
+        """ Arranges for the backlog to be processed on the next reactor
+            iteration, or once the pacer allows another message, if this has
+            not already been arranged. """
+
+        if self.drain_trigger is None:
+            # When paced, wait at least PACING_INTERVAL so that the tokens
+            # earned are sent in batches rather than one per timer
+            delay = self.pacer.delay()
+            if delay > 0:
+                delay = max(delay, PACING_INTERVAL)
+            self.drain_trigger = reactor.callLater(delay, self.process_queue)
+
+    def paced(self):
+        """ Returns True if messages are waiting in the backlog for the
+            pacer to allow them to be sent. """
+
+        return self._connected is True and self.paused is False and \
+            len(self.message_queue) > 0 and self.pacer.ready() is False
+
+    def set_send_rate(self, send_rate, send_burst=None):
+        """ Changes the pacing of this connection, and sends whatever the
+            new rate allows from the backlog. """
+
+        self.pacer.set_rate(send_rate, send_burst)
+
+        if self.drain_trigger is not None and self.drain_trigger.active():
+            self.drain_trigger.cancel()
+        self.drain_trigger = None
+        self.schedule_drain()
+
+    def pacing_state(self):
+        """ Returns a dict describing the pacing of this connection. """
+
+        state = self.pacer.state()
+        state["paced"] = self.paced()
+        state["backlog_depth"] = len(self.message_queue)
+        state["lane_depths"] = self.message_queue.depths()
+
+        return state
+
+    def _lane_depth(self, lane):
+        """ Returns the number of messages waiting in a lane of the
+            backlog. """
+
+        return len(self.message_queue.lane(lane))
+
+    def load(self):
+        """ Returns a relative measure of how busy this factory is, used by
+            the connection pool to pick the least loaded connection. Factories
+            without a connection are always considered busier than those
+            with one. """
+
+        load = len(self.message_queue)
+
+        if self._connected is False:
+            load += DISCONNECTED_LOAD_PENALTY
+        elif self.paused is True:
+            load += PAUSED_LOAD_PENALTY
+
+        return load
+
+    def _set_paused(self, paused):
+        """ Updates the paused state, informing the flow listeners if it
+            has changed. """
+
+        if paused == self.paused:
+            return
+
+        self.paused = paused
+        for listener in self.flow_listeners:
+            listener(paused)
+
+    def pauseProducing(self):
+        """ Called by the transport when its write buffer is full. """
+
+        logger.count("APNS transport pauses")
+        self.metrics.increment("apns.transport_pauses")
+        logger.debug("APNS transport buffer full; pausing writes")
+        self._set_paused(True)
+
+    def resumeProducing(self):
+        """ Called by the transport when its write buffer has drained. Sends
+            any messages held while paused and releases waiting callers. """
+
+        logger.debug("APNS transport buffer drained; resuming writes")
+        self._set_paused(False)
+        self.process_queue()
+
+    def stopProducing(self):
+        """ Called by the transport when the connection is lost. Messages
+            will be queued until a new connection is made. """
+
+        self._set_paused(False)
+
+    def stop_writing(self):
+        """ Called when the APNS has reported an error and is about to close
+            the connection. Anything written after the failed message is
+            ignored by the APNS, so new messages are held in the backlog
+            until a new connection has been made. """
+
+        self._connected = False
+        self.hold_writes()
+        self.stopProducing()
+
+    def writable(self, lane=None):
+        """ Returns True if a message would be written straight away, i.e.
+            the factory is connected, the transport is not paused, there
+            is nothing waiting in the backlog and the pacer allows it. If a
+            lane is given, only messages waiting in that lane and in lanes
+            weighted at least as heavily need to have been sent, so that
+            urgent messages are not held behind a backlog of bulk ones. """
+
+        if lane is None:
+            waiting = len(self.message_queue)
+        else:
+            waiting = self.message_queue.waiting_ahead(lane)
+
+        return self._connected is True and self.paused is False and \
+            waiting == 0 and self.pacer.ready() is True
+
+    def wait_for_capacity(self, lane=None):
+        """ Returns a Deferred which fires once the factory is connected,
+            the backlog has been sent and the transport is able to accept
+            more data. If a lane is given the Deferred fires straight away
+            when a message for that lane could be written now. """
+
+        if self.writable(lane) is True:
+            return defer.succeed(None)
+
+        if lane is not None:
+            lane = self._lane_name(lane)
+
+        waiter = defer.Deferred()
+        self.capacity_waiters.setdefault(lane, collections.deque()).append(
+            waiter)
+
+        # If only the pacer is holding the waiter back nothing else will
+        # release it, so check again once it allows another message
+        if self._connected is True and self.paused is False:
+            self.schedule_drain()
+
+        return waiter
+
+    def notify_capacity(self):
+        """ Fires the waiting Deferreds one at a time, stopping as soon as
+            one of the resulting writes fills the transport's buffer. The
+            waiters for each lane are released once that lane, and the lanes
+            weighted more heavily, have been sent, starting with the most
+            heavily weighted lane; waiters without a lane are only released
+            once the whole backlog has been sent. """
+
+        weights = self.message_queue.weights
+        for lane in sorted(self.capacity_waiters,
+                           key=lambda lane: -weights.get(lane, 0)):
+            waiters = self.capacity_waiters[lane]
+            while len(waiters) > 0 and self.writable(lane) is True:
+                waiters.popleft().callback(None)
+
+            if len(waiters) == 0 and \
+                    self.capacity_waiters.get(lane) is waiters:
+                del self.capacity_waiters[lane]
+
+        # Waiters held back only by the pacer are released once it allows
+        # another message; those held back by the backlog are released as
+        # it drains
+        if len(self.capacity_waiters) > 0 and self._connected is True and \
+                self.paused is False:
+            self.schedule_drain()
 
     def buildProtocol(self, addr):
         """ Builds an instance of the APNSProtocol which is used to
@@ -207,6 +861,7 @@ class APNSClientFactory(ReconnectingClientFactory):
 
         # Restart processing incoming messages
         self._connected = True
+        self.metrics.increment("apns.connections")
 
         return new_protocol
 
@@ -215,142 +870,236 @@ class APNSClientFactory(ReconnectingClientFactory):
 
         log.msg("Attempting to connect to the APNS.")
 
-    def enque_message(self, device_token, payload):
-        """ Adds a payload with the corresponding device token
-            to the queue. Used when a connection to the APNS is unavailable
-            but where it is useful to have the option to send messages
-            upon reconnection. """
+    def enque_message(self, device_token, payload, lane=None):
+        """ Adds a payload with the corresponding decoded device token
+            to the named lane of the queue (by default the normal lane).
+            Used when a connection to the APNS is unavailable but where it
+            is useful to have the option to send messages upon
+            reconnection, and while connected for messages held back by
+            flow control or pacing. The lane's item limit only applies
+            while disconnected; its byte budget always applies. What
+            happens when the lane is full depends on its overflow policy;
+            with the reject policy an APNSException is raised. Only
+            messages in the same lane are dropped to make room. """
 
-        if not self.message_queue.full():
-            try:
-                self.message_queue.put((device_token, payload),
-                                        block=False)
-                log.msg(("Message for device {0} stored in " +
-                         "queue as no APNS connection is available").format(
-                         device_token))
-            except Queue.Full:
-                log.msg(("No connection to the APNS is available, and " +
-                         "the queue is full. Discarding message."))
+        dropped = self.message_queue.dropped
+
+        try:
+            stored = self.message_queue.put((device_token, payload),
+                                            len(device_token) + len(payload),
+                                            lane, self._connected is False)
+        except backlog.BacklogFullException as exception:
+            raise APNSException("No connection to the APNS is available, " \
+                                "and the queue is full ({0}). Discarding " \
+                                "message.".format(exception.error_text))
+
+        if stored is False:
+            logger.count("APNS messages discarded from the queue")
+            self.metrics.increment("apns.messages_dropped")
+            self.metrics.increment("apns.messages_dropped.{0}".format(
+                self._lane_name(lane)))
+            logger.sampled("apns.discarded", LOG_SAMPLE_RATE, logger.WARNING,
+                           "No connection to the APNS is available, and " \
+                           "the queue is full. Discarding message.")
+        elif self.message_queue.dropped > dropped:
+            logger.count("APNS messages discarded from the queue",
+                         self.message_queue.dropped - dropped)
+            logger.count("APNS messages queued")
+            self.metrics.increment("apns.messages_dropped",
+                                   self.message_queue.dropped - dropped)
+            self.metrics.increment("apns.messages_dropped.{0}".format(
+                self._lane_name(lane)), self.message_queue.dropped - dropped)
+            self.metrics.increment("apns.messages_queued")
+            logger.sampled("apns.popped", LOG_SAMPLE_RATE, logger.WARNING,
+                           "Full Queue - message(s) popped to make way " \
+                           "for newer messages")
         else:
-            try:
-                # Pop the first item off to make space for the newer message
-                self.message_queue.get(block=False)
-                self.message_queue.put((device_token, payload),
-                                        block=False)
-                log.msg(("Full Queue - message popped to make way for newer " +
-                         "message for device {0}, as no " +
-                         "APNS connection is available").format(
-                         device_token))
-            except Queue.Full:
-                log.msg("No connection to the APNS is available, and the " +
-                        "queue is full. Discarding message.")
-            except Queue.Empty:
-                log.msg("No connection to the APNS is available, and " +
-                        "unable to store message in queue. Discarding " +
-                        "message.")
-
-    def sendMessage(self, device_token, payload):
+            logger.count("APNS messages queued")
+            self.metrics.increment("apns.messages_queued")
+            if logger.is_enabled(logger.DEBUG):
+                logger.debug("Message for device {0} stored in queue as " \
+                             "it cannot be sent yet",
+                             binascii.hexlify(device_token))
+
+    def _lane_name(self, lane):
+        """ Returns the name of the lane of the backlog a message for the
+            lane is held in. """
+
+        if lane in self.message_queue.lanes:
+            return lane
+
+        return self.message_queue.default_lane
+
+    def write_message(self, message):
+        """ Writes a packed message to the APNS, either immediately or, when
+            batching is enabled, by adding it to the write buffer so that it
+            can be written along with other messages. """
+
+        if self.batch_writes is False:
+            self.protocol.sendMessage(message)
+            return
+
+        self.write_buffer.extend(message)
+
+        if len(self.write_buffer) >= self.flush_threshold_bytes:
+            self.flush_writes()
+        elif self.flush_trigger is None:
+            self.flush_trigger = reactor.callLater(0, self.flush_writes)
+
+    def flush_writes(self):
+        """ Writes the contents of the write buffer to the APNS in a single
+            write, and empties the buffer so it can be reused. """
+
+        if self.flush_trigger is not None:
+            if self.flush_trigger.active():
+                self.flush_trigger.cancel()
+            self.flush_trigger = None
+
+        if len(self.write_buffer) > 0:
+            self.protocol.sendMessage(bytes(self.write_buffer))
+            del self.write_buffer[:]
+
+    def hold_writes(self):
+        """ Empties the write buffer without sending its contents, holding
+            them to be written once reconnected. Used when the connection
+            has been lost. """
+
+        if self.flush_trigger is not None:
+            if self.flush_trigger.active():
+                self.flush_trigger.cancel()
+            self.flush_trigger = None
+
+        if len(self.write_buffer) > 0:
+            log.msg("Holding {0} unwritten bytes from the APNS write " \
+                    "buffer until reconnected".format(len(self.write_buffer)))
+            self.unwritten_messages.extend(self.write_buffer)
+            del self.write_buffer[:]
+
+    def write_unwritten(self):
+        """ Writes the messages which were held when the connection was
+            lost, before any others. """
+
+        if len(self.unwritten_messages) > 0:
+            log.msg("Writing {0} bytes held since the APNS connection was " \
+                    "lost".format(len(self.unwritten_messages)))
+            self.write_message(bytes(self.unwritten_messages))
+            del self.unwritten_messages[:]
+
+    def sendMessage(self, device_token, payload, lane=backlog.LANE_NORMAL):
         """ Notification messages are binary messages in network order
         using the following format:
-        <1 byte command> <2 bytes length><token> <2 bytes length><payload> """
+        <1 byte command> <2 bytes length><token> <2 bytes length><payload>
+
+        When the frame format is enabled, command 2 is used instead:
+        <1 byte command> <4 bytes frame length> <frame>
+        where the frame contains the token, payload, identifier, expiry and
+        priority items, each as <1 byte id> <2 bytes length> <data> """
+
+        self.send_decoded_message(self.packer.decode_token(device_token),
+                                  payload, lane)
+
+    def send_decoded_message(self, decoded_token, payload,
+                             lane=backlog.LANE_NORMAL):
+        """ Sends the payload to the device with the specified token, which
+            has already been decoded into its 32 byte binary form. If it
+            cannot be written yet it is held in the named lane of the
+            backlog. """
+
+        check_token(decoded_token)
+        payload = encode_payload(payload)
+
+        # The size limit is applied as if the message had been packed
+        # using command 1, so that it is the same for both formats
+        if len(payload) + COMMAND_OVERHEAD_BYTES > MAX_MESSAGE_SIZE_BYTES:
+            raise APNSException("The message size ({0}) exceeds the " \
+                                "maximum permitted by the APNS ({1}). " \
+                                "Discarding message".format(
+                                str(len(payload) + COMMAND_OVERHEAD_BYTES),
+                                str(MAX_MESSAGE_SIZE_BYTES)))
+
+        # Messages are only written straight away if there is nothing
+        # waiting in their lane, or in a more urgent one, so that each lane
+        # is sent in order
+        if self.writable(lane) is True:
+            self._write_notification(decoded_token, payload)
+        else:
+            self.enque_message(decoded_token, payload, lane)
+            if self._connected is True and self.paused is False:
+                self.schedule_drain()
+
+    def send_template(self, decoded_token, template,
+                      lane=backlog.LANE_NORMAL):
+        """ Sends a message created from a template, which already contains
+            the packed payload, to the device with the decoded token. The
+            message is held in the named lane of the backlog if it cannot
+            be written yet. """
+
+        check_token(decoded_token)
+        if self.writable(lane) is True:
+            self._write_packed(decoded_token, template.pack(
+                self.sequence_number,
+                int(time.time()) + MESSAGE_EXPIRY_SECONDS, decoded_token))
+        else:
+            self.enque_message(decoded_token, template.payload, lane)
+            if self._connected is True and self.paused is False:
+                self.schedule_drain()
+
+    def _write_packed(self, decoded_token, message):
+        """ Records a message packed with the current sequence number in the
+            sent message history, writes it to the APNS and moves on to the
+            next sequence number. Every message is written here, so this is
+            where they are counted. """
+
+        self.message = message
+        self.sent_messages.append(self.sequence_number, decoded_token,
+                                  message)
+        self.pacer.take()
+        self.write_message(message)
+        logger.count("APNS messages sent")
+        self.metrics.increment("apns.messages_sent")
+        if self.sequence_number >= MAX_MESSAGE_ID:
+            self.sequence_number = MIN_MESSAGE_ID
+        else:
+            self.sequence_number = self.sequence_number + 1
 
-        try:
-            decoded_token = base64.decodestring(device_token)
-            message_format = FORMAT_STRING % len(payload)
-        except binascii.Error:
-            raise APNSException("Unable to decode APNS device token {0}. " \
-                    "Discarding message".format(device_token))
+    def _write_notification(self, decoded_token, payload):
+        """ Packs the notification using the next sequence number, records
+            it in the sent message history and writes it to the APNS. """
 
-        expiry = int(time.time()) + 3600
+        self._write_packed(decoded_token, self.packer.pack(
+            self.sequence_number, int(time.time()) + MESSAGE_EXPIRY_SECONDS,
+            decoded_token, payload))
 
-        try:
-            self.message = struct.pack(message_format, COMMAND_TYPE,
-                                        int(self.sequence_number), expiry,
-                                        len(decoded_token), decoded_token,
-                                        len(payload), payload)
-        except struct.error:
-            raise APNSException("Unable to pack message with payload {0} to " \
-                                "send to device {1}. Discarding " \
-                                "message".format(payload, device_token))
-
-        if self._connected is True:
-            if len(self.message) <= MAX_MESSAGE_SIZE_BYTES:
-                self.sent_messages.append({self.sequence_number :
-                    [device_token, self.message]})
-                self.protocol.sendMessage(self.message)
-                if self.sequence_number >= MAX_MESSAGE_ID:
-                    self.sequence_number = MIN_MESSAGE_ID
-                else:
-                    self.sequence_number = self.sequence_number + 1
-            else:
-                raise APNSException("The message size ({0}) exceeds the " \
-                                    "maximum permitted by the APNS ({1}). " \
-                                    "Discarding message".format(
-                                    str(len(self.message)),
-                                    str(MAX_MESSAGE_SIZE_BYTES)))
-
-            log.msg(("Message pushed to device with " \
-                     "APNS token: {1}").format(device_token))
-        else:
-            self.enque_message(device_token, payload)
+        if logger.is_enabled(logger.DEBUG):
+            logger.debug("Message pushed to device with APNS token: {0}",
+                         binascii.hexlify(decoded_token))
 
     def process_failed_sent_messages(self):
         """ Processes messages that were sent AFTER the message that
-            caused the connection to be cut. """
-
-        if len(self.sent_messages) > (MAX_MESSAGE_ID - MIN_MESSAGE_ID):
-            # As the number of saved sent messages is higher than the
-            # number of unique message id's, we cannot work out which
-            # ones have been sent and which ones haven't. Either the number
-            # of saved sent messages should be decreased or the range
-            # of message id's should be increased.
-            log.msg("Can't resend messages as the " \
-                    "proportion of cached sent messages is higher than" \
-                    "the difference between the max message ID and min"
-                    "message ID. The number of sent messages stored should " \
-                    "be decreased, or the range of message id's increased")
-        else:
-            log.msg("Resending messages that were sent after the failed " \
-                    "message (id: {0})".format(self.message_error))
-
-            # This check is to cover the case where the message counter has
-            # has recently been reset, following it hitting the maximum value.
-            # We don't want to resend messages that were sent succesfully but
-            # have a higher sequence number, so we take into account the number
-            # of messages sent since the reset if the error is higher than the
-            # current sequence number.
-            if len(self.sent_messages) > \
-                ((self.sequence_number - MIN_MESSAGE_ID)):
-                number_beyond_min = self.sequence_number - MIN_MESSAGE_ID
-                max_id_to_resend = MAX_MESSAGE_ID - (len(self.sent_messages) -
-                                                     number_beyond_min)
-                log.msg("Detected counter reset. NumberBeyondMin: {0}, " \
-                        "MaxIDToResend: {1}".format(number_beyond_min,
-                                                    max_id_to_resend))
-                looped = True
-            else:
-                max_id_to_resend = MAX_MESSAGE_ID
-                looped = False
-
-            for message in self.sent_messages:
-                for key, value in message.iteritems():
-                    resend = False
-                    if looped is True:
-                        if key > int(self.message_error):
-                            if key < max_id_to_resend or \
-                             int(self.message_error) > self.sequence_number:
-                                resend = True
-                        else:
-                            if key < max_id_to_resend and \
-                                int(self.message_error) > max_id_to_resend:
-                                resend = True
-                    else:
-                        if key > int(self.message_error):
-                            resend = True
-
-                    if resend is True:
-                        log.msg("Resending message with id: " + str(key))
-                        self.protocol.sendMessage(value[1])
+            caused the connection to be cut. The messages are written
+            to the APNS in a single write. """
+
+        log.msg("Resending messages that were sent after the failed " \
+                "message (id: {0})".format(self.message_error))
+
+        identifier = int(self.message_error)
+        if identifier not in self.sent_messages:
+            logger.count("APNS resend history overflows")
+            self.metrics.increment("apns.resend_history_overflows")
+            logger.warning("The failed message (id: {0}) is older than the " \
+                           "{1} messages held for resending, so some of " \
+                           "the messages sent after it cannot be resent. " \
+                           "Increase sent_message_capacity.", identifier,
+                           len(self.sent_messages))
+
+        # The messages held when the connection was lost are in the
+        # history, so they are resent along with the rest
+        del self.unwritten_messages[:]
+
+        messages = self.sent_messages.messages_after(identifier)
+        if len(messages) > 0:
+            self.metrics.increment("apns.resends")
+            self.write_message(messages)
 
         self.message_error = None
 
@@ -360,6 +1109,8 @@ class APNSClientFactory(ReconnectingClientFactory):
             process. """
 
         self._connected = False
+        self.hold_writes()
+        self.metrics.increment("apns.disconnects")
 
         log.msg(("Lost connection to the APNS. Reason: {0}").format(
             reason.getErrorMessage()))
@@ -383,52 +1134,572 @@ class APNSClientFactory(ReconnectingClientFactory):
         """ The connection attempt to the APNS has failed. """
 
         log.err(("Unable to connect to the APNS. Reason: {0}").format(reason))
+        self.metrics.increment("apns.connection_failures")
 
         ReconnectingClientFactory.clientConnectionFailed(self, connector,
                                                          reason)
 
+class APNSConnectionPool(object):
+    """ Distributes messages between a number of APNS client factories,
+        each of which maintains its own connection, sequence ids, sent
+        message history and backlog. """
+
+    def __init__(self, factories, policy=POOL_POLICY_LEAST_LOADED):
+        if policy not in (POOL_POLICY_LEAST_LOADED, POOL_POLICY_TOKEN_HASH):
+            raise APNSException("Unknown APNS connection pool policy: " \
+                                "{0}".format(policy))
+
+        self.factories = factories
+        self.policy = policy
+        self._next_index = 0
+        self._ring_keys = []
+        self._ring_indexes = []
+
+        if policy == POOL_POLICY_TOKEN_HASH:
+            self._build_ring()
+
+    @staticmethod
+    def _hash(value):
+        """ Returns an unsigned 32 bit hash of the value provided, which is
+            stable between processes (unlike the builtin hash). """
+
+        return struct.unpack_from("!L", hashlib.md5(value).digest())[0]
+
+    def _build_ring(self):
+        """ Builds the consistent hash ring used to map device tokens to
+            factories. Each factory is placed on the ring a number of times
+            so that tokens are spread evenly between them. """
+
+        ring = []
+        for index in range(len(self.factories)):
+            for replica in range(HASH_RING_REPLICAS):
+                ring.append((self._hash("{0}-{1}".format(index, replica)),
+                             index))
+        ring.sort()
+
+        self._ring_keys = [key for key, _ in ring]
+        self._ring_indexes = [index for _, index in ring]
+
+    def _least_loaded(self):
+        """ Returns the factory with the lowest load. The starting point
+            rotates on every call so that ties are broken in a round robin
+            fashion. """
+
+        factory_count = len(self.factories)
+        selected = None
+        selected_load = None
+
+        for offset in range(factory_count):
+            factory = self.factories[(self._next_index + offset) %
+                                     factory_count]
+            load = factory.load()
+            if selected is None or load < selected_load:
+                selected = factory
+                selected_load = load
+
+        self._next_index = (self._next_index + 1) % factory_count
+
+        return selected
+
+    def select(self, device_token):
+        """ Returns the factory which should be used to send a message to
+            the device with the specified decoded token. """
+
+        if len(self.factories) == 1:
+            return self.factories[0]
+
+        if self.policy == POOL_POLICY_TOKEN_HASH:
+            position = bisect.bisect(self._ring_keys,
+                                     self._hash(device_token))
+            if position == len(self._ring_keys):
+                position = 0
+            return self.factories[self._ring_indexes[position]]
+
+        return self._least_loaded()
+
+class APNSBulkSend(object):
+    """ Sends a single payload to every device token produced by an
+        iterable. The payload is packed once, and tokens are consumed in
+        chunks, waiting whenever the chosen connection cannot accept more
+        data, so that the tokens are never all held in memory at once.
+        Messages which cannot be written yet are held in the named lane of
+        the connection's backlog, by default the bulk lane. """
+
+    def __init__(self, service, device_tokens, payload,
+                 chunk_size=BULK_CHUNK_SIZE, decoded=False,
+                 lane=backlog.LANE_BULK):
+        self.service = service
+        self.lane = lane
+        self.device_tokens = iter(device_tokens)
+        self.template = service.packer.compile(payload)
+        self.chunk_size = chunk_size
+        self.decoded = decoded
+        self.deferred = defer.Deferred()
+        self.sent = 0
+        self.invalid = 0
+        self.suppressed = 0
+
+    def start(self):
+        """ Starts sending, returning a Deferred which fires with the number
+            of messages sent once every token has been processed. """
+
+        log.msg("Starting bulk APNS send")
+        self._send_chunk()
+
+        return self.deferred
+
+    def _resume(self, _, apns_factory, decoded_token):
+        """ Sends the message which was waiting for the connection to have
+            capacity, then carries on with the next chunk. """
+
+        apns_factory.send_template(decoded_token, self.template, self.lane)
+        self.sent += 1
+        self._send_chunk()
+
+    def _send_chunk(self):
+        """ Sends messages until the chunk size is reached, a connection
+            is unable to accept more data, or the tokens run out. """
+
+        sent_in_chunk = 0
+        for device_token in self.device_tokens:
+            try:
+                if self.decoded is True:
+                    decoded_token = check_token(device_token)
+                else:
+                    decoded_token = self.service.packer.decode_token(
+                        device_token)
+            except APNSException:
+                self.invalid += 1
+                continue
+
+            if decoded_token in self.service.suppression:
+                self.suppressed += 1
+                continue
+
+            apns_factory = self.service.pool.select(decoded_token)
+            if apns_factory.writable(self.lane) is False:
+                apns_factory.wait_for_capacity(self.lane).addCallback(
+                    self._resume, apns_factory, decoded_token)
+                return
+
+            apns_factory.send_template(decoded_token, self.template,
+                                       self.lane)
+            self.sent += 1
+            sent_in_chunk += 1
+
+            if sent_in_chunk >= self.chunk_size:
+                reactor.callLater(0, self._send_chunk)
+                return
+
+        self.service.count_suppressed(self.suppressed)
+        log.msg("Finished bulk APNS send. Sent: {0}, invalid tokens: " \
+                "{1}, suppressed tokens: {2}".format(self.sent, self.invalid,
+                                                    self.suppressed))
+        self.deferred.callback(self.sent)
+
 class APNSService(object):
     """ Sets up and controls the instances of the APNS and
-        APN Feedback factories. """
+        APN Feedback factories. If an HTTP/2 engine (see apns_http2.py) is
+        provided, messages are sent using it instead of the binary protocol
+        and the send methods return Deferreds which fire with the response
+        to each message. Tokens reported as invalid by the APNS are added to
+        the suppression index (by default the shared suppression.INDEX),
+        and messages to tokens in the index are not sent. Writes can be
+        paced to send_rate messages per second across the service and
+        connection_send_rate per connection (the HTTP/2 engine counts as
+        one connection), each with bursts (by default of one second's
+        worth); the pacing state is included in metrics
+        snapshots and returned by pacing_state. Each connection's backlog
+        has the lanes in backlog_lanes (see APNSClientFactory); messages
+        are sent in the normal lane and bulk sends in the bulk lane unless
+        another lane is given. Lanes are not used with HTTP/2. If a
+        coalesce_window is given, messages sent with send_message and
+        send_decoded_message are held for that many seconds, and messages
+        for the same token and collapse key are merged using coalesce_merge
+        (see coalesce.Coalescer). Unless sent_message_capacity is given,
+        each connection holds enough sent messages for resending to cover
+        ERROR_ROUND_TRIP_SECONDS at its send rate. """
 
     def __init__(self, certificate_file, key_file,
                  error_callback=None, use_sandbox=False,
-                 apns_queue_size=1):
+                 apns_queue_size=1, connection_count=APNS_CONNECTION_COUNT,
+                 pool_policy=POOL_POLICY_LEAST_LOADED, batch_writes=False,
+                 use_frame_format=False,
+                 flush_threshold_bytes=FLUSH_THRESHOLD_BYTES,
+                 sent_message_capacity=None,
+                 apns_queue_bytes=backlog.DEFAULT_MAX_BYTES,
+                 overflow_policy=backlog.OVERFLOW_DROP_OLDEST,
+                 http2_engine=None, metrics_registry=None, hostname=None,
+                 port=APNS_PORT, suppression_index=None, send_rate=None,
+                 send_burst=None, connection_send_rate=None,
+                 connection_send_burst=None,
+                 backlog_lanes=backlog.DEFAULT_LANES, lane_limits=None,
+                 coalesce_window=None, coalesce_merge=None,
+                 coalesce_max_held=coalesce.MAX_HELD_MESSAGES):
+
+        if connection_count < 1:
+            raise APNSException("At least one APNS connection is required")
 
         self.error_callback = error_callback
-        self.apns_factory = APNSClientFactory(self.handle_error,
-                                    apns_queue_size)
-
-        if use_sandbox is True:
+        self.apns_factories = []
+        self.producers = []
+        self.paused_connections = 0
+        self.http2_engine = http2_engine
+
+        if metrics_registry is None:
+            metrics_registry = metrics.REGISTRY
+        self.metrics = metrics_registry
+
+        if suppression_index is None:
+            suppression_index = suppression.INDEX
+        self.suppression = suppression_index
+
+        if coalesce_window is not None:
+            self.coalescer = coalesce.Coalescer(self._send_coalesced,
+                                                coalesce_window,
+                                                coalesce_merge,
+                                                coalesce_max_held,
+                                                metrics_registry,
+                                                "apns.coalesce")
+        else:
+            self.coalescer = None
+
+        # Each connection's pacer takes from this one as well, so that the
+        # service as a whole is limited to send_rate
+        self.pacer = pacing.TokenBucket(send_rate, send_burst)
+
+        if http2_engine is not None:
+            self.apns_factory = None
+            self.pool = None
+            self.packer = http2_engine.packer
+            http2_engine.error_callback = self.handle_http2_error
+            http2_engine.set_pacer(pacing.TokenBucket(connection_send_rate,
+                                                      connection_send_burst,
+                                                      self.pacer))
+            self.metrics.register_source(lambda: {"apns_pacing" :
+                                                  self.pacing_state()},
+                                         owner=self)
+            http2_engine.start()
+            return
+
+        # A single packer is shared by the whole pool so that the token
+        # cache and compiled structs are shared between the connections
+        self.packer = APNSMessagePacker(use_frame_format)
+
+        # Without a limit of its own, a connection may send at the rate of
+        # the whole service
+        if sent_message_capacity is None:
+            sent_message_capacity = sent_message_history_size(
+                connection_send_rate or send_rate)
+
+        for factory_index in range(connection_count):
+            self.apns_factories.append(APNSClientFactory(
+                functools.partial(self.handle_error,
+                                  factory_index=factory_index),
+                backlog_queue_size=apns_queue_size,
+                backlog_max_bytes=apns_queue_bytes,
+                overflow_policy=overflow_policy,
+                batch_writes=batch_writes,
+                flush_threshold_bytes=flush_threshold_bytes,
+                sent_message_capacity=sent_message_capacity,
+                packer=self.packer,
+                metrics_registry=metrics_registry,
+                send_rate=connection_send_rate,
+                send_burst=connection_send_burst,
+                service_pacer=self.pacer,
+                backlog_lanes=backlog_lanes,
+                lane_limits=lane_limits))
+
+        # Retained so that existing code referring to the single factory
+        # continues to work
+        self.apns_factory = self.apns_factories[0]
+        self.pool = APNSConnectionPool(self.apns_factories, pool_policy)
+
+        for apns_factory in self.apns_factories:
+            apns_factory.flow_listeners.append(self._connection_flow_changed)
+
+        self.metrics.register_source(lambda: {"apns_pacing" :
+                                              self.pacing_state()}, owner=self)
+
+        # The hostname and port can be overridden to connect to a local
+        # server, for example when benchmarking
+        if hostname is not None:
+            apns_host = hostname
+        elif use_sandbox is True:
             apns_host = APNS_SANDBOX_HOSTNAME
         else:
             apns_host = APNS_HOSTNAME
 
-        reactor.connectSSL(apns_host, APNS_PORT,
-                    self.apns_factory,
-                    common.APNSClientContextFactory(certificate_file,
-                                                  key_file))
+        context_factory = common.APNSClientContextFactory(certificate_file,
+                                                          key_file)
+
+        for apns_factory in self.apns_factories:
+            reactor.connectSSL(apns_host, port, apns_factory,
+                               context_factory)
 
-    def handle_error(self, error_tuple):
+    def unregister_metrics(self):
+        """ Removes the gauges registered by this service and its
+            connections from the metrics registry, for use when it is being
+            replaced by a new one. """
+
+        self.metrics.unregister(self)
+        for apns_factory in self.apns_factories:
+            apns_factory.unregister_metrics()
+        if self.http2_engine is not None:
+            self.http2_engine.unregister_metrics()
+        if self.coalescer is not None:
+            self.coalescer.unregister_metrics()
+
+    def handle_error(self, error_tuple, factory_index=0):
         """ Method which handles error response that have been received from
-            the APNS, for example when a token is no longer valid. """
+            the APNS, for example when a token is no longer valid. As each
+            connection has its own sequence ids, the token is looked up in
+            the history of the factory which received the error. """
+
+        error_value = error_tuple[ERROR_VALUE_INDEX]
+        if self.error_callback is None and \
+                error_value != INVALID_TOKEN_ERROR:
+            return
+
+        invalid_token = 0
+        apns_factory = self.apns_factories[factory_index]
+        decoded_token = apns_factory.sent_messages.token(
+            int(error_tuple[SENT_MESSAGE_INDEX]))
+        if decoded_token is not None:
+            if error_value == INVALID_TOKEN_ERROR:
+                self.suppress(decoded_token)
+            invalid_token = base64.encodestring(decoded_token). \
+                replace('\n', '')
 
         if self.error_callback is not None:
-            invalid_token = 0
-            error_value = error_tuple[ERROR_VALUE_INDEX]
-            for message in self.apns_factory.sent_messages:
-                if message.has_key(int(error_tuple[SENT_MESSAGE_INDEX])):
-                    invalid_token = message[int(error_tuple[
-                        SENT_MESSAGE_INDEX])][0]
-                    break
-
             response = (error_value, invalid_token)
 
             self.error_callback(response)
 
-    def send_message(self, device_token, payload):
-        """ Initiates the process to send the payload to the
-            device with the specified token. """
+    def handle_http2_error(self, error_tuple):
+        """ Handles an error response received by the HTTP/2 engine, which
+            reports the equivalent binary protocol error and the base64
+            encoded token. """
+
+        if error_tuple[ERROR_VALUE_INDEX] == INVALID_TOKEN_ERROR:
+            self.suppress(base64.decodestring(error_tuple[1]))
+
+        if self.error_callback is not None:
+            self.error_callback(error_tuple)
+
+    def suppress(self, decoded_token):
+        """ Adds a token which the APNS has reported as invalid, or which
+            the feedback service has returned, to the suppression index so
+            that no more messages are sent to it. """
+
+        if self.suppression.add(decoded_token) is True:
+            self.metrics.increment("apns.tokens_suppressed")
 
-        self.apns_factory.sendMessage(device_token, payload)
+    def count_suppressed(self, message_count=1):
+        """ Counts messages which were not sent as their tokens are in the
+            suppression index. """
 
+        if message_count > 0:
+            logger.count("APNS messages suppressed", message_count)
+            self.metrics.increment("apns.messages_suppressed", message_count)
+
+    def pacing_state(self):
+        """ Returns a dict describing the pacing of the service and of each
+            connection. """
+
+        if self.http2_engine is not None:
+            connections = [self.http2_engine.pacer.state()]
+        else:
+            connections = [apns_factory.pacing_state()
+                           for apns_factory in self.apns_factories]
+
+        return {"service" : self.pacer.state(),
+                "connections" : connections}
+
+    def set_send_rate(self, send_rate=UNCHANGED, send_burst=UNCHANGED,
+                      connection_send_rate=UNCHANGED,
+                      connection_send_burst=UNCHANGED):
+        """ Changes the pacing of the service and its connections while it
+            is running. A rate of None removes that limit, and any limit
+            which is not passed keeps its current value. """
+
+        self.pacer.set_rate(*self._new_rate(self.pacer, send_rate,
+                                            send_burst))
+
+        if self.http2_engine is not None:
+            pacer = self.http2_engine.pacer
+            pacer.set_rate(*self._new_rate(pacer, connection_send_rate,
+                                           connection_send_burst))
+            self.http2_engine.set_pacer(pacer)
+            return
+
+        for apns_factory in self.apns_factories:
+            apns_factory.set_send_rate(*self._new_rate(apns_factory.pacer,
+                connection_send_rate, connection_send_burst))
+
+    def _new_rate(self, pacer, rate, burst):
+        """ Returns the rate and burst to give the pacer, keeping its current
+            values for those which are UNCHANGED. """
+
+        if rate is UNCHANGED:
+            rate = pacer.rate
+        if burst is UNCHANGED:
+            burst = pacer.burst
+
+        return rate, burst
+
+    def registerProducer(self, producer):
+        """ Registers a push producer (for example the transport of a
+            connection messages are being read from) which is paused while
+            any of the APNS connections are unable to accept more data. """
+
+        self.producers.append(producer)
+        if self.paused_connections > 0:
+            producer.pauseProducing()
+
+    def unregisterProducer(self, producer):
+        """ Stops the producer from being paused and resumed. """
+
+        if producer in self.producers:
+            self.producers.remove(producer)
+
+    def _connection_flow_changed(self, paused):
+        """ Pauses the registered producers when the first connection is
+            paused, and resumes them once all connections have resumed. """
+
+        if paused is True:
+            self.paused_connections += 1
+            if self.paused_connections == 1:
+                for producer in self.producers:
+                    producer.pauseProducing()
+        else:
+            self.paused_connections -= 1
+            if self.paused_connections == 0:
+                for producer in self.producers:
+                    producer.resumeProducing()
+
+    def send_message_when_ready(self, device_token, payload,
+                                lane=backlog.LANE_NORMAL):
+        """ Sends the payload once the connection chosen for the device is
+            able to accept more data. Returns a Deferred which fires when the
+            message has been written, so that callers which wait for it
+            never build up more than the transport can hold. """
+
+        decoded_token = self.packer.decode_token(device_token)
+
+        if decoded_token in self.suppression:
+            self.count_suppressed()
+            return defer.succeed(None)
+
+        if self.http2_engine is not None:
+            deferred = self.http2_engine.wait_for_capacity()
+            deferred.addCallback(lambda _: self.http2_engine.
+                                 send_decoded_message(decoded_token, payload))
+            return deferred
+
+        apns_factory = self.pool.select(decoded_token)
+
+        deferred = apns_factory.wait_for_capacity(lane)
+        deferred.addCallback(lambda _: apns_factory.send_decoded_message(
+            decoded_token, payload, lane))
+
+        return deferred
+
+    def send_bulk(self, device_tokens, payload, chunk_size=BULK_CHUNK_SIZE,
+                  lane=backlog.LANE_BULK):
+        """ Sends the payload to every device in the list of tokens. The
+            payload is only packed once, and messages are written in chunks
+            as the connections are able to accept them. Returns a Deferred
+            which fires with the number of messages sent. """
+
+        return self.send_bulk_iter(iter(device_tokens), payload, chunk_size,
+                                   lane=lane)
+
+    def send_bulk_iter(self, device_tokens, payload,
+                       chunk_size=BULK_CHUNK_SIZE, decoded=False,
+                       lane=backlog.LANE_BULK):
+        """ As send_bulk, but takes any iterator or generator of tokens, which
+            is only consumed as quickly as the messages can be written. If
+            decoded is True the tokens are already in their binary form. """
+
+        if self.http2_engine is not None:
+            return self.http2_engine.send_bulk_iter(
+                self._unsuppressed(device_tokens, decoded), payload, decoded)
+
+        return APNSBulkSend(self, device_tokens, payload, chunk_size,
+                            decoded, lane).start()
+
+    def _unsuppressed(self, device_tokens, decoded):
+        """ Generator which passes on the tokens which are not in the
+            suppression index. Tokens which cannot be decoded are passed on,
+            to be counted as invalid by the bulk send. """
+
+        suppressed = 0
+        for device_token in device_tokens:
+            if decoded is True:
+                decoded_token = device_token
+            else:
+                try:
+                    decoded_token = self.packer.decode_token(device_token)
+                except APNSException:
+                    yield device_token
+                    continue
+
+            if decoded_token in self.suppression:
+                suppressed += 1
+            else:
+                yield device_token
+
+        self.count_suppressed(suppressed)
+
+    def send_message(self, device_token, payload, lane=backlog.LANE_NORMAL,
+                     collapse_key=None):
+        """ Initiates the process to send the payload to the
+            device with the specified token, using the connection
+            chosen by the pool. """
+
+        return self.send_decoded_message(self.packer.decode_token(
+            device_token), payload, lane, collapse_key)
+
+    def send_decoded_message(self, decoded_token, payload,
+                             lane=backlog.LANE_NORMAL, collapse_key=None):
+        """ Sends the payload to the device with the specified token, which
+            has already been decoded into its 32 byte binary form. Nothing is
+            sent if the token is in the suppression index. The lane is the
+            one the message waits in if it cannot be written yet. When
+            coalescing, the message is held with others for the same token
+            and collapse key, and a Deferred is returned which fires once
+            the merged message has been sent (or fails if it could not
+            be). """
+
+        check_token(decoded_token)
+        if self.coalescer is not None:
+            return self.coalescer.submit(decoded_token, payload,
+                                         collapse_key, lane)
+
+        return self._send_decoded_message(decoded_token, payload, lane)
+
+    def _send_coalesced(self, messages):
+        """ Sends the messages released by the coalescer, returning a
+            Deferred for each. """
+
+        return [defer.maybeDeferred(self._send_decoded_message, decoded_token,
+                                    payload, lane)
+                for decoded_token, payload, lane in messages]
+
+    def _send_decoded_message(self, decoded_token, payload, lane):
+        """ Sends the payload to the device, unless its token is
+            suppressed. """
+
+        if decoded_token in self.suppression:
+            self.count_suppressed()
+            if self.http2_engine is not None:
+                return defer.succeed(None)
+            return
+
+        if self.http2_engine is not None:
+            return self.http2_engine.send_decoded_message(decoded_token,
+                                                          payload)
+
+        self.pool.select(decoded_token).send_decoded_message(decoded_token,
+                                                             payload, lane)
@@ -1,20 +1,106 @@
 """apns_feedback.py: Module which contains functionality which polls
 the APNS feedback service for expired/invalid tokens. """
 
-import base64
 import struct
+import binascii
 import common
+import logger
+import metrics
+import suppression
 from twisted.internet.protocol import ReconnectingClientFactory
 from twisted.internet import defer, reactor
 from twisted.protocols.basic import LineReceiver
 from twisted.python import log
-from StringIO import StringIO
 
 APN_HOSTNAME = "feedback.push.apple.com"
 APN_SANDBOX_HOSTNAME = "feedback.sandbox.push.apple.com"
 APN_FEEDBACK_PORT = 2196
 FEEDBACK_INTERVAL = 43200
 
+# Each tuple is a 4 byte time and a 2 byte token length, followed by the
+# token itself
+FEEDBACK_HEADER = struct.Struct("!IH")
+
+# Number of tokens passed to the feedback callback at a time
+FEEDBACK_BATCH_SIZE = 1000
+
+class FeedbackParser(object):
+    """ Decodes the feedback stream incrementally as data arrives. Complete
+        tuples are read using offsets into a memoryview of the buffer, which
+        is only compacted once per read, so the cost of parsing is linear in
+        the size of the stream. Tokens are delivered to the callback in
+        batches of batch_size. """
+
+    def __init__(self, batch_callback, batch_size=FEEDBACK_BATCH_SIZE):
+        self.batch_callback = batch_callback
+        self.batch_size = batch_size
+        self.buffer = bytearray()
+        self.batch = []
+        self.token_count = 0
+        self.batch_count = 0
+
+    def feed(self, data):
+        """ Adds the data received to the buffer and decodes every complete
+            tuple it now contains. """
+
+        self.buffer.extend(data)
+        offset = self._parse()
+
+        # The memoryview used by _parse has been released, so the buffer
+        # can be resized
+        if offset > 0:
+            del self.buffer[:offset]
+
+    def _parse(self):
+        """ Decodes the complete tuples in the buffer, returning the offset
+            of the first byte which has not been consumed. """
+
+        view = memoryview(self.buffer)
+        buffer_length = len(view)
+        header_size = FEEDBACK_HEADER.size
+        offset = 0
+
+        while buffer_length - offset >= header_size:
+            feedback_time, token_length = FEEDBACK_HEADER.unpack_from(view,
+                                                                      offset)
+            token_end = offset + header_size + token_length
+            if token_end > buffer_length:
+                break
+
+            encoded_token = binascii.b2a_base64(
+                view[offset + header_size:token_end].tobytes())[:-1]
+            self.batch.append((feedback_time, encoded_token))
+            offset = token_end
+
+            if len(self.batch) >= self.batch_size:
+                self._deliver()
+
+        return offset
+
+    def _deliver(self):
+        """ Passes the current batch to the callback. """
+
+        batch = self.batch
+        self.batch = []
+        self.token_count += len(batch)
+        self.batch_count += 1
+        self.batch_callback(batch)
+
+    def finish(self):
+        """ Delivers any tokens which have not yet been passed to the
+            callback. The callback is always called at least once, so an
+            empty list is delivered if no tokens were received. Returns the
+            number of bytes left over, which is non zero if the stream ended
+            part way through a tuple. """
+
+        if len(self.batch) > 0 or self.batch_count == 0:
+            self._deliver()
+
+        remaining = len(self.buffer)
+        del self.buffer[:]
+
+        return remaining
+
 class APNProcessFeedback(LineReceiver):
     """ Handles the data that is received from the APN feedback service. """
 
@@ -29,14 +115,14 @@ class APNProcessFeedback(LineReceiver):
     def rawDataReceived(self, data):
         """ Called when data is received from the feedback service. """
 
-        log.msg("Receiving data from the APN Feedback Service")
-        self.input.write(data)
+        logger.debug("Receiving data from the APN Feedback Service")
+        self.parser.feed(data)
 
     def lineReceived(self, data):
         """ Called when data is received from the feedback service. """
 
-        log.msg("Receiving data from the APN Feedback Service")
-        self.input.write(data)
+        logger.debug("Receiving data from the APN Feedback Service")
+        self.parser.feed(data)
 
     def connectionLost(self, reason):
         """ Called when the connection is closed by the feedback service (this
@@ -44,24 +130,35 @@ class APNProcessFeedback(LineReceiver):
 
         log.msg("Finished receiving data from the Feedback Service.")
 
-        self.factory.process_list(self.input.getvalue())
-        self.input.close()
+        self.factory.finish_parsing(self.parser)
 
 class APNFeedbackClientFactory(ReconnectingClientFactory):
     """ Factory which manages instances of the protocol which connect to the
-        APN Feedback Service to retrieve invalid client tokens. """
-
-    def __init__(self, feedback_callback):
+        APN Feedback Service to retrieve invalid client tokens. The tokens
+        received are added to the suppression index (by default the shared
+        suppression.INDEX), so that the APNSService stops sending to them. """
+
+    def __init__(self, feedback_callback, metrics_registry=None,
+                 batch_size=FEEDBACK_BATCH_SIZE, suppression_index=None):
+        if metrics_registry is None:
+            metrics_registry = metrics.REGISTRY
+        self.metrics = metrics_registry
+
+        if suppression_index is None:
+            suppression_index = suppression.INDEX
+        self.suppression = suppression_index
         self.deferred = defer.Deferred()
         self.deferred.addCallback(self.process_list)
 
         self.protocol = APNProcessFeedback()
         self.feedback_callback = feedback_callback
+        self.batch_size = batch_size
 
     def buildProtocol(self, addr):
         """ Builds an instance of the APNProcessFeedback protocol. """
 
         log.msg("Connecting to the APN feedback service")
+        self.metrics.increment("apns_feedback.connections")
         self.initialDelay = FEEDBACK_INTERVAL
         self.maxDelay = FEEDBACK_INTERVAL
         self.resetDelay()
@@ -69,43 +166,51 @@ class APNFeedbackClientFactory(ReconnectingClientFactory):
         new_protocol = self.protocol
         new_protocol.factory = self
         new_protocol.deferred = self.deferred
-        new_protocol.input = StringIO()
+        new_protocol.parser = FeedbackParser(self.deliver_tokens,
+                                             self.batch_size)
         new_protocol.setRawMode()
 
         return new_protocol
 
-    def process_list(self, data):
-        """ Parses a list of tokens received from the feedback service. """
-
-        log.msg("Processing the tokens received from the APN feedback service")
+    def deliver_tokens(self, token_list):
+        """ Passes a batch of (time, token) tuples decoded from the feedback
+            stream to the feedback callback. """
 
-        token_list = []
-        header_size = 6
-
-        while data != "":
-            try:
-                # Format is a 4 byte time followed by a 2 byte token
-                # length field
-                feedback_time, token_length = struct.unpack_from('!lh', data, 0)
-                data = data[header_size:]
-
-                # Extract the token by using the length that has just been
-                # retrieved
-                token = struct.unpack_from("!{0}s".format(token_length),
-                                           data, 0)[0]
-                encoded_token = base64.encodestring(token).replace('\n', '')
-                token_list.append((feedback_time, encoded_token))
-                data = data[token_length:]
-            except struct.error:
-                log.err("Could not parse data received from the APN " \
-                        "Feedback service.")
-                break
+        self.metrics.increment("apns_feedback.tokens_received",
+                               len(token_list))
 
-        log.msg("Finished processing the token list received from " \
-                "the APN feedback service")
+        suppressed = 0
+        for _, token in token_list:
+            if self.suppression.add(binascii.a2b_base64(token)) is True:
+                suppressed += 1
+        self.metrics.increment("apns_feedback.tokens_suppressed", suppressed)
 
         self.feedback_callback(token_list)
 
+    def finish_parsing(self, parser):
+        """ Delivers the last batch once the feedback service has closed the
+            connection, reporting a stream which ended part way through a
+            tuple. """
+
+        remaining = parser.finish()
+        if remaining > 0:
+            self.metrics.increment("apns_feedback.parse_errors")
+            log.err("Could not parse the last {0} bytes received from the " \
+                    "APN Feedback service.".format(remaining))
+
+        log.msg("Finished processing the {0} tokens received from the APN " \
+                "feedback service".format(parser.token_count))
+
+    def process_list(self, data):
+        """ Parses a complete list of tokens received from the feedback
+            service, delivering them to the feedback callback in batches. """
+
+        log.msg("Processing the tokens received from the APN feedback service")
+
+        parser = FeedbackParser(self.deliver_tokens, self.batch_size)
+        parser.feed(data)
+        self.finish_parsing(parser)
+
     def startedConnecting(self, connector):
         """ Called when a connection attempt to the APN feedback service
             has started. """
@@ -122,16 +227,22 @@ class APNFeedbackClientFactory(ReconnectingClientFactory):
         """ The connection attempt to the APN feedback service has failed. """
 
         log.err("Unable to connect to the APN feedback service")
+        self.metrics.increment("apns_feedback.connection_failures")
 
         ReconnectingClientFactory.clientConnectionLost(self, connector, reason)
 
 class APNFeedbackService(object):
     """ Sets up and controls the instances of the
-        APN Feedback factory. """
+        APN Feedback factory. The feedback callback is passed lists of at
+        most batch_size (time, token) tuples as the tokens are received. """
 
     def __init__(self, certificate_file, key_file, feedback_callback,
-                 use_sandbox=False):
-        self.apns_receiver = APNFeedbackClientFactory(feedback_callback)
+                 use_sandbox=False, metrics_registry=None,
+                 batch_size=FEEDBACK_BATCH_SIZE, suppression_index=None):
+        self.apns_receiver = APNFeedbackClientFactory(feedback_callback,
+                                                      metrics_registry,
+                                                      batch_size,
+                                                      suppression_index)
 
         if use_sandbox is True:
             apns_host = APN_SANDBOX_HOSTNAME
@@ -0,0 +1,584 @@
+"""apns_http2.py: Module which contains functionality enabling push
+notification messages to be sent to the APNS using its HTTP/2 provider API,
+as an alternative to the binary protocol used in apns.py. Many notifications
+are multiplexed over a single connection as concurrent streams, and each
+one receives its own response. Requires the h2 package, and the
+cryptography package when authenticating with a provider token. """
+
+import json
+import time
+import base64
+import binascii
+import collections
+import apns
+import common
+import logger
+import metrics
+import pacing
+from twisted.internet.protocol import Protocol, ReconnectingClientFactory
+from twisted.python import log
+from twisted.internet import defer, reactor
+
+try:
+    from h2.config import H2Configuration
+    from h2.connection import H2Connection
+    from h2.exceptions import ProtocolError
+    from h2 import events as h2_events
+except ImportError:
+    H2Connection = None
+
+try:
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import ec, utils
+except ImportError:
+    ec = None
+
+APNS_HTTP2_HOSTNAME = "api.push.apple.com"
+APNS_HTTP2_SANDBOX_HOSTNAME = "api.sandbox.push.apple.com"
+APNS_HTTP2_PORT = 443
+MAX_PAYLOAD_SIZE_BYTES = 4096
+MAX_CONCURRENT_STREAMS = 1000
+MAX_PENDING_NOTIFICATIONS = 10000
+MAX_NOTIFICATION_RETRIES = 3
+PROVIDER_TOKEN_LIFETIME = 3000
+DEFAULT_PRIORITY = 10
+STATUS_SUCCESS = 200
+EXPIRED_PROVIDER_TOKEN = "ExpiredProviderToken"
+
+# The equivalent binary protocol error code for each HTTP/2 error reason,
+# so that error callbacks receive the same values whichever engine is used.
+# DeviceTokenNotForTopic is left as unknown, as the token is still valid for
+# other topics and must not be suppressed
+REASON_ERROR_CODES = {
+    "BadDeviceToken" : 8,
+    "Unregistered" : 8,
+    "MissingDeviceToken" : 2,
+    "MissingTopic" : 3,
+    "PayloadEmpty" : 4,
+    "BadTopic" : 6,
+    "PayloadTooLarge" : 7,
+    "InternalServerError" : 1,
+    "ServiceUnavailable" : 10,
+    "Shutdown" : 10,
+}
+UNKNOWN_ERROR_CODE = 255
+
+def _base64url(data):
+    """ Returns the data base64url encoded without padding, as used by
+        JSON Web Tokens. """
+
+    return base64.urlsafe_b64encode(data).rstrip("=")
+
+class APNSProviderToken(object):
+    """ Creates the JSON Web Token used to authenticate with the APNS,
+        signed with the ES256 key provided by Apple. The token is reused
+        until it is due to expire, as Apple rejects tokens which are
+        regenerated too often. """
+
+    def __init__(self, auth_key_file, key_id, team_id,
+                 lifetime=PROVIDER_TOKEN_LIFETIME):
+        if ec is None:
+            raise apns.APNSException("The cryptography package is required " \
+                                     "to authenticate with a provider token")
+
+        with open(auth_key_file) as key_file:
+            self.key = serialization.load_pem_private_key(key_file.read(),
+                password=None, backend=default_backend())
+
+        self.key_id = key_id
+        self.team_id = team_id
+        self.lifetime = lifetime
+        self.token = None
+        self.issued_at = 0
+
+    def get(self):
+        """ Returns the current token, creating a new one if necessary. """
+
+        now = int(time.time())
+        if self.token is None or now - self.issued_at >= self.lifetime:
+            self.token = self._create(now)
+            self.issued_at = now
+
+        return self.token
+
+    def invalidate(self):
+        """ Forces a new token to be created the next time one is used. """
+
+        self.token = None
+
+    def _create(self, issued_at):
+        """ Creates and signs a new token. """
+
+        header = _base64url(json.dumps({"alg" : "ES256",
+                                        "kid" : self.key_id}))
+        claims = _base64url(json.dumps({"iss" : self.team_id,
+                                        "iat" : issued_at}))
+        signing_input = "{0}.{1}".format(header, claims)
+
+        # The signature is DER encoded, whereas JWT expects the raw 32 byte
+        # r and s values
+        signature = self.key.sign(signing_input, ec.ECDSA(hashes.SHA256()))
+        r_value, s_value = utils.decode_dss_signature(signature)
+        raw_signature = binascii.unhexlify("{0:064x}{1:064x}".format(r_value,
+                                                                    s_value))
+
+        return "{0}.{1}".format(signing_input, _base64url(raw_signature))
+
+class HTTP2Notification(object):
+    """ A notification waiting to be sent, or awaiting its response. """
+
+    __slots__ = ('decoded_token', 'payload', 'expiry', 'priority',
+                 'collapse_id', 'deferred', 'retries', 'created')
+
+    def __init__(self, decoded_token, payload, expiry, priority,
+                 collapse_id=None):
+        self.decoded_token = decoded_token
+        self.payload = payload
+        self.expiry = expiry
+        self.priority = priority
+        self.collapse_id = collapse_id
+        self.deferred = defer.Deferred()
+        self.retries = 0
+        self.created = time.time()
+
+class APNSHTTP2Protocol(Protocol):
+    """ Protocol which sends notifications to the APNS as HTTP/2 streams
+        and matches each response with the notification that caused it. """
+
+    def __init__(self):
+        self.connection = H2Connection(H2Configuration(client_side=True))
+        self.streams = {}
+        self.max_streams = MAX_CONCURRENT_STREAMS
+
+    def connectionMade(self):
+        """ Sends the HTTP/2 preamble and starts sending notifications. """
+
+        self.connection.initiate_connection()
+        self.flush()
+        self.factory.engine.connection_made(self)
+
+    def flush(self):
+        """ Writes any data the HTTP/2 connection has waiting to be sent. """
+
+        data = self.connection.data_to_send()
+        if data:
+            self.transport.write(data)
+
+    def can_send(self, notification):
+        """ Returns True if another stream can be opened and its payload is
+            allowed by the connection's flow control window. """
+
+        if len(self.streams) >= self.max_streams:
+            return False
+
+        return len(notification.payload) <= min(
+            self.connection.outbound_flow_control_window,
+            self.connection.remote_settings.initial_window_size)
+
+    def send_notification(self, notification, headers):
+        """ Opens a new stream and sends the notification on it. The data is
+            only written to the transport when flush is called. """
+
+        stream_id = self.connection.get_next_available_stream_id()
+        self.connection.send_headers(stream_id, headers)
+        self.connection.send_data(stream_id, notification.payload,
+                                  end_stream=True)
+        self.streams[stream_id] = [notification, None, []]
+
+    def dataReceived(self, data):
+        """ Processes the HTTP/2 frames received from the APNS. """
+
+        try:
+            events = self.connection.receive_data(data)
+        except ProtocolError as exception:
+            log.err("HTTP/2 protocol error from the APNS: {0}".format(
+                exception))
+            self.transport.loseConnection()
+            return
+
+        for event in events:
+            if isinstance(event, h2_events.ResponseReceived):
+                stream = self.streams.get(event.stream_id)
+                if stream is not None:
+                    stream[1] = int(dict(event.headers)[":status"])
+            elif isinstance(event, h2_events.DataReceived):
+                stream = self.streams.get(event.stream_id)
+                if stream is not None:
+                    stream[2].append(event.data)
+                self.connection.acknowledge_received_data(
+                    event.flow_controlled_length, event.stream_id)
+            elif isinstance(event, h2_events.StreamEnded):
+                self._stream_ended(event.stream_id)
+            elif isinstance(event, h2_events.StreamReset):
+                stream = self.streams.pop(event.stream_id, None)
+                if stream is not None:
+                    self.factory.engine.retry(stream[0])
+            elif isinstance(event, h2_events.RemoteSettingsChanged):
+                self.max_streams = min(MAX_CONCURRENT_STREAMS,
+                    self.connection.remote_settings.max_concurrent_streams)
+            elif isinstance(event, h2_events.ConnectionTerminated):
+                log.msg("APNS closed the HTTP/2 connection. Error code: " \
+                        "{0}".format(event.error_code))
+                self.transport.loseConnection()
+
+        self.flush()
+        self.factory.engine.send_pending()
+
+    def _stream_ended(self, stream_id):
+        """ Passes the status and reason of a completed response to the
+            engine. """
+
+        stream = self.streams.pop(stream_id, None)
+        if stream is None:
+            return
+
+        notification, status, body = stream
+        reason = None
+        if len(body) > 0:
+            try:
+                reason = json.loads("".join(body)).get("reason")
+            except ValueError:
+                log.err("Unable to parse APNS response body: {0}".format(
+                    "".join(body)))
+
+        self.factory.engine.notification_complete(notification, status,
+                                                  reason)
+
+    def connectionLost(self, reason):
+        """ Notifications which had not received a response are retried on
+            the next connection. """
+
+        log.msg("APNS HTTP/2 connection lost with {0} streams in " \
+                "flight".format(len(self.streams)))
+
+        streams = self.streams
+        self.streams = {}
+        for stream_id in sorted(streams):
+            self.factory.engine.retry(streams[stream_id][0])
+
+        self.factory.engine.connection_lost(self)
+
+class APNSHTTP2ClientFactory(ReconnectingClientFactory):
+    """ Factory which manages the HTTP/2 connection to the APNS. """
+
+    def __init__(self, engine):
+        self.engine = engine
+
+    def buildProtocol(self, addr):
+        """ Builds an instance of the APNSHTTP2Protocol. """
+
+        log.msg(("Connected to the APNS HTTP/2 API at {0}:{1}").format(
+            addr.host, addr.port))
+        self.resetDelay()
+
+        new_protocol = APNSHTTP2Protocol()
+        new_protocol.factory = self
+
+        return new_protocol
+
+    def startedConnecting(self, connector):
+        """ Called when a connection attempt to the APNS has started. """
+
+        log.msg("Attempting to connect to the APNS HTTP/2 API.")
+
+    def clientConnectionLost(self, connector, reason):
+        """ Called when the connection to the APNS has been lost. """
+
+        log.msg(("Lost connection to the APNS HTTP/2 API. Reason: " \
+                 "{0}").format(reason.getErrorMessage()))
+
+        ReconnectingClientFactory.clientConnectionLost(self, connector,
+                                                       reason)
+
+    def clientConnectionFailed(self, connector, reason):
+        """ The connection attempt to the APNS has failed. """
+
+        log.err(("Unable to connect to the APNS HTTP/2 API. Reason: " \
+                 "{0}").format(reason))
+
+        ReconnectingClientFactory.clientConnectionFailed(self, connector,
+                                                         reason)
+
+class APNSHTTP2Engine(object):
+    """ Sends notifications using the APNS HTTP/2 API. An instance can be
+        passed to APNSService, which then uses it in place of the binary
+        protocol connections. Each send returns a Deferred which fires with
+        a (status, reason) tuple once the APNS has responded. Requests are
+        only opened as quickly as pacer allows, which by default does not
+        limit them; APNSService replaces it when pacing is configured. """
+
+    def __init__(self, topic, auth_key_file=None, key_id=None, team_id=None,
+                 certificate_file=None, key_file=None, use_sandbox=False,
+                 hostname=None, port=APNS_HTTP2_PORT, use_tls=True,
+                 max_pending=MAX_PENDING_NOTIFICATIONS, metrics_registry=None):
+        if H2Connection is None:
+            raise apns.APNSException("The h2 package is required to use " \
+                                     "the APNS HTTP/2 API")
+
+        if hostname is None:
+            if use_sandbox is True:
+                hostname = APNS_HTTP2_SANDBOX_HOSTNAME
+            else:
+                hostname = APNS_HTTP2_HOSTNAME
+
+        if auth_key_file is not None:
+            self.provider_token = APNSProviderToken(auth_key_file, key_id,
+                                                    team_id)
+        else:
+            self.provider_token = None
+
+        self.topic = topic
+        self.hostname = hostname
+        self.port = port
+        self.use_tls = use_tls
+        self.certificate_file = certificate_file
+        self.key_file = key_file
+        self.max_pending = max_pending
+        self.error_callback = None
+        self.packer = apns.APNSMessagePacker()
+        self.factory = APNSHTTP2ClientFactory(self)
+        self.protocol = None
+        self.pending = collections.deque()
+        self.in_flight = 0
+        self.capacity_waiters = collections.deque()
+        self.pacer = pacing.TokenBucket()
+        self.pace_trigger = None
+
+        if metrics_registry is None:
+            metrics_registry = metrics.REGISTRY
+        self.metrics = metrics_registry
+        self.metrics.register_gauge("apns_http2.in_flight",
+                                    lambda: self.in_flight, owner=self)
+        self.metrics.register_gauge("apns_http2.pending",
+                                    lambda: len(self.pending), owner=self)
+
+    def unregister_metrics(self):
+        """ Removes the gauges registered by this engine from the metrics
+            registry, for use when it is being replaced by a new one. """
+
+        self.metrics.unregister(self)
+
+    def start(self):
+        """ Connects to the APNS. Plain TCP (HTTP/2 with prior knowledge) is
+            used if TLS is disabled, which is useful for testing against a
+            local server. """
+
+        if self.use_tls is True:
+            reactor.connectSSL(self.hostname, self.port, self.factory,
+                common.HTTP2ClientContextFactory(self.certificate_file,
+                                                 self.key_file))
+        else:
+            reactor.connectTCP(self.hostname, self.port, self.factory)
+
+    def connection_made(self, protocol):
+        """ Called when a connection is ready to send notifications. """
+
+        self.protocol = protocol
+        self.send_pending()
+
+    def connection_lost(self, protocol):
+        """ Called when the connection has been lost. """
+
+        if self.protocol is protocol:
+            self.protocol = None
+
+    def build_headers(self, notification):
+        """ Returns the HTTP/2 request headers for the notification. """
+
+        headers = [(":method", "POST"),
+                   (":scheme", "https"),
+                   (":path", "/3/device/" +
+                    binascii.hexlify(notification.decoded_token)),
+                   (":authority", self.hostname),
+                   ("apns-topic", self.topic),
+                   ("apns-expiration", str(notification.expiry)),
+                   ("apns-priority", str(notification.priority)),
+                   ("content-length", str(len(notification.payload)))]
+
+        if self.provider_token is not None:
+            headers.append(("authorization",
+                            "bearer " + self.provider_token.get()))
+
+        if notification.collapse_id is not None:
+            headers.append(("apns-collapse-id", notification.collapse_id))
+
+        return headers
+
+    def send_pending(self):
+        """ Opens streams for as many pending notifications as the connection
+            and the pacer allow. If the pacer holds notifications back, this
+            is called again once it allows more. """
+
+        # While waiting for the pacer, the scheduled call sends the
+        # notifications
+        if self.pace_trigger is not None:
+            if self.pace_trigger.active():
+                return
+            self.pace_trigger = None
+
+        if self.protocol is None:
+            return
+
+        sent = 0
+        while len(self.pending) > 0 and \
+                self.protocol.can_send(self.pending[0]) is True:
+            if self.pacer.ready() is False:
+                self.metrics.increment("apns_http2.pacing_waits")
+                self.pace_trigger = reactor.callLater(
+                    max(self.pacer.delay(), apns.PACING_INTERVAL),
+                    self.send_pending)
+                break
+
+            notification = self.pending.popleft()
+            self.protocol.send_notification(notification,
+                                            self.build_headers(notification))
+            self.pacer.take()
+            sent += 1
+
+        if sent > 0:
+            self.metrics.increment("apns_http2.requests", sent)
+            self.protocol.flush()
+
+    def set_pacer(self, pacer):
+        """ Replaces the pacer, and sends whatever the new one allows. """
+
+        self.pacer = pacer
+        if self.pace_trigger is not None and self.pace_trigger.active():
+            self.pace_trigger.cancel()
+        self.pace_trigger = None
+        self.send_pending()
+
+    def send_message(self, device_token, payload, **kwargs):
+        """ Sends the payload to the device with the base64 encoded token. """
+
+        return self.send_decoded_message(self.packer.decode_token(
+            device_token), payload, **kwargs)
+
+    def send_decoded_message(self, decoded_token, payload,
+                             priority=DEFAULT_PRIORITY, collapse_id=None):
+        """ Sends the payload to the device with the binary token. Returns a
+            Deferred which fires with the (status, reason) of the response. """
+
+        apns.check_token(decoded_token)
+        payload = apns.encode_payload(payload)
+        if len(payload) > MAX_PAYLOAD_SIZE_BYTES:
+            raise apns.APNSException("The payload size ({0}) exceeds the " \
+                                     "maximum permitted by the APNS ({1}). " \
+                                     "Discarding message".format(
+                                     len(payload), MAX_PAYLOAD_SIZE_BYTES))
+
+        notification = HTTP2Notification(decoded_token, payload,
+            int(time.time()) + apns.MESSAGE_EXPIRY_SECONDS, priority,
+            collapse_id)
+
+        self.pending.append(notification)
+        self.in_flight += 1
+        self.send_pending()
+
+        return notification.deferred
+
+    def retry(self, notification):
+        """ Puts a notification which did not receive a response back at the
+            front of the queue, unless it has been retried too many times. """
+
+        if notification.retries >= MAX_NOTIFICATION_RETRIES:
+            log.err("Giving up on APNS notification for device {0} after " \
+                    "{1} attempts".format(
+                    binascii.hexlify(notification.decoded_token),
+                    notification.retries + 1))
+            self._complete(notification, None, "RetriesExhausted")
+            return
+
+        notification.retries += 1
+        self.metrics.increment("apns_http2.retries")
+        self.pending.appendleft(notification)
+
+    def notification_complete(self, notification, status, reason):
+        """ Handles the response to a notification, reporting errors to the
+            error callback using the equivalent binary protocol error code. """
+
+        if status == STATUS_SUCCESS:
+            logger.count("APNS HTTP/2 messages accepted")
+        else:
+            if reason == EXPIRED_PROVIDER_TOKEN and \
+                    self.provider_token is not None:
+                self.provider_token.invalidate()
+                self.retry(notification)
+                return
+
+            logger.count("APNS HTTP/2 error responses")
+            if logger.is_enabled(logger.INFO):
+                logger.info("APNS returned status {0} ({1}) for device {2}",
+                    status, reason,
+                    binascii.hexlify(notification.decoded_token))
+
+            if self.error_callback is not None:
+                error_code = REASON_ERROR_CODES.get(reason,
+                                                    UNKNOWN_ERROR_CODE)
+                self.error_callback((error_code,
+                    base64.encodestring(notification.decoded_token).replace(
+                        "\n", "")))
+
+        self._complete(notification, status, reason)
+
+    def _complete(self, notification, status, reason):
+        """ Fires the notification's Deferred and releases callers waiting
+            for capacity. """
+
+        self.in_flight -= 1
+        self.metrics.increment("apns_http2.responses.{0}".format(status))
+        self.metrics.observe("apns_http2.latency",
+                             time.time() - notification.created)
+        notification.deferred.callback((status, reason))
+
+        while len(self.capacity_waiters) > 0 and \
+                self.in_flight < self.max_pending:
+            self.capacity_waiters.popleft().callback(None)
+
+    def wait_for_capacity(self):
+        """ Returns a Deferred which fires once fewer than max_pending
+            notifications are waiting for a response. """
+
+        if self.in_flight < self.max_pending:
+            return defer.succeed(None)
+
+        waiter = defer.Deferred()
+        self.capacity_waiters.append(waiter)
+
+        return waiter
+
+    def send_bulk_iter(self, device_tokens, payload, decoded=False):
+        """ Sends the payload to every token produced by the iterator,
+            consuming it only as quickly as responses are received. Returns
+            a Deferred which fires with the number of messages sent. """
+
+        result = defer.Deferred()
+        device_tokens = iter(device_tokens)
+        counts = {"sent" : 0, "invalid" : 0}
+
+        def send_next(_=None):
+            while self.in_flight < self.max_pending:
+                try:
+                    device_token = next(device_tokens)
+                except StopIteration:
+                    log.msg("Finished bulk APNS send. Sent: {0}, invalid " \
+                            "tokens: {1}".format(counts["sent"],
+                                                 counts["invalid"]))
+                    result.callback(counts["sent"])
+                    return
+
+                try:
+                    if decoded is True:
+                        self.send_decoded_message(device_token, payload)
+                    else:
+                        self.send_message(device_token, payload)
+                    counts["sent"] += 1
+                except apns.APNSException:
+                    counts["invalid"] += 1
+
+            self.wait_for_capacity().addCallback(send_next)
+
+        send_next()
+
+        return result
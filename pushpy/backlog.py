@@ -0,0 +1,236 @@
+"""backlog.py: Module which contains the backlog used to hold messages
+that cannot be sent straight away, for example whilst reconnecting. """
+
+import collections
+
+OVERFLOW_DROP_OLDEST = "drop_oldest"
+OVERFLOW_DROP_NEWEST = "drop_newest"
+OVERFLOW_REJECT = "reject"
+OVERFLOW_POLICIES = (OVERFLOW_DROP_OLDEST, OVERFLOW_DROP_NEWEST,
+                     OVERFLOW_REJECT)
+DEFAULT_MAX_BYTES = 16 * 1024 * 1024
+
+# Lanes of a PriorityBacklog, and the default weights with which they are
+# drained: while all are waiting, 8 high priority messages are sent for
+# every 4 normal and 1 bulk message
+LANE_HIGH = "high"
+LANE_NORMAL = "normal"
+LANE_BULK = "bulk"
+DEFAULT_LANES = ((LANE_HIGH, 8), (LANE_NORMAL, 4), (LANE_BULK, 1))
+
+# Approximate memory used by each entry in addition to the message itself,
+# covering the tuple and deque slot which hold it
+ITEM_OVERHEAD_BYTES = 64
+
+class BacklogFullException(Exception):
+    """ Class representing an Exception which is raised when a message
+        cannot be added to a backlog using the reject overflow policy. """
+
+    def __init__(self, error_message):
+        self.error_text = error_message
+        super(BacklogFullException, self).__init__(self.error_text)
+
+class MessageBacklog(object):
+    """ First in, first out store of messages. The main limit is the byte
+        budget, max_bytes, which always applies; max_items optionally also
+        limits the number of messages, and can be skipped for individual
+        messages (see put). The backlog does no locking, so must only be
+        used from the reactor thread. """
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES, max_items=None,
+                 overflow_policy=OVERFLOW_DROP_OLDEST):
+        if overflow_policy not in OVERFLOW_POLICIES:
+            raise ValueError("Unknown backlog overflow policy: {0}".format(
+                overflow_policy))
+
+        self.max_bytes = max_bytes
+        self.max_items = max_items
+        self.overflow_policy = overflow_policy
+        self.items = collections.deque()
+        self.size_bytes = 0
+        self.dropped = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def _is_full(self, size, limit_items=True):
+        """ Returns True if adding a message of the specified size would
+            take the backlog over its byte budget, or over its item limit
+            if limit_items is True. """
+
+        if self.size_bytes + size > self.max_bytes:
+            return True
+
+        if limit_items is True and self.max_items is not None and \
+                len(self.items) >= self.max_items:
+            return True
+
+        return False
+
+    def put(self, message, size, limit_items=True):
+        """ Adds the message, which occupies the specified number of bytes,
+            to the back of the backlog. Returns True if it was stored and
+            False if it was dropped; raises BacklogFullException instead of
+            dropping when the reject policy is in use. If limit_items is
+            False only the byte budget is applied. """
+
+        size += ITEM_OVERHEAD_BYTES
+
+        if size > self.max_bytes:
+            if self.overflow_policy == OVERFLOW_REJECT:
+                raise BacklogFullException("Message of {0} bytes is larger " \
+                    "than the backlog ({1} bytes)".format(size,
+                                                          self.max_bytes))
+            self.dropped += 1
+            return False
+
+        while self._is_full(size, limit_items):
+            if self.overflow_policy == OVERFLOW_DROP_OLDEST:
+                self.get()
+                self.dropped += 1
+            elif self.overflow_policy == OVERFLOW_DROP_NEWEST:
+                self.dropped += 1
+                return False
+            else:
+                raise BacklogFullException("The backlog is full ({0} " \
+                    "messages, {1} bytes)".format(len(self.items),
+                                                  self.size_bytes))
+
+        self.items.append((message, size))
+        self.size_bytes += size
+
+        return True
+
+    def get(self):
+        """ Removes and returns the message at the front of the backlog.
+            Raises IndexError if the backlog is empty. """
+
+        message, size = self.items.popleft()
+        self.size_bytes -= size
+
+        return message
+
+    def clear(self):
+        """ Removes all messages from the backlog. """
+
+        self.items.clear()
+        self.size_bytes = 0
+
+class PriorityBacklog(object):
+    """ Backlog made up of several lanes, each a MessageBacklog with its own
+        limits, so that a flood of messages in one lane cannot push out the
+        messages waiting in another. Messages are taken from the lanes which
+        have any waiting using smooth weighted round robin, so each lane
+        gets a share of the sends in proportion to its weight and no lane
+        is starved. lanes is a sequence of (name, weight) pairs; every lane
+        has the limits and overflow policy given, unless lane_limits maps
+        its name to (max_bytes, max_items). The limits apply to each lane
+        rather than being split between them, so the backlog as a whole
+        can hold up to the number of lanes times max_bytes and max_items. """
+
+    def __init__(self, lanes=DEFAULT_LANES, max_bytes=DEFAULT_MAX_BYTES,
+                 max_items=None, overflow_policy=OVERFLOW_DROP_OLDEST,
+                 lane_limits=None, default_lane=LANE_NORMAL):
+        if lane_limits is None:
+            lane_limits = {}
+
+        self.lanes = collections.OrderedDict()
+        self.weights = {}
+        self.current_weights = {}
+        for name, weight in lanes:
+            lane_max_bytes, lane_max_items = lane_limits.get(name,
+                (max_bytes, max_items))
+            self.lanes[name] = MessageBacklog(lane_max_bytes, lane_max_items,
+                                              overflow_policy)
+            self.weights[name] = weight
+            self.current_weights[name] = 0
+
+        if default_lane not in self.lanes:
+            default_lane = next(iter(self.lanes))
+        self.default_lane = default_lane
+        self.length = 0
+
+    def __len__(self):
+        return self.length
+
+    @property
+    def size_bytes(self):
+        """ The number of bytes held by all of the lanes. """
+
+        return sum(lane.size_bytes for lane in self.lanes.itervalues())
+
+    @property
+    def dropped(self):
+        """ The number of messages dropped from all of the lanes. """
+
+        return sum(lane.dropped for lane in self.lanes.itervalues())
+
+    def lane(self, name):
+        """ Returns the named lane, or the default lane if there is no lane
+            with that name. """
+
+        return self.lanes.get(name, self.lanes[self.default_lane])
+
+    def put(self, message, size, lane=None, limit_items=True):
+        """ Adds the message to the back of the named lane (by default the
+            default lane), applying that lane's limits and overflow policy,
+            or only its byte budget if limit_items is False. Returns True if
+            it was stored and False if it was dropped. """
+
+        backlog = self.lane(lane)
+        length = len(backlog)
+        stored = backlog.put(message, size, limit_items)
+        self.length += len(backlog) - length
+
+        return stored
+
+    def get(self):
+        """ Removes and returns the next message, choosing between the lanes
+            with messages waiting by their weights. Raises IndexError if
+            every lane is empty. """
+
+        selected = None
+        total_weight = 0
+        for name, backlog in self.lanes.iteritems():
+            if len(backlog) == 0:
+                continue
+
+            weight = self.weights[name]
+            total_weight += weight
+            self.current_weights[name] += weight
+            if selected is None or self.current_weights[name] > \
+                    self.current_weights[selected]:
+                selected = name
+
+        if selected is None:
+            raise IndexError("get from an empty backlog")
+
+        self.current_weights[selected] -= total_weight
+        self.length -= 1
+
+        return self.lanes[selected].get()
+
+    def clear(self):
+        """ Removes all messages from every lane. """
+
+        for name, backlog in self.lanes.iteritems():
+            backlog.clear()
+            self.current_weights[name] = 0
+        self.length = 0
+
+    def depths(self):
+        """ Returns the number of messages waiting in each lane. """
+
+        return dict((name, len(backlog))
+                    for name, backlog in self.lanes.iteritems())
+
+    def waiting_ahead(self, name):
+        """ Returns the number of messages waiting in the named lane and in
+            the lanes weighted at least as heavily, which a new message for
+            that lane should not overtake. """
+
+        weight = self.weights.get(name, self.weights[self.default_lane])
+
+        return sum(len(backlog) for lane_name, backlog
+                   in self.lanes.iteritems()
+                   if self.weights[lane_name] >= weight)
@@ -2,20 +2,39 @@
 messages to be sent to the Blackberry Push Service. """
 
 from datetime import datetime, timedelta
+import time
 import base64
 import uuid
-from StringIO import StringIO
+import itertools
+import common
+import logger
+import metrics
+from zope.interface import implementer
 from twisted.internet.protocol import Protocol
 from twisted.python import log
-from twisted.internet import reactor
+from twisted.internet import defer, reactor, task
 from twisted.web.client import Agent
 from twisted.internet.ssl import ClientContextFactory
-from twisted.web.client import FileBodyProducer
 from twisted.web.http_headers import Headers
+from twisted.web.iweb import IBodyProducer
 
 MAX_DELAY = 2
 BOUNDARY = "boundary-marker"
 SUCCESS_CODE = "1001"
+
+# Large address lists are split into several pushes of at most this many
+# addresses, with no more than MAX_CONCURRENT_REQUESTS sent at once
+MAX_ADDRESSES_PER_PUSH = 1000
+MAX_CONCURRENT_REQUESTS = 10
+
+# Number of addresses written to the request body at a time
+ADDRESS_CHUNK_SIZE = 500
+
+ADDRESS_PREFIX = "<address address-value=\""
+ADDRESS_SUFFIX = "\"/>"
+ADDRESS_SEPARATOR = ADDRESS_SUFFIX + ADDRESS_PREFIX
+ADDRESS_LENGTH = len(ADDRESS_PREFIX) + len(ADDRESS_SUFFIX)
+
 MESSAGE_TEMPLATE = """
  --{boundary}--
 Content-Type: application/xml
@@ -32,13 +51,18 @@ Content-Type: application/xml
 </pap>
 --{boundary}--
 Content-Encoding: binary
-Content-Type: text/html
+Content-Type: text/html; charset=utf-8
 
 {content}
 
  --{boundary}--
  """
 
+# The message template either side of the address list, which is written
+# separately so that it never needs to be formatted into the template
+MESSAGE_HEADER_TEMPLATE, MESSAGE_FOOTER_TEMPLATE = \
+    MESSAGE_TEMPLATE.split("{device_segment}")
+
 class WebClientContextFactory(ClientContextFactory):
     """ Context Factory used to connect to the push service
         over SSL. """
@@ -49,11 +73,95 @@ class WebClientContextFactory(ClientContextFactory):
 
         return ClientContextFactory.getContext(self)
 
+def encode_text(text):
+    """ Returns the text as a byte string, encoding unicode as UTF-8, so
+        that lengths are measured in the bytes written. """
+
+    if isinstance(text, unicode):
+        return text.encode("utf-8")
+
+    return str(text)
+
+@implementer(IBodyProducer)
+class PAPBodyProducer(object):
+    """ Produces the body of a PAP push, writing the address list in chunks
+        of ADDRESS_CHUNK_SIZE addresses rather than building the whole body
+        in memory. Unicode text is encoded as UTF-8 and the length is
+        calculated up front from the encoded bytes, so the body is not sent
+        chunked. A body with a single chunk of addresses is written as soon
+        as the request asks for it, as with StringBodyProducer; larger
+        bodies are written from a cooperative task, which hands control
+        back to the reactor between chunks whenever the cooperator's time
+        slice runs out (so several chunks may be written in one
+        iteration), and pauses while the connection's buffer is full. """
+
+    def __init__(self, header, device_list, footer,
+                 chunk_size=ADDRESS_CHUNK_SIZE):
+        self.header = encode_text(header)
+        self.addresses = [encode_text(device) for device in device_list]
+        self.footer = encode_text(footer)
+        self.chunk_size = chunk_size
+        self.task = None
+
+        self.length = len(self.header) + len(self.footer) + \
+            sum(itertools.imap(len, self.addresses)) + \
+            ADDRESS_LENGTH * len(self.addresses)
+
+    def chunks(self):
+        """ Generator which returns the body in pieces: the header, each
+            chunk of addresses and the footer. """
+
+        yield self.header
+
+        addresses = self.addresses
+        for start in xrange(0, len(addresses), self.chunk_size):
+            yield ADDRESS_PREFIX + ADDRESS_SEPARATOR.join(
+                addresses[start:start + self.chunk_size]) + ADDRESS_SUFFIX
+
+        yield self.footer
+
+    def startProducing(self, consumer):
+        """ Writes the body to the consumer, returning a Deferred which fires
+            once it has all been written. """
+
+        if len(self.addresses) <= self.chunk_size:
+            consumer.write("".join(self.chunks()))
+            return defer.succeed(None)
+
+        self.task = task.cooperate(consumer.write(chunk)
+                                   for chunk in self.chunks())
+        deferred = self.task.whenDone()
+        deferred.addCallback(lambda _: None)
+
+        return deferred
+
+    def pauseProducing(self):
+        """ Pauses writing until resumeProducing is called. """
+
+        if self.task is not None:
+            self.task.pause()
+
+    def resumeProducing(self):
+        """ Resumes writing after pauseProducing. """
+
+        if self.task is not None:
+            self.task.resume()
+
+    def stopProducing(self):
+        """ Stops writing, as the request has been abandoned. """
+
+        if self.task is not None:
+            try:
+                self.task.stop()
+            except task.TaskFinished:
+                pass
+
 class BlackberryResponse(Protocol):
     """ Protocol used to read the response from the request that is sent
         to the Blackberry Push Service. """
 
-    def __init__(self):
+    def __init__(self, metrics_registry):
+        self.metrics = metrics_registry
         self.data = ""
 
     def dataReceived(self, bytes):
@@ -66,28 +174,68 @@ class BlackberryResponse(Protocol):
             indicating. """
 
         if SUCCESS_CODE not in self.data:
+            self.metrics.increment("blackberry.pushes_rejected")
             log.err("Blackberry Push Message was not accepted for " \
                     "processing: {0}".format(reason.getErrorMessage()))
         else:
-            log.msg("Blackberry Push Message was accepted")
+            logger.count("Blackberry pushes accepted")
+            self.metrics.increment("blackberry.pushes_accepted")
+            logger.debug("Blackberry Push Message was accepted")
 
 class BlackberryService(object):
     """ Sets up and controls the instances of the Blackberry client
         factory. """
 
-    def __init__(self, hostname, application_id, application_password):
+    def __init__(self, hostname, application_id, application_password,
+                 metrics_registry=None, connection_pool=None,
+                 warm_up_connections=0,
+                 max_addresses_per_push=MAX_ADDRESSES_PER_PUSH,
+                 max_concurrent_requests=MAX_CONCURRENT_REQUESTS):
         contextFactory = WebClientContextFactory()
 
         self.blackberry_hostname = hostname
         self.application_id = application_id
         self.application_password = application_password
+        self.max_addresses_per_push = max_addresses_per_push
+        self.max_concurrent_requests = max_concurrent_requests
+        self.in_flight = 0
+
+        if metrics_registry is None:
+            metrics_registry = metrics.REGISTRY
+        self.metrics = metrics_registry
+        self.metrics.register_gauge("blackberry.in_flight",
+                                    lambda: self.in_flight, owner=self)
+
+        # Connections are kept open between requests, and by default are
+        # shared with the other HTTP based providers
+        if connection_pool is None:
+            connection_pool = common.shared_connection_pool()
+        self.connection_pool = connection_pool
+        self.agent = Agent(reactor, contextFactory, pool=connection_pool)
+
+        if warm_up_connections > 0:
+            reactor.callWhenRunning(self.warm_up, warm_up_connections)
+
+    def unregister_metrics(self):
+        """ Removes the gauges registered by this service from the metrics
+            registry, for use when it is being replaced by a new one. """
+
+        self.metrics.unregister(self)
+
+    def warm_up(self, connection_count=common.HTTP_POOL_MAX_PER_HOST):
+        """ Opens connections to the push service before they are needed.
+            Returns a Deferred which fires with the number of connections
+            opened. """
 
-        self.agent = Agent(reactor, contextFactory)
+        return common.warm_up_connections(self.agent,
+                                          self.blackberry_hostname,
+                                          connection_count)
 
     def errorReceived(self, error_detail):
         """ Callback which is invoked when an error is detected when
             attempting to send a request to the push service. """
 
+        self.metrics.increment("blackberry.request_errors")
         log.err("Error thrown when executing request: {0}".format(error_detail))
 
     def responseReceived(self, response):
@@ -95,49 +243,88 @@ class BlackberryService(object):
             push service. Invokes the response protocol to read the contents
             of the body contained in the response. """
 
+        self.metrics.increment("blackberry.responses.{0}".format(
+            response.code))
         if response.code == 200:
-            response.deliverBody(BlackberryResponse())
+            response.deliverBody(BlackberryResponse(self.metrics))
         else:
             log.err("Did not receive 200 response: {0}".
                     format(str(response.code)))
+            common.discard_body(response)
+
+    def _request_finished(self, result, start_time):
+        """ Records the time taken to receive the response to a request,
+            passing the result on unchanged. """
+
+        self.in_flight -= 1
+        self.metrics.observe("blackberry.request_latency",
+                             time.time() - start_time)
+
+        return result
 
     def construct_message(self, device_list, message_text):
         """ Creates a new message with the recipients as specified in
             the device list, with the payload provided. """
 
-        device_segment = ""
+        return "".join(self.create_body(device_list, message_text).chunks())
+
+    def create_body(self, device_list, message_text):
+        """ Returns a PAPBodyProducer which writes a new message with the
+            recipients as specified in the device list, with the payload
+            provided. """
+
         message_id = str(uuid.uuid4())
         timestamp = (datetime.utcnow() +
                      timedelta(hours=MAX_DELAY)). \
                      strftime("%Y-%m-%dT%H:%M:%SZ")
 
-        for device in device_list:
-            device_segment += "<address address-value=\"{0}\"/>".format(device)
-
-        payload = MESSAGE_TEMPLATE.format(timestamp=timestamp,
-                              content=message_text,
+        header = MESSAGE_HEADER_TEMPLATE.format(timestamp=timestamp,
                               unique_push_id = message_id,
                               boundary=BOUNDARY,
-                              device_segment = device_segment,
                               application_id=self.application_id)
+        footer = MESSAGE_FOOTER_TEMPLATE.format(
+            content=encode_text(message_text), boundary=BOUNDARY)
 
-        return payload
+        return PAPBodyProducer(header, device_list, footer)
 
     def send_message(self, device_list, message_text):
-        """ Constructs a message from the device list and payload provided. """
-
-        payload = self.construct_message(device_list, message_text)
-
-        self._submit_request(payload)
-
-    def _submit_request(self, payload):
-        """ Private method which wraps the payload in a HTTP request and
-            submits it as a POST method to the Blackberry push service.
+        """ Constructs a message from the device list and payload provided.
+            Returns the Deferred of the request. A device list longer than
+            max_addresses_per_push is split into several pushes, sent with
+            no more than max_concurrent_requests outstanding at once, and
+            the Deferred returned fires once every push has been answered. """
+
+        if len(device_list) <= self.max_addresses_per_push:
+            return self._submit_request(self.create_body(device_list,
+                                                         message_text))
+
+        log.msg("Splitting Blackberry push to {0} addresses".format(
+            len(device_list)))
+        requests = self._requests(device_list, message_text)
+        workers = [task.cooperate(requests).whenDone()
+                   for _ in range(self.max_concurrent_requests)]
+
+        deferred = defer.gatherResults(workers)
+        deferred.addCallback(lambda _: None)
+
+        return deferred
+
+    def _requests(self, device_list, message_text):
+        """ Generator shared by the workers sending a split push, submitting
+            the request for the next part of the device list and yielding its
+            Deferred, which the worker waits on before asking for another. """
+
+        for start in xrange(0, len(device_list), self.max_addresses_per_push):
+            yield self._submit_request(self.create_body(
+                device_list[start:start + self.max_addresses_per_push],
+                message_text))
+
+    def _submit_request(self, body):
+        """ Private method which wraps the body producer in a HTTP request
+            and submits it as a POST method to the Blackberry push service.
             Request is made using a Deferred object to ensure that it
             is a non blocking event when waiting for the repsonse. """
 
-        body = FileBodyProducer(StringIO(payload))
-
         deferred_request = self.agent.request('POST', self.blackberry_hostname,
             Headers({'User-Agent': ['pushpy'],
                      'Authorization': ['Basic %s' % base64.b64encode("%s:%s" %
@@ -146,10 +333,13 @@ class BlackberryService(object):
                      'Content-type': ['multipart/related; \
                                       boundary={boundary}; \
                                       type=application/xml; \
-                                      charset=us-ascii'.format(
+                                      charset=utf-8'.format(
                                       boundary=BOUNDARY)]}),
                                       bodyProducer=body)
 
+        self.in_flight += 1
+        self.metrics.increment("blackberry.requests")
+        deferred_request.addBoth(self._request_finished, time.time())
         deferred_request.addCallback(self.responseReceived)
         deferred_request.addErrback(self.errorReceived)
 
@@ -0,0 +1,544 @@
+"""cluster.py: Module which contains functionality enabling messages to be
+sent from several worker processes, each with its own reactor and provider
+connections, so that pushpy can make use of more than one core. """
+
+import os
+import sys
+import json
+import time
+import zlib
+import importlib
+import metrics
+from twisted.application import service
+from twisted.internet import defer, protocol, reactor, stdio, task
+from twisted.protocols.basic import LineReceiver
+from twisted.python import log
+
+# Requests and responses are exchanged as one JSON document per line over
+# the worker's stdin and stdout
+MAX_LINE_LENGTH = 64 * 1024 * 1024
+WORKER_COMMAND = "from pushpy import cluster; cluster.run_worker()"
+
+# Seconds between each worker reporting its metrics, and the number of
+# reports a worker may miss before it is considered unhealthy
+STATS_INTERVAL = 5
+MISSED_REPORTS_UNHEALTHY = 3
+
+RESTART_DELAY = 1
+SHUTDOWN_TIMEOUT = 10
+
+# Registered producers are paused while more requests than this are
+# waiting for the workers, and resumed once fewer than half are
+MAX_OUTSTANDING_REQUESTS = 1000
+
+# The method of each provider used to send a message to a list of tokens;
+# the message is passed as keyword arguments, for example
+# {"payload": ...} for apns or {"message_header": ..., "message_text": ...}
+# for gcm
+SEND_METHODS = {"apns" : "send_bulk",
+                "gcm" : "send_bulk",
+                "blackberry" : "send_message"}
+
+class ClusterException(Exception):
+    """ Class representing an Exception which is used to report a request
+        which could not be completed by a worker process. """
+
+    def __init__(self, error_message):
+        self.error_text = error_message
+        super(ClusterException, self).__init__(self.error_text)
+
+def shard(token, shard_count):
+    """ Returns the index of the worker which sends to the token. A token is
+        always sent to by the same worker, so that its messages stay in
+        order and its worker's suppression index learns if it is invalid. """
+
+    if isinstance(token, unicode):
+        token = token.encode("utf-8")
+
+    return (zlib.crc32(token) & 0xffffffff) % shard_count
+
+def encode_strings(value):
+    """ Returns the value decoded from JSON with its unicode strings, at any
+        depth, encoded as UTF-8 str, which is what the providers expect
+        (for example the APNS packer joins the payload with binary data). """
+
+    if isinstance(value, unicode):
+        return value.encode("utf-8")
+
+    if isinstance(value, dict):
+        return dict((encode_strings(key), encode_strings(item))
+                    for key, item in value.iteritems())
+
+    if isinstance(value, list):
+        return [encode_strings(item) for item in value]
+
+    return value
+
+def load_request(line):
+    """ Returns the request decoded from a line of JSON, with its strings
+        encoded as UTF-8. """
+
+    return encode_strings(json.loads(line))
+
+class ProviderRouter(object):
+    """ Sends messages using providers in this process. It has the same
+        send, registerProducer and unregisterProducer methods as the
+        Supervisor, so either can be given to code which routes messages
+        (for example the ingest service). """
+
+    def __init__(self, providers):
+        self.providers = providers
+
+    def send(self, provider, device_tokens, message):
+        """ Sends the message, a dict of the keyword arguments of the
+            provider's send method (see SEND_METHODS), to the tokens.
+            Returns a Deferred which fires with the result of the send. """
+
+        if provider not in self.providers:
+            return defer.fail(ClusterException("No {0} provider has been " \
+                                               "set up".format(provider)))
+
+        send = getattr(self.providers[provider], SEND_METHODS[provider])
+
+        return defer.maybeDeferred(send, device_tokens, **message)
+
+    def registerProducer(self, producer):
+        """ Registers the producer with each provider which pauses producers
+            while it is unable to accept more messages. """
+
+        for provider in self.providers.itervalues():
+            if hasattr(provider, "registerProducer"):
+                provider.registerProducer(producer)
+
+    def unregisterProducer(self, producer):
+        """ Unregisters the producer from each provider. """
+
+        for provider in self.providers.itervalues():
+            if hasattr(provider, "unregisterProducer"):
+                provider.unregisterProducer(producer)
+
+class WorkerProcess(protocol.ProcessProtocol):
+    """ Represents one worker process, which is restarted by the supervisor
+        if it exits. Requests written while the process is restarting are
+        held until it has been started again. """
+
+    def __init__(self, supervisor, worker_index):
+        self.supervisor = supervisor
+        self.worker_index = worker_index
+        self.pid = None
+        self.running = False
+        self.restarts = 0
+        self.buffer = ""
+        self.waiting = []
+        self.requests = {}
+        self.last_report = None
+        self.counters = {}
+        self.gauges = {}
+        self.retired_counters = {}
+        self.exited = None
+
+    def start(self):
+        """ Spawns the worker process, unless the supervisor has stopped. """
+
+        if not self.supervisor.running:
+            return
+
+        self.buffer = ""
+        self.last_report = None
+        self.exited = defer.Deferred()
+        arguments = [sys.executable, "-c", WORKER_COMMAND,
+                     self.supervisor.setup, str(self.worker_index),
+                     str(self.supervisor.worker_count)]
+        reactor.spawnProcess(self, sys.executable, arguments,
+                             env=os.environ, path=self.supervisor.path)
+
+    def connectionMade(self):
+        """ Writes the requests which were made while the process was not
+            running. """
+
+        self.pid = self.transport.pid
+        self.running = True
+        log.msg("Started pushpy worker {0} (pid {1})".format(
+            self.worker_index, self.pid))
+
+        waiting = self.waiting
+        self.waiting = []
+        for line in waiting:
+            self.transport.write(line)
+
+    def write_request(self, request_id, request, deferred):
+        """ Sends a request to the worker; the Deferred fires with the
+            result it reports. """
+
+        self.requests[request_id] = deferred
+        line = json.dumps(request) + "\n"
+
+        if self.running is True:
+            self.transport.write(line)
+        else:
+            self.waiting.append(line)
+
+    def outReceived(self, data):
+        """ Splits the worker's output into lines, each of which is a JSON
+            response or metrics report. """
+
+        self.buffer += data
+        if len(self.buffer) > MAX_LINE_LENGTH:
+            log.err("Discarding oversized output from pushpy worker " \
+                    "{0}".format(self.worker_index))
+            self.buffer = ""
+            return
+
+        lines = self.buffer.split("\n")
+        self.buffer = lines.pop()
+        for line in lines:
+            try:
+                message = json.loads(line)
+            except ValueError:
+                log.err("Unable to parse output from pushpy worker {0}: " \
+                        "{1}".format(self.worker_index, line))
+                continue
+
+            self.message_received(message)
+
+    def message_received(self, message):
+        """ Handles a response or metrics report from the worker. """
+
+        if message.get("type") == "stats":
+            self.last_report = time.time()
+            self.counters = message.get("counters", {})
+            self.gauges = message.get("gauges", {})
+            return
+
+        deferred = self.requests.pop(message.get("id"), None)
+        if deferred is None:
+            return
+
+        if "error" in message:
+            deferred.errback(ClusterException(message["error"]))
+        else:
+            deferred.callback(message.get("result"))
+
+    def errReceived(self, data):
+        """ Passes on the worker's log output. """
+
+        for line in data.splitlines():
+            log.msg("[worker {0}] {1}".format(self.worker_index, line))
+
+    def processEnded(self, reason):
+        """ Fails the requests which were outstanding and restarts the worker
+            unless the supervisor is stopping. The counters last reported are
+            retained so that the totals never go backwards. """
+
+        self.running = False
+        for name, value in self.counters.iteritems():
+            self.retired_counters[name] = \
+                self.retired_counters.get(name, 0) + value
+        self.counters = {}
+        self.gauges = {}
+
+        requests = self.requests
+        self.requests = {}
+        for deferred in requests.itervalues():
+            deferred.errback(ClusterException("pushpy worker {0} exited " \
+                "before completing the request".format(self.worker_index)))
+
+        self.exited.callback(None)
+
+        if self.supervisor.running:
+            log.err("pushpy worker {0} (pid {1}) exited: {2}".format(
+                self.worker_index, self.pid, reason.getErrorMessage()))
+            self.restarts += 1
+            self.supervisor.metrics.increment("cluster.worker_restarts")
+            reactor.callLater(RESTART_DELAY, self.start)
+
+    def stop(self):
+        """ Closes the worker's stdin, which it treats as a request to shut
+            down, and kills it if it has not exited within the timeout.
+            Returns a Deferred which fires once it has exited. """
+
+        if self.running is False:
+            return defer.succeed(None)
+
+        self.transport.closeStdin()
+
+        kill_call = reactor.callLater(SHUTDOWN_TIMEOUT,
+                                      self.transport.signalProcess, "KILL")
+
+        def cancel_kill(result):
+            if kill_call.active():
+                kill_call.cancel()
+            return result
+
+        return self.exited.addBoth(cancel_kill)
+
+    def healthy(self):
+        """ Returns whether the worker is running and reporting metrics. """
+
+        return self.running is True and self.last_report is not None and \
+            time.time() - self.last_report < \
+            STATS_INTERVAL * MISSED_REPORTS_UNHEALTHY
+
+    def health(self):
+        """ Returns a dict describing the state of the worker. """
+
+        if self.last_report is None:
+            report_age = None
+        else:
+            report_age = time.time() - self.last_report
+
+        return {"index" : self.worker_index,
+                "pid" : self.pid,
+                "running" : self.running,
+                "healthy" : self.healthy(),
+                "restarts" : self.restarts,
+                "outstanding_requests" : len(self.requests),
+                "waiting_requests" : len(self.waiting),
+                "last_report_age" : report_age}
+
+class Supervisor(service.Service):
+    """ Service which starts worker_count worker processes and shards the
+        messages it is given between them by token. setup names a function
+        ("module:function", importable from path) which each worker calls
+        with its index and the worker count, and which returns a dict of
+        the providers it should send with, keyed by "apns", "gcm" or
+        "blackberry". The counters and gauges reported by the workers, and
+        the health of each worker, are added to the supervisor's metrics
+        registry. Registered producers are paused while more than
+        max_outstanding requests are waiting for the workers. """
+
+    def __init__(self, setup, worker_count, metrics_registry=None,
+                 path=None, max_outstanding=MAX_OUTSTANDING_REQUESTS):
+        if worker_count < 1:
+            raise ClusterException("At least one worker process is required")
+
+        self.setup = setup
+        self.worker_count = worker_count
+        self.path = path
+        self.next_request_id = 0
+        self.max_outstanding = max_outstanding
+        self.outstanding = 0
+        self.producers = []
+        self.paused = False
+        self.workers = [WorkerProcess(self, worker_index)
+                        for worker_index in range(worker_count)]
+
+        if metrics_registry is None:
+            metrics_registry = metrics.REGISTRY
+        self.metrics = metrics_registry
+        self.metrics.register_gauge("cluster.workers",
+                                    lambda: self.worker_count, owner=self)
+        self.metrics.register_gauge("cluster.workers_healthy",
+            lambda: sum(1 for worker in self.workers if worker.healthy()),
+            owner=self)
+        self.metrics.register_gauge("cluster.outstanding_requests",
+                                    lambda: self.outstanding, owner=self)
+        self.metrics.register_source(self.worker_metrics, owner=self)
+
+    def unregister_metrics(self):
+        """ Removes the gauges registered by this supervisor from the metrics
+            registry, for use when it is being replaced by a new one. """
+
+        self.metrics.unregister(self)
+
+    def startService(self):
+        """ Starts the worker processes. """
+
+        service.Service.startService(self)
+        for worker in self.workers:
+            worker.start()
+
+    def stopService(self):
+        """ Stops the worker processes, returning a Deferred which fires
+            once they have all exited. """
+
+        service.Service.stopService(self)
+
+        return defer.gatherResults([worker.stop() for worker in self.workers])
+
+    def send(self, provider, device_tokens, message):
+        """ Sends the message, a dict of the keyword arguments of the
+            provider's send method (see SEND_METHODS), to the tokens, with
+            each worker sending to its share of them. Returns a Deferred
+            which fires with the list of results reported by the workers
+            which were sent tokens. """
+
+        shards = [[] for _ in range(self.worker_count)]
+        for device_token in device_tokens:
+            shards[shard(device_token, self.worker_count)].append(
+                device_token)
+
+        deferreds = []
+        for worker, tokens in zip(self.workers, shards):
+            if len(tokens) == 0:
+                continue
+
+            self.next_request_id += 1
+            deferred = defer.Deferred()
+            deferred.addBoth(self._request_finished)
+            worker.write_request(self.next_request_id,
+                                 {"id" : self.next_request_id,
+                                  "provider" : provider,
+                                  "tokens" : tokens,
+                                  "message" : message}, deferred)
+            deferreds.append(deferred)
+
+        self.outstanding += len(deferreds)
+        self.metrics.increment("cluster.requests")
+        if self.paused is False and self.outstanding > self.max_outstanding:
+            self.paused = True
+            for producer in self.producers:
+                producer.pauseProducing()
+
+        deferred = defer.gatherResults(deferreds, consumeErrors=True)
+        deferred.addErrback(lambda failure: failure.value.subFailure)
+
+        return deferred
+
+    def _request_finished(self, result):
+        """ Resumes the registered producers once enough of the outstanding
+            requests have finished, passing the result on unchanged. """
+
+        self.outstanding -= 1
+        if self.paused is True and \
+                self.outstanding <= self.max_outstanding / 2:
+            self.paused = False
+            for producer in self.producers:
+                producer.resumeProducing()
+
+        return result
+
+    def registerProducer(self, producer):
+        """ Registers a push producer (for example the transport of a
+            connection messages are being read from) which is paused while
+            too many requests are waiting for the workers. """
+
+        self.producers.append(producer)
+        if self.paused is True:
+            producer.pauseProducing()
+
+    def unregisterProducer(self, producer):
+        """ Stops the producer from being paused and resumed. """
+
+        if producer in self.producers:
+            self.producers.remove(producer)
+
+    def worker_metrics(self):
+        """ Returns the totals of the counters and gauges last reported by
+            the workers, and the health of each worker. """
+
+        counters = {}
+        gauges = {}
+        for worker in self.workers:
+            for totals, values in ((counters, worker.retired_counters),
+                                   (counters, worker.counters),
+                                   (gauges, worker.gauges)):
+                for name, value in values.iteritems():
+                    totals[name] = totals.get(name, 0) + value
+
+        return {"counters" : counters,
+                "gauges" : gauges,
+                "workers" : [worker.health() for worker in self.workers]}
+
+class WorkerProtocol(LineReceiver):
+    """ Protocol run by each worker over its stdin and stdout, which sends
+        the messages it is given using its providers and reports the result,
+        and periodically reports the worker's metrics. """
+
+    delimiter = "\n"
+    MAX_LENGTH = MAX_LINE_LENGTH
+
+    def __init__(self, providers, metrics_registry):
+        self.router = ProviderRouter(providers)
+        self.metrics = metrics_registry
+        self.stats_loop = task.LoopingCall(self.report_stats)
+
+    def connectionMade(self):
+        """ Starts reporting metrics. """
+
+        self.stats_loop.start(STATS_INTERVAL)
+
+    def lineReceived(self, line):
+        """ Sends the message in a request using the provider it names. """
+
+        request = None
+        try:
+            request = load_request(line)
+            deferred = self.router.send(request["provider"],
+                                        request["tokens"],
+                                        request["message"])
+        except Exception as e:
+            log.err("Unable to process request: {0}".format(e))
+            deferred = defer.fail(e)
+            request_id = None
+            if isinstance(request, dict):
+                request_id = request.get("id")
+        else:
+            request_id = request["id"]
+
+        deferred.addCallbacks(self.request_succeeded, self.request_failed,
+                              callbackArgs=(request_id,),
+                              errbackArgs=(request_id,))
+
+    def request_succeeded(self, result, request_id):
+        """ Reports the result of a request. """
+
+        self.write_message({"id" : request_id, "result" : result})
+
+    def request_failed(self, failure, request_id):
+        """ Reports a request which could not be completed. """
+
+        self.write_message({"id" : request_id,
+                            "error" : failure.getErrorMessage()})
+
+    def report_stats(self):
+        """ Reports the worker's counters and gauges. """
+
+        snapshot = self.metrics.snapshot()
+        self.write_message({"type" : "stats",
+                            "pid" : os.getpid(),
+                            "counters" : snapshot["counters"],
+                            "gauges" : snapshot["gauges"]})
+
+    def write_message(self, message):
+        """ Writes a message to the supervisor. """
+
+        try:
+            line = json.dumps(message)
+        except (TypeError, ValueError):
+            message["result"] = None
+            line = json.dumps(message)
+
+        self.transport.write(line + self.delimiter)
+
+    def connectionLost(self, reason):
+        """ The supervisor has closed stdin, asking the worker to stop. """
+
+        if self.stats_loop.running:
+            self.stats_loop.stop()
+
+        if reactor.running:
+            reactor.stop()
+
+def load_setup(setup):
+    """ Returns the function named by a "module:function" string. """
+
+    module_name, function_name = setup.split(":", 1)
+
+    return getattr(importlib.import_module(module_name), function_name)
+
+def run_worker(arguments=None):
+    """ Entry point of a worker process, started by the supervisor with the
+        setup function, the worker's index and the worker count. """
+
+    if arguments is None:
+        arguments = sys.argv[1:]
+
+    # Anything printed is logged, as stdout carries the responses
+    setup, worker_index, worker_count = arguments
+    log.startLogging(sys.stderr)
+
+    providers = load_setup(setup)(int(worker_index), int(worker_count))
+    stdio.StandardIO(WorkerProtocol(providers, metrics.REGISTRY))
+
+    reactor.run()
@@ -0,0 +1,205 @@
+"""coalesce.py: Module which contains the coalescing stage, which holds
+messages for a device for a short window so that several updates sent in
+quick succession are delivered as one. """
+
+import time
+import collections
+import metrics
+from twisted.internet import defer, reactor
+from twisted.python.failure import Failure
+
+# Messages are held for this many seconds after the first message for the
+# same device and collapse key was submitted
+COALESCE_WINDOW = 1.0
+
+# At most this many messages are held at once; when full, the message which
+# has been held longest is sent early to make room
+MAX_HELD_MESSAGES = 100000
+
+# Messages whose windows end within this many seconds of each other are
+# sent together, so that providers can batch them into fewer requests
+FLUSH_RESOLUTION = 0.05
+
+def latest(held_payload, new_payload):
+    """ The default merge function, which keeps the latest payload. """
+
+    return new_payload
+
+class CoalescedMessage(object):
+    """ A message being held, along with the Deferreds of every message
+        merged into it. """
+
+    __slots__ = ('payload', 'context', 'deadline', 'waiters')
+
+    def __init__(self, payload, context, deadline):
+        self.payload = payload
+        self.context = context
+        self.deadline = deadline
+        self.waiters = []
+
+class Coalescer(object):
+    """ Holds messages keyed by (token, collapse key) for window seconds.
+        A message submitted while another with the same key is held is
+        merged into it, using merge(held_payload, new_payload) (by default
+        keeping only the latest payload), and the merged message is sent
+        when the window of the first one ends, so that a stream of updates
+        is never held for longer than the window. The held messages are
+        bounded by max_held; when full, the oldest is sent early.
+
+        Messages are sent by calling send_function with a list of
+        (token, payload, context) tuples, in the order they were first
+        submitted. It may return a list holding the result (or a Deferred
+        of the result) of each message, which the Deferreds returned by
+        submit fire with, or None. The coalescer does no locking, so must
+        only be used from the reactor thread. """
+
+    def __init__(self, send_function, window=COALESCE_WINDOW, merge=None,
+                 max_held=MAX_HELD_MESSAGES, metrics_registry=None,
+                 metrics_prefix="coalesce"):
+        if window <= 0:
+            raise ValueError("The coalescing window must be greater than " \
+                             "zero")
+
+        if merge is None:
+            merge = latest
+
+        self.send_function = send_function
+        self.window = window
+        self.merge = merge
+        self.max_held = max_held
+        self.held = collections.OrderedDict()
+        self.flush_trigger = None
+
+        if metrics_registry is None:
+            metrics_registry = metrics.REGISTRY
+        self.metrics = metrics_registry
+        self.metrics_prefix = metrics_prefix
+        self.metrics.register_gauge(metrics_prefix + ".held",
+                                    lambda: len(self.held), owner=self)
+
+        # Anything still held is sent rather than lost when shutting down
+        reactor.addSystemEventTrigger("before", "shutdown", self.flush)
+
+    def __len__(self):
+        return len(self.held)
+
+    def unregister_metrics(self):
+        """ Removes the gauges registered by this coalescer from the metrics
+            registry, for use when it is being replaced by a new one. """
+
+        self.metrics.unregister(self)
+
+    def submit(self, token, payload, collapse_key=None, context=None):
+        """ Holds the payload for the token, merging it into the message
+            held for the same token and collapse key if there is one. The
+            context (for example the lane to send in) is passed on to the
+            send function, the latest context replacing any earlier one.
+            Returns a Deferred which fires with the result of sending the
+            message the payload ended up in. """
+
+        key = (token, collapse_key)
+        message = self.held.get(key)
+
+        if message is None:
+            if len(self.held) >= self.max_held:
+                self.metrics.increment(self.metrics_prefix + ".sent_early")
+                self._send([self.held.popitem(last=False)])
+
+            message = CoalescedMessage(payload, context,
+                                       time.time() + self.window)
+            self.held[key] = message
+            if self.flush_trigger is None:
+                self.flush_trigger = reactor.callLater(self.window,
+                                                       self.flush_expired)
+        else:
+            message.payload = self.merge(message.payload, payload)
+            message.context = context
+            self.metrics.increment(self.metrics_prefix + ".merged")
+
+        self.metrics.increment(self.metrics_prefix + ".submitted")
+
+        waiter = defer.Deferred()
+        message.waiters.append(waiter)
+
+        return waiter
+
+    def flush_expired(self):
+        """ Sends the messages whose window has ended, and arranges to be
+            called again when the next window ends. Messages are held in
+            the order they were submitted, which is also the order their
+            windows end. """
+
+        self.flush_trigger = None
+
+        now = time.time()
+        expired = []
+        for key, message in self.held.iteritems():
+            if message.deadline > now + FLUSH_RESOLUTION:
+                break
+            expired.append(key)
+
+        self._send([(key, self.held.pop(key)) for key in expired])
+
+        if len(self.held) > 0:
+            message = next(self.held.itervalues())
+            self.flush_trigger = reactor.callLater(
+                max(message.deadline - now, 0), self.flush_expired)
+
+    def flush(self):
+        """ Sends every held message straight away. """
+
+        if self.flush_trigger is not None:
+            if self.flush_trigger.active():
+                self.flush_trigger.cancel()
+            self.flush_trigger = None
+
+        held = self.held.items()
+        self.held.clear()
+        self._send(held)
+
+    def _send(self, items):
+        """ Passes the (key, message) items to the send function, and fires
+            the Deferreds of the messages with the results. """
+
+        if len(items) == 0:
+            return
+
+        self.metrics.increment(self.metrics_prefix + ".sent", len(items))
+
+        try:
+            results = self.send_function([(key[0], message.payload,
+                                           message.context)
+                                          for key, message in items])
+        except Exception:
+            failure = Failure()
+            for key, message in items:
+                for waiter in message.waiters:
+                    waiter.errback(failure)
+            return
+
+        if results is None:
+            results = [None] * len(items)
+
+        # Messages sent in the same request share its Deferred, so the
+        # waiters are collected for each distinct Deferred
+        deferreds = collections.OrderedDict()
+        for (key, message), result in zip(items, results):
+            if isinstance(result, defer.Deferred):
+                deferreds.setdefault(id(result), (result, []))[1].extend(
+                    message.waiters)
+            else:
+                for waiter in message.waiters:
+                    waiter.callback(result)
+
+        for result, waiters in deferreds.itervalues():
+            result.addBoth(self._fire, waiters)
+
+    def _fire(self, result, waiters):
+        """ Fires the waiters with the result of a send. The result is not
+            passed on, as the waiters are left to handle any failure. """
+
+        for waiter in waiters:
+            if isinstance(result, Failure):
+                waiter.errback(result)
+            else:
+                waiter.callback(result)
@@ -1,9 +1,21 @@
 """common.py: Module which contains common functionality enabling
 push notification messages to be sent to various platforms. """
 
+from zope.interface import implementer
 from twisted.internet.ssl import ClientContextFactory
+from twisted.internet import defer, reactor
+from twisted.python import log
+from twisted.web.client import HTTPConnectionPool, readBody
+from twisted.web.iweb import IBodyProducer
 from OpenSSL import SSL
 
+# Number of idle connections kept open to each host, and the number of
+# seconds after which an idle connection is closed
+HTTP_POOL_MAX_PER_HOST = 10
+HTTP_POOL_IDLE_TIMEOUT = 240
+
+SHARED_CONNECTION_POOL = None
+
 class APNSClientContextFactory(ClientContextFactory):
     """ Represents the context relating to the SSL authentication that
         has to be used when connecting to the APNS. """
@@ -20,3 +32,116 @@ class APNSClientContextFactory(ClientContextFactory):
             classes use instead of directly using the variable. """
 
         return self.context
+
+class HTTP2ClientContextFactory(ClientContextFactory):
+    """ Represents the context used when connecting to the APNS HTTP/2
+        API, which requires TLS 1.2 and negotiates HTTP/2 using ALPN. A
+        certificate is only needed when authenticating with a certificate
+        rather than a provider token. """
+
+    def __init__(self, certificate_file=None, private_key_file=None):
+        self.context = SSL.Context(SSL.SSLv23_METHOD)
+        self.context.set_options(SSL.OP_NO_SSLv2 | SSL.OP_NO_SSLv3 |
+                                 SSL.OP_NO_TLSv1 | SSL.OP_NO_TLSv1_1)
+        self.context.set_alpn_protos(["h2"])
+
+        if certificate_file is not None:
+            self.context.use_certificate_file(certificate_file)
+            self.context.use_privatekey_file(private_key_file)
+
+    def getContext(self):
+        """ Returns the SSL context which should be used when making
+            connections to the APNS HTTP/2 API. """
+
+        return self.context
+
+@implementer(IBodyProducer)
+class StringBodyProducer(object):
+    """ Produces a request body which is already held in memory. The whole
+        body is written as soon as the request asks for it, so it is sent
+        together with the request headers. FileBodyProducer writes from a
+        cooperative task on a later reactor iteration instead, and on a
+        reused connection Nagle's algorithm then holds the body back until
+        the server's delayed acknowledgement of the headers arrives. """
+
+    def __init__(self, body):
+        self.body = body
+        self.length = len(body)
+
+    def startProducing(self, consumer):
+        """ Writes the body to the consumer. """
+
+        consumer.write(self.body)
+
+        return defer.succeed(None)
+
+    def pauseProducing(self):
+        """ Nothing to do, as the body is written all at once. """
+
+    def resumeProducing(self):
+        """ Nothing to do, as the body is written all at once. """
+
+    def stopProducing(self):
+        """ Nothing to do, as the body is written all at once. """
+
+def create_connection_pool(max_per_host=HTTP_POOL_MAX_PER_HOST,
+                           idle_timeout=HTTP_POOL_IDLE_TIMEOUT):
+    """ Returns a pool of persistent HTTP connections, so that requests
+        to the same host reuse an established connection (and its TLS
+        session) rather than connecting for every request. max_per_host
+        limits the number of idle connections kept for each host; more
+        connections are opened while requests are outstanding. """
+
+    pool = HTTPConnectionPool(reactor, persistent=True)
+    pool.maxPersistentPerHost = max_per_host
+    pool.cachedConnectionTimeout = idle_timeout
+    pool.retryAutomatically = True
+
+    return pool
+
+def shared_connection_pool():
+    """ Returns the connection pool shared by the HTTP based providers
+        (GCM and Blackberry) unless they are given their own. """
+
+    global SHARED_CONNECTION_POOL
+
+    if SHARED_CONNECTION_POOL is None:
+        SHARED_CONNECTION_POOL = create_connection_pool()
+
+    return SHARED_CONNECTION_POOL
+
+def warm_up_connections(agent, url, connection_count):
+    """ Opens connection_count connections to the host of the url, using
+        HEAD requests, so that they are waiting in the agent's pool before
+        the first messages are sent. Returns a Deferred which fires with
+        the number of requests which succeeded. """
+
+    def request_succeeded(response):
+        # Reading the (empty) body returns the connection to the pool
+        return readBody(response).addCallback(lambda _: True)
+
+    def request_failed(failure):
+        log.err("Unable to open a connection to {0}: {1}".format(url,
+                failure.getErrorMessage()))
+        return False
+
+    requests = []
+    for _ in range(connection_count):
+        request = agent.request('HEAD', url)
+        request.addCallbacks(request_succeeded, request_failed)
+        requests.append(request)
+
+    deferred = defer.gatherResults(requests)
+    deferred.addCallback(lambda results: results.count(True))
+
+    return deferred
+
+def discard_body(response):
+    """ Reads and discards the body of a response. The body of every
+        response must be consumed before its connection is returned to the
+        pool. """
+
+    deferred = readBody(response)
+    deferred.addErrback(lambda _: None)
+
+    return deferred
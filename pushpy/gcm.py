@@ -2,20 +2,64 @@
 messages to be sent to the Google Cloud Messaging service. """
 
 import json
-import ast
+import time
+import collections
+import random
+import itertools
 from datetime import datetime
-from StringIO import StringIO
+import common
+import logger
+import coalesce
+import metrics
+import suppression
 from twisted.internet.protocol import Protocol
 from twisted.python import log
 from twisted.internet.defer import Deferred
-from twisted.internet import reactor
+from twisted.internet import defer, reactor, task
 from twisted.web.client import Agent
 from twisted.internet.ssl import ClientContextFactory
-from twisted.web.client import FileBodyProducer
 from twisted.web.http_headers import Headers
+from twisted.web.http import stringToDatetime
+
+# Responses are decoded with the fastest JSON decoder available
+try:
+    import ujson as json_decoder
+except ImportError:
+    try:
+        import simplejson as json_decoder
+    except ImportError:
+        json_decoder = json
 
 TOKEN_ERRORS = ['InvalidRegistration', 'NotRegistered']
 
+# Errors which mean the message may be delivered if it is sent again later
+RETRYABLE_ERRORS = ['Unavailable', 'InternalServerError']
+RETRY_ATTEMPTS = 5
+RETRY_INITIAL_DELAY = 1.0
+RETRY_MAX_DELAY = 300.0
+
+# Each device sent to for the first time adds this fraction of a retry to
+# the budget, which starts with, and never holds more than, the maximum
+RETRY_BUDGET_RATIO = 0.2
+RETRY_BUDGET_MAXIMUM = 10000
+
+# GCM accepts at most this many registration ids in a single request
+MAX_REGISTRATION_IDS = 1000
+
+# Default number of requests which may be waiting for a response at once
+MAX_CONCURRENT_REQUESTS = 10
+
+# Maximum number of escaped registration ids kept by the packer
+TOKEN_CACHE_SIZE = 100000
+MESSAGE_TIME_FORMAT = "%H:%M.%S"
+
+# Result of a request for each device, as stored in GCMResults.codes
+RESULT_SUCCESS = 0
+RESULT_UPDATED = 1
+RESULT_REMOVE = 2
+RESULT_ERROR = 3
+RESULT_MISSING = 4
+
 class WebClientContextFactory(ClientContextFactory):
     """ Context Factory used to connect to the push service
         over SSL. """
@@ -32,29 +76,374 @@ class GCMResponse(Protocol):
 
     def __init__(self, callback):
         self.callback = callback
-        self.data = ""
+        self.chunks = []
 
     def dataReceived(self, bytes):
         """ Append the bytes received from the GCM service
-            to the current block of data. """
+            to the list of blocks of data, which are joined once the
+            whole response has been received. """
 
-        self.data += bytes
+        self.chunks.append(bytes)
 
     def connectionLost(self, reason):
         """ Called when the connection to the GCM service
             has been lost, indicating that the response message
             has been received. """
 
-        log.msg(self.data)
-        self.callback.callback(self.data)
+        data = "".join(self.chunks)
+        self.chunks = []
+
+        logger.debug("GCM response: {0}", data)
+        self.callback.callback(data)
+
+class GCMResults(object):
+    """ The result of a GCM request for each device it was sent to. codes
+        holds one RESULT_ value per device, in the same order as the device
+        list. Only the devices which failed or were given a new token have
+        an entry in errors or canonical_ids, keyed by their index. The
+        success, failure and canonical_id_count totals are those reported
+        by the GCM. """
+
+    __slots__ = ('device_list', 'codes', 'errors', 'canonical_ids',
+                 'success', 'failure', 'canonical_id_count')
+
+    def __init__(self, device_list, success=0, failure=0,
+                 canonical_id_count=0):
+        self.device_list = device_list
+        self.codes = bytearray(len(device_list))
+        self.errors = {}
+        self.canonical_ids = {}
+        self.success = success
+        self.failure = failure
+        self.canonical_id_count = canonical_id_count
+
+    def tokens(self, code):
+        """ Returns the tokens of the devices with the result specified. """
+
+        device_list = self.device_list
+        return [device_list[index] for index, device_code in
+                enumerate(self.codes) if device_code == code]
+
+class GCMMessagePacker(object):
+    """ Serializes GCM messages. The JSON fragment for each registration id
+        is cached, so ids which are sent to repeatedly are only escaped
+        once. """
+
+    def __init__(self, token_cache_size=TOKEN_CACHE_SIZE):
+        self.token_cache_size = token_cache_size
+
+        # As with the APNS token cache, an LRU is approximated using two
+        # generations of fragments
+        self.recent_fragments = {}
+        self.previous_fragments = {}
+
+    def token_fragment(self, device_token):
+        """ Returns the device token as a JSON string. """
+
+        fragment = self.recent_fragments.get(device_token)
+        if fragment is not None:
+            return fragment
+
+        fragment = self.previous_fragments.get(device_token)
+        if fragment is None:
+            fragment = json.dumps(device_token)
+
+        if len(self.recent_fragments) * 2 >= self.token_cache_size:
+            self.previous_fragments = self.recent_fragments
+            self.recent_fragments = {}
+        self.recent_fragments[device_token] = fragment
+
+        return fragment
+
+    def token_fragments(self, device_list):
+        """ Returns the list of the device tokens as JSON strings. The
+            recent generation is checked for every token in one pass, and
+            only the tokens missing from it are looked up individually. """
+
+        fragments = map(self.recent_fragments.get, device_list)
+
+        if None in fragments:
+            token_fragment = self.token_fragment
+            for index, fragment in enumerate(fragments):
+                if fragment is None:
+                    fragments[index] = token_fragment(device_list[index])
+
+        return fragments
+
+    def compile(self, message_header, message_text, message_time=None):
+        """ Returns a template for the message, with its data serialized
+            once so that it can be sent to many batches of devices. The
+            time included in the message is the time it was compiled,
+            unless one is provided. """
+
+        if message_time is None:
+            message_time = datetime.utcnow().strftime(MESSAGE_TIME_FORMAT)
+
+        return GCMMessageTemplate(self, json.dumps({message_header :
+                                                    message_text,
+                                                    "time" : message_time}))
+
+class GCMMessageTemplate(object):
+    """ A message with its data already serialized, leaving only the list
+        of registration ids to be filled in for each request. """
+
+    __slots__ = ('packer', 'data', 'prefix', 'suffix')
+
+    def __init__(self, packer, data):
+        self.packer = packer
+        self.data = data
+        self.prefix = '{"data": ' + data + ', "registration_ids": ['
+        self.suffix = ']}'
+
+    def payload(self, device_list):
+        """ Returns the request body sending the message to the devices. """
+
+        return self.prefix + ", ".join(self.packer.token_fragments(
+            device_list)) + self.suffix
+
+def parse_retry_after(value):
+    """ Returns the number of seconds requested by a Retry-After header,
+        which is either a number of seconds or a HTTP date, or None if it
+        cannot be parsed. """
+
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+
+    try:
+        return max(stringToDatetime(value) - time.time(), 0.0)
+    except ValueError:
+        return None
+
+class RetryBudget(object):
+    """ Limits the number of retries to a fraction of the devices sent to
+        for the first time, so that a GCM outage cannot cause a retry storm.
+        The budget starts full and holds at most maximum retries. """
+
+    def __init__(self, ratio=RETRY_BUDGET_RATIO, maximum=RETRY_BUDGET_MAXIMUM):
+        self.ratio = ratio
+        self.maximum = maximum
+        self.balance = float(maximum)
+
+    def deposit(self, device_count):
+        """ Adds to the budget for devices sent to for the first time. """
+
+        self.balance = min(self.balance + device_count * self.ratio,
+                           self.maximum)
+
+    def withdraw(self, device_count):
+        """ Takes as many of the retries requested as the budget allows,
+            returning the number taken. """
+
+        allowed = min(device_count, int(self.balance))
+        self.balance -= allowed
+
+        return allowed
+
+class GCMRetryScheduler(object):
+    """ Collects the devices which could not be sent to, because of a
+        retryable error for the device or a failed request, and sends the
+        message to them again. Devices failing with the same message on the
+        same attempt are merged into a single group, which is sent in full
+        sized batches once its backoff has passed. The backoff grows
+        exponentially with jitter, no retry is made before a time requested
+        by Retry-After, and retries are limited by a RetryBudget. """
+
+    def __init__(self, service, max_attempts=RETRY_ATTEMPTS,
+                 initial_delay=RETRY_INITIAL_DELAY,
+                 max_delay=RETRY_MAX_DELAY, budget=None):
+        if budget is None:
+            budget = RetryBudget()
+
+        self.service = service
+        self.max_attempts = max_attempts
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.budget = budget
+        self.retry_not_before = 0
+        self.pending = {}
+        self.pending_devices = 0
+
+    def backoff(self, attempt):
+        """ Returns the delay before the specified retry attempt: half of the
+            exponential delay, plus a random amount up to the other half. """
+
+        delay = min(self.initial_delay * (2 ** (attempt - 1)), self.max_delay)
+
+        return delay / 2 + random.random() * delay / 2
+
+    def retry_after(self, seconds):
+        """ Prevents any retry being made until the number of seconds
+            requested by the GCM has passed. """
+
+        self.retry_not_before = max(self.retry_not_before,
+                                    time.time() + seconds)
+
+    def schedule(self, template, device_list, attempt):
+        """ Schedules the devices, which failed on the specified attempt, to
+            be sent the message again. Devices which have used all of their
+            attempts, or for which there is no budget, are abandoned. """
+
+        if len(device_list) == 0:
+            return
+
+        if attempt >= self.max_attempts:
+            self.abandon(device_list, "retry attempts exhausted")
+            return
+
+        allowed = self.budget.withdraw(len(device_list))
+        if allowed < len(device_list):
+            self.abandon(device_list[allowed:], "retry budget exhausted")
+            device_list = device_list[:allowed]
+            if allowed == 0:
+                return
+
+        key = (template, attempt + 1)
+        group = self.pending.get(key)
+        if group is None:
+            group = self.pending[key] = []
+            reactor.callLater(self.backoff(attempt + 1), self.flush, key)
+
+        group.extend(device_list)
+        self.pending_devices += len(device_list)
+        self.service.metrics.increment("gcm.retries_scheduled",
+                                       len(device_list))
+
+    def abandon(self, device_list, reason):
+        """ Gives up on sending to the devices, passing them to the service's
+            retry failed callback if it has one. """
+
+        logger.count("GCM retries abandoned", len(device_list))
+        logger.debug("Abandoning {0} GCM devices: {1}", len(device_list),
+                     reason)
+        self.service.metrics.increment("gcm.retries_abandoned",
+                                       len(device_list))
+
+        if self.service.retry_failed_callback is not None:
+            self.service.retry_failed_callback(device_list)
+
+    def flush(self, key):
+        """ Sends the message to a group of devices once its backoff has
+            passed, or waits longer if the GCM asked for a later retry. """
+
+        delay = self.retry_not_before - time.time()
+        if delay > 0:
+            reactor.callLater(delay, self.flush, key)
+            return
+
+        template, attempt = key
+        device_list = self.pending.pop(key)
+        self.pending_devices -= len(device_list)
+
+        logger.debug("Retrying {0} GCM devices (attempt {1})",
+                     len(device_list), attempt)
+        GCMBatchSend(self.service, device_list, template,
+                     concurrency=self.service.max_concurrent_requests,
+                     attempt=attempt).start()
+
+class GCMBatchSend(object):
+    """ Sends a message to every device produced by an iterable, splitting
+        the devices into requests of at most batch_size registration ids.
+        A fixed number of cooperative workers each submit one request at a
+        time, so no more than concurrency requests are outstanding and the
+        devices are only consumed as quickly as the GCM responds. """
+
+    def __init__(self, service, device_tokens, template,
+                 batch_size=MAX_REGISTRATION_IDS,
+                 concurrency=MAX_CONCURRENT_REQUESTS, attempt=0):
+        if batch_size > MAX_REGISTRATION_IDS:
+            raise ValueError("GCM accepts at most {0} registration ids per " \
+                             "request".format(MAX_REGISTRATION_IDS))
+
+        self.service = service
+        self.device_tokens = service.unsuppressed(device_tokens)
+        self.template = template
+        self.attempt = attempt
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.result = {'requests' : 0, 'failed_requests' : 0, 'devices' : 0,
+                       'success' : 0, 'failure' : 0, 'canonical_ids' : 0}
+
+    def start(self):
+        """ Starts sending, returning a Deferred which fires with a dict
+            totalling the requests made and the results of the devices once
+            every batch has been answered. """
+
+        log.msg("Starting bulk GCM send")
+        requests = self._requests()
+        workers = [task.cooperate(requests).whenDone()
+                   for _ in range(self.concurrency)]
+
+        deferred = defer.gatherResults(workers)
+        deferred.addCallback(self._finished)
+
+        return deferred
+
+    def _requests(self):
+        """ Generator shared by the workers, submitting the request for the
+            next batch and yielding its Deferred, which the worker waits on
+            before asking for another. """
+
+        while True:
+            device_list = list(itertools.islice(self.device_tokens,
+                                                self.batch_size))
+            if len(device_list) == 0:
+                return
+
+            payload = self.template.payload(device_list)
+
+            self.result['requests'] += 1
+            self.result['devices'] += len(device_list)
+
+            deferred = self.service._submit_request(device_list, payload,
+                                                    self.template,
+                                                    self.attempt)
+            deferred.addCallback(self._batch_complete)
+            yield deferred
+
+    def _batch_complete(self, batch_result):
+        """ Adds the results of a batch to the totals. A batch which did not
+            receive a valid response is counted as a failed request. """
+
+        if batch_result is None:
+            self.result['failed_requests'] += 1
+            return
+
+        self.result['success'] += batch_result.success
+        self.result['failure'] += batch_result.failure
+        self.result['canonical_ids'] += batch_result.canonical_id_count
+
+    def _finished(self, _):
+        """ Logs and returns the totals once every worker has finished. """
+
+        log.msg("Finished bulk GCM send. Requests: {0}, failed requests: " \
+                "{1}, devices: {2}, successful: {3}, failed: {4}".format(
+                self.result['requests'], self.result['failed_requests'],
+                self.result['devices'], self.result['success'],
+                self.result['failure']))
+
+        return self.result
 
 class GCMService(object):
     """ Sets up and controls the instances of the GCM client
-        factory. """
+        factory. No more than max_concurrent_requests requests are
+        outstanding at once across every send method, retries included;
+        further requests wait for one to finish. If a coalesce_window is
+        given, messages sent with send_message are held for that many
+        seconds for each device, and messages for the same device and
+        collapse key are merged using coalesce_merge, which is passed
+        (message_header, message_text) tuples (see coalesce.Coalescer). """
 
     def __init__(self, hostname, application_id, application_key,
                  error_callback, update_callback,
-                 notification_hostname=None):
+                 notification_hostname=None, metrics_registry=None,
+                 connection_pool=None, warm_up_connections=0,
+                 max_concurrent_requests=MAX_CONCURRENT_REQUESTS,
+                 retry_attempts=RETRY_ATTEMPTS, retry_failed_callback=None,
+                 suppression_index=None, coalesce_window=None,
+                 coalesce_merge=None,
+                 coalesce_max_held=coalesce.MAX_HELD_MESSAGES):
 
         contextFactory = WebClientContextFactory()
         self.android_hostname = hostname
@@ -63,85 +452,277 @@ class GCMService(object):
         self.application_key = application_key
         self.error_callback = error_callback
         self.update_callback = update_callback
+        self.in_flight = 0
+        self.max_concurrent_requests = max_concurrent_requests
+        self.request_slots = defer.DeferredSemaphore(max_concurrent_requests)
+        self.packer = GCMMessagePacker()
+
+        # Devices which fail with a retryable error are sent the message
+        # again, up to retry_attempts times; retry_failed_callback is passed
+        # the devices which are given up on
+        self.retry_failed_callback = retry_failed_callback
+        self.retry_scheduler = GCMRetryScheduler(self, retry_attempts)
+
+        # Registration ids which the GCM reports as no longer registered are
+        # added to the suppression index, and are not sent to again
+        if suppression_index is None:
+            suppression_index = suppression.INDEX
+        self.suppression = suppression_index
+
+        if metrics_registry is None:
+            metrics_registry = metrics.REGISTRY
+        self.metrics = metrics_registry
+        self.metrics.register_gauge("gcm.in_flight", lambda: self.in_flight,
+                                    owner=self)
+        self.metrics.register_gauge("gcm.requests_waiting",
+            lambda: len(self.request_slots.waiting), owner=self)
+        self.metrics.register_gauge("gcm.retries_pending",
+            lambda: self.retry_scheduler.pending_devices, owner=self)
+
+        if coalesce_window is not None:
+            self.coalescer = coalesce.Coalescer(self._send_coalesced,
+                                                coalesce_window,
+                                                coalesce_merge,
+                                                coalesce_max_held,
+                                                metrics_registry,
+                                                "gcm.coalesce")
+        else:
+            self.coalescer = None
+
+        # Connections are kept open between requests, and by default are
+        # shared with the other HTTP based providers
+        if connection_pool is None:
+            connection_pool = common.shared_connection_pool()
+        self.connection_pool = connection_pool
+        self.agent = Agent(reactor, contextFactory, pool=connection_pool)
+
+        if warm_up_connections > 0:
+            reactor.callWhenRunning(self.warm_up, warm_up_connections)
+
+    def unregister_metrics(self):
+        """ Removes the gauges registered by this service from the metrics
+            registry, for use when it is being replaced by a new one. """
 
-        self.agent = Agent(reactor, contextFactory)
+        self.metrics.unregister(self)
+        if self.coalescer is not None:
+            self.coalescer.unregister_metrics()
 
-    def errorReceived(self, error_detail):
-        """ Logs an error message when an error is detected. """
+    def warm_up(self, connection_count=common.HTTP_POOL_MAX_PER_HOST):
+        """ Opens connections to the GCM before they are needed. Returns a
+            Deferred which fires with the number of connections opened. """
 
+        return common.warm_up_connections(self.agent, self.android_hostname,
+                                          connection_count)
+
+    def errorReceived(self, error_detail, device_list=None, template=None,
+                      attempt=0):
+        """ Logs an error message when an error is detected, and schedules
+            the request's devices to be retried if the message is known. """
+
+        self.metrics.increment("gcm.request_errors")
         log.err("Error thrown when executing request: {0}".format(
             error_detail))
 
-    def responseReceived(self, response, device_list):
+        if template is not None:
+            self.retry_scheduler.schedule(template, device_list, attempt)
+
+    def responseReceived(self, response, device_list, template=None,
+                         attempt=0):
         """ Creates a GCMResponse protocol when a response is
-            received from the web service request. """
+            received from the web service request. Returns a Deferred which
+            fires with the result of processing the response body, so that
+            the request's Deferred only fires once the body has been read.
+            If the message is known, devices with retryable errors (or all
+            of the devices, following a server error) are retried. """
+
+        self.metrics.increment("gcm.responses.{0}".format(response.code))
+
+        retry_after = response.headers.getRawHeaders('retry-after')
+        if retry_after is not None:
+            seconds = parse_retry_after(retry_after[0])
+            if seconds is not None:
+                self.retry_scheduler.retry_after(seconds)
 
         if response.code == 200:
             deferred = Deferred()
             response.deliverBody(GCMResponse(deferred))
             deferred.addCallback(self.process_response, device_list)
+            if template is not None:
+                deferred.addCallback(self._retry_failed_devices, template,
+                                     attempt)
+            return deferred
         else:
             log.err("Did not receive 200 response: {0}".
                     format(str(response.code)))
+            common.discard_body(response)
+
+            if template is not None and response.code >= 500:
+                self.retry_scheduler.schedule(template, device_list, attempt)
+
+    def _retry_failed_devices(self, results, template, attempt):
+        """ Schedules the devices which failed with a retryable error to be
+            sent the message again, passing the results on unchanged. """
+
+        if results is not None and len(results.errors) > 0:
+            device_list = results.device_list
+            self.retry_scheduler.schedule(template,
+                [device_list[device_number] for device_number, reason in
+                 sorted(results.errors.iteritems())
+                 if reason in RETRYABLE_ERRORS], attempt)
+
+        return results
 
     def process_response(self, gcm_response, device_list):
-        """ Processes the response from the GCM. """
+        """ Processes the response from the GCM. Returns a GCMResults
+            describing the result for each device, or None if the response
+            could not be parsed. """
 
         try:
-            parsed_response = ast.literal_eval(gcm_response)
-        except ValueError:
-            log.err("Unable to parse response ({0}) from GCM: {0}".format(\
-                                                        gcm_response))
-            return
+            parsed_response = json_decoder.loads(gcm_response)
+            success = parsed_response.get('success', 0)
+            failure = parsed_response.get('failure', 0)
+            canonical_id_count = parsed_response.get('canonical_ids', 0)
+        except (ValueError, AttributeError):
+            self.metrics.increment("gcm.parse_errors")
+            log.err("Unable to parse response from GCM: {0}".format(
+                gcm_response))
+            return None
 
-        if parsed_response['failure'] > 0 or \
-                parsed_response['canonical_ids'] > 0:
-            self.process_fail_response(parsed_response, device_list)
-        else:
-            log.msg("GCM message accepted")
+        if failure > 0 or canonical_id_count > 0:
+            return self.process_fail_response(parsed_response, device_list)
+
+        logger.count("GCM requests accepted")
+        logger.debug("GCM message accepted")
+
+        return GCMResults(device_list, success, failure, canonical_id_count)
 
     def process_fail_response(self, response, device_list):
         """ Proceses the fail response to determine what action should be
-            taken with the messages that were not accepted by the GCM. """
-
-        for device_number, gcm_response in enumerate(response['results']):
-            response_tuple = gcm_response.items()
-            for status, reason in response_tuple:
-                if status == "error":
-                    if reason in TOKEN_ERRORS:
-                        log.msg("Token {0} should be removed from the " \
-                                "database. Reason: {1}".format(\
-                                device_list[device_number], reason))
-                        self.error_callback(device_list[device_number])
-                        break
-                    else:
-                        log.msg("Token {0} returned error response {1} but " \
-                            "should not be removed at this time".format(\
-                                device_list[device_number], reason))
-                elif status == "registration_id":
-                    log.msg("Token {0} should be updated in the " \
-                            "database. New Token: {1}".format(\
-                            device_list[device_number], reason))
-                    self.update_callback(device_list[device_number], reason)
+            taken with the messages that were not accepted by the GCM.
+            Returns a GCMResults, and passes the tokens which should be
+            removed or updated to the error and update callbacks. """
+
+        results = GCMResults(device_list, response.get('success', 0),
+                             response.get('failure', 0),
+                             response.get('canonical_ids', 0))
+        codes = results.codes
+        device_results = response.get('results', [])
+
+        for device_number, gcm_response in enumerate(device_results):
+            if device_number >= len(device_list):
+                break
+
+            reason = gcm_response.get('error')
+            if reason is not None:
+                results.errors[device_number] = reason
+                if reason in TOKEN_ERRORS:
+                    codes[device_number] = RESULT_REMOVE
+                else:
+                    codes[device_number] = RESULT_ERROR
+            elif 'registration_id' in gcm_response:
+                codes[device_number] = RESULT_UPDATED
+                results.canonical_ids[device_number] = \
+                    gcm_response['registration_id']
+
+        # Devices which were not given a result by the GCM
+        for device_number in range(len(device_results), len(device_list)):
+            codes[device_number] = RESULT_MISSING
+
+        self._notify_token_changes(results)
+
+        return results
+
+    def _run_callback(self, callback, *args):
+        """ Calls an error or update callback, logging any exception it
+            raises so that the rest of the response is still processed. """
+
+        try:
+            callback(*args)
+        except Exception:
+            self.metrics.increment("gcm.callback_errors")
+            log.err(None, "Exception raised by a GCM callback")
+
+    def _notify_token_changes(self, results):
+        """ Counts the devices which failed or were given a new token, and
+            passes the tokens to be removed or updated to the callbacks. """
+
+        device_list = results.device_list
+        removed = 0
+        errors = 0
+
+        for device_number, reason in results.errors.iteritems():
+            if results.codes[device_number] == RESULT_REMOVE:
+                removed += 1
+                if self.suppression.add(device_list[device_number]) is True:
+                    self.metrics.increment("gcm.tokens_suppressed")
+                logger.debug("Token {0} should be removed from the " \
+                             "database. Reason: {1}",
+                             device_list[device_number], reason)
+                if self.error_callback is not None:
+                    self._run_callback(self.error_callback,
+                                       device_list[device_number])
+            else:
+                errors += 1
+                logger.debug("Token {0} returned error response {1} but " \
+                             "should not be removed at this time",
+                             device_list[device_number], reason)
+
+        for device_number, new_token in results.canonical_ids.iteritems():
+            logger.debug("Token {0} should be updated in the database. " \
+                         "New Token: {1}", device_list[device_number],
+                         new_token)
+            if self.update_callback is not None:
+                self._run_callback(self.update_callback,
+                                   device_list[device_number], new_token)
+
+        updated = len(results.canonical_ids)
+        missing = results.codes.count(chr(RESULT_MISSING))
+
+        if removed > 0:
+            logger.count("GCM tokens to remove", removed)
+            self.metrics.increment("gcm.tokens_removed", removed)
+        if errors > 0:
+            logger.count("GCM token errors", errors)
+            self.metrics.increment("gcm.token_errors", errors)
+        if updated > 0:
+            logger.count("GCM tokens to update", updated)
+            self.metrics.increment("gcm.tokens_updated", updated)
+        if missing > 0:
+            logger.count("GCM tokens without a result", missing)
+            self.metrics.increment("gcm.tokens_missing", missing)
+
+    def _request_finished(self, result, start_time):
+        """ Records the time taken to receive the response to a request,
+            passing the result on unchanged. """
+
+        self.in_flight -= 1
+        self.metrics.observe("gcm.request_latency", time.time() - start_time)
+
+        return result
 
     def construct_message(self, device_list, message_header, message_text,
                           user_notification=False):
         """ Creates a message in the defined format to send to the
             GCM service. """
 
-        message_time = datetime.utcnow().strftime("%H:%M.%S")
-
         if user_notification is True:
+            message_time = datetime.utcnow().strftime(MESSAGE_TIME_FORMAT)
             payload = json.dumps({"data" : {message_header : message_text,
                                    "time" : message_time },
                                    "to" : device_list[0] })
         else:
-            payload = json.dumps({"data" : {message_header : message_text,
-                                   "time" : message_time },
-                                   "registration_ids" : device_list })
+            payload = self.packer.compile(message_header,
+                                          message_text).payload(device_list)
 
         return payload
 
+    def compile_message(self, message_header, message_text):
+        """ Returns a template for the message which can be passed to
+            send_template or send_bulk_template, so that the message is
+            only serialized once however many devices it is sent to. """
+
+        return self.packer.compile(message_header, message_text)
+
     def process_api_response(self, api_response,
                              message_header, message_text):
         """ Processes the response from the API which should have created a
@@ -161,29 +742,149 @@ class GCMService(object):
         self._submit_request(user_notification_key, payload)
 
     def send_message(self, device_list, message_header,
-                     message_text):
-        """ Constructs a message from the device list and payload provided. """
-
-        payload = self.construct_message(device_list, message_header,
-                                         message_text,
-                                         user_notification=False)
-        self._submit_request(device_list, payload)
-
-    def _submit_request(self, device_list, payload):
+                     message_text, collapse_key=None):
+        """ Constructs a message from the device list and payload provided.
+            Returns the Deferred of the request, which fires with the
+            GCMResults of the request, or None if it failed. Lists longer
+            than GCM accepts in one request are sent using send_bulk, and
+            the Deferred fires with its totals instead. When coalescing,
+            the message is held for each device with others for the same
+            collapse key, and the Deferred fires with a list of the results
+            of the requests the devices were sent in. """
+
+        if self.coalescer is not None:
+            return defer.gatherResults([self.coalescer.submit(device_token,
+                (message_header, message_text), collapse_key)
+                for device_token in device_list], consumeErrors=True)
+
+        return self.send_template(device_list, self.compile_message(
+            message_header, message_text))
+
+    def _send_coalesced(self, messages):
+        """ Sends the messages released by the coalescer, with a single
+            request for the devices whose messages ended up the same.
+            Returns the Deferred of each message's request. """
+
+        keys = [json.dumps(payload, sort_keys=True)
+                for _, payload, _ in messages]
+
+        groups = collections.OrderedDict()
+        for key, (device_token, payload, _) in zip(keys, messages):
+            if key not in groups:
+                groups[key] = (payload, [])
+            groups[key][1].append(device_token)
+
+        requests = {}
+        for key, (payload, device_list) in groups.iteritems():
+            requests[key] = defer.maybeDeferred(self.send_template,
+                device_list, self.compile_message(*payload))
+
+        return [requests[key] for key in keys]
+
+    def send_template(self, device_list, template):
+        """ As send_message, but sends a message compiled by
+            compile_message. """
+
+        if len(device_list) > MAX_REGISTRATION_IDS:
+            return self.send_bulk_template(device_list, template)
+
+        device_list = list(self.unsuppressed(device_list))
+        if len(device_list) == 0:
+            return defer.succeed(None)
+
+        return self._submit_request(device_list,
+                                    template.payload(device_list), template)
+
+    def unsuppressed(self, device_tokens):
+        """ Generator which passes on the registration ids which are not in
+            the suppression index, counting those which are. """
+
+        suppressed = 0
+        for device_token in device_tokens:
+            if device_token in self.suppression:
+                suppressed += 1
+            else:
+                yield device_token
+
+        if suppressed > 0:
+            logger.count("GCM messages suppressed", suppressed)
+            self.metrics.increment("gcm.messages_suppressed", suppressed)
+
+    def send_bulk(self, device_tokens, message_header, message_text,
+                  batch_size=MAX_REGISTRATION_IDS, concurrency=None):
+        """ Sends the message to every device produced by the iterable, in
+            requests of at most batch_size devices, with no more than
+            concurrency requests (by default max_concurrent_requests)
+            outstanding at once, and never more than the service allows.
+            Returns a Deferred which fires with a dict totalling the
+            requests and device results. """
+
+        return self.send_bulk_template(device_tokens, self.compile_message(
+            message_header, message_text), batch_size, concurrency)
+
+    def send_bulk_template(self, device_tokens, template,
+                           batch_size=MAX_REGISTRATION_IDS, concurrency=None):
+        """ As send_bulk, but sends a message compiled by compile_message,
+            which is reused for every request. """
+
+        if concurrency is None:
+            concurrency = self.max_concurrent_requests
+
+        return GCMBatchSend(self, device_tokens, template, batch_size,
+                            concurrency).start()
+
+    def _submit_request(self, device_list, payload, template=None,
+                        attempt=0):
         """ Private method which wraps the payload in a HTTP request and
             submits it as a POST method to the GCM service.
             Request is made using a Deferred object to ensure that it
-            is a non blocking event when waiting for the repsonse. """
+            is a non blocking event when waiting for the repsonse. If the
+            template of the message is provided, devices which fail with a
+            retryable error are retried; attempt is the number of times
+            they have already been retried. The request waits if
+            max_concurrent_requests are already outstanding, and its
+            Deferred fires once the response has been processed. """
+
+        if attempt == 0:
+            self.retry_scheduler.budget.deposit(len(device_list))
 
-        body = FileBodyProducer(StringIO(payload))
+        deferred_request = self.request_slots.run(self._post, device_list,
+                                                  payload, template, attempt)
+        deferred_request.addErrback(self._processing_failed)
+
+        return deferred_request
+
+    def _post(self, device_list, payload, template, attempt):
+        """ Makes the request once a slot is free, returning a Deferred
+            which fires once its response has been processed, when the
+            slot is released. """
+
+        body = common.StringBodyProducer(payload)
 
         deferred_request = self.agent.request('POST', self.android_hostname,
             Headers({'Authorization': ['key=%s' % self.application_key],
                      'Content-type': ['application/json']}),
                      bodyProducer=body)
 
-        deferred_request.addCallback(self.responseReceived, device_list)
-        deferred_request.addErrback(self.errorReceived)
+        self.in_flight += 1
+        self.metrics.increment("gcm.requests")
+        deferred_request.addBoth(self._request_finished, time.time())
+
+        # Only a failure of the request itself is retried; a failure while
+        # processing a response which was received must not send the
+        # message to its devices again
+        deferred_request.addCallbacks(self.responseReceived,
+                                      self.errorReceived,
+                                      callbackArgs=(device_list, template,
+                                                    attempt),
+                                      errbackArgs=(device_list, template,
+                                                   attempt))
 
         return deferred_request
 
+    def _processing_failed(self, failure):
+        """ Logs an exception raised while processing a response. """
+
+        self.metrics.increment("gcm.processing_errors")
+        log.err(failure, "Unable to process the response from GCM")
+
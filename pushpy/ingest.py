@@ -0,0 +1,244 @@
+"""ingest.py: Module which contains a TCP service accepting push requests
+as newline delimited JSON, so that applications can send messages through
+a shared pushpy process rather than each embedding their own. """
+
+import json
+import cluster
+import metrics
+from zope.interface import implementer
+from twisted.application import service
+from twisted.internet import reactor
+from twisted.internet.interfaces import IPushProducer
+from twisted.internet.protocol import Factory
+from twisted.protocols.basic import LineReceiver
+from twisted.python import log
+
+INGEST_INTERFACE = "127.0.0.1"
+MAX_REQUEST_LENGTH = 16 * 1024 * 1024
+
+# Reading from a connection is paused while it has more than this many
+# requests waiting for a result, and resumed once it has fewer than half
+MAX_OUTSTANDING_REQUESTS = 1000
+
+@implementer(IPushProducer)
+class IngestProtocol(LineReceiver):
+    """ Reads one push request per line, in the form
+        {"id": ..., "provider": "apns", "tokens": [...], "message": {...}},
+        where message holds the keyword arguments of the provider's send
+        method (see cluster.SEND_METHODS). Clients may write any number of
+        requests without waiting; an acknowledgement with the request's id
+        is written as each one completes, as {"id": ..., "status": "ok",
+        "result": ...} or {"id": ..., "status": "error", "error": ...}.
+        Reading is paused while the connection has too many requests
+        outstanding, or while the router (through the providers it sends
+        with) is unable to accept more messages. """
+
+    delimiter = "\n"
+    MAX_LENGTH = MAX_REQUEST_LENGTH
+
+    def __init__(self):
+        self.outstanding = 0
+        self.paused_by_router = False
+        self.paused_by_requests = False
+        self.connected_to_client = False
+
+    def connectionMade(self):
+        """ Registers the connection to be paused by the router. """
+
+        self.connected_to_client = True
+        self.factory.connection_made(self)
+        self.factory.router.registerProducer(self)
+
+    def connectionLost(self, reason):
+        """ Stops the connection from being paused; acknowledgements for the
+            requests which are still outstanding are discarded. """
+
+        self.connected_to_client = False
+        self.factory.router.unregisterProducer(self)
+        self.factory.connection_lost(self)
+
+    def lineReceived(self, line):
+        """ Routes a request to the provider it names. """
+
+        if len(line.strip()) == 0:
+            return
+
+        self.factory.metrics.increment("ingest.requests")
+
+        try:
+            request = cluster.load_request(line)
+            request_id = request.get("id")
+            deferred = self.factory.router.send(request["provider"],
+                                                request["tokens"],
+                                                request.get("message", {}))
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            self.factory.metrics.increment("ingest.invalid_requests")
+            self.write_ack({"id" : None, "status" : "error",
+                            "error" : "Invalid request: {0}".format(e)})
+            return
+
+        self.outstanding += 1
+        if self.outstanding > self.factory.max_outstanding:
+            self.paused_by_requests = True
+            self._update_paused()
+
+        deferred.addCallbacks(self.request_succeeded, self.request_failed,
+                              callbackArgs=(request_id,),
+                              errbackArgs=(request_id,))
+
+    def lineLengthExceeded(self, line):
+        """ Rejects a request which is too long, and closes the connection
+            as the rest of the stream cannot be split into requests. """
+
+        self.factory.metrics.increment("ingest.invalid_requests")
+        self.write_ack({"id" : None, "status" : "error",
+                        "error" : "Request exceeds {0} bytes".format(
+                            self.MAX_LENGTH)})
+        self.transport.loseConnection()
+
+    def request_succeeded(self, result, request_id):
+        """ Acknowledges a request which was sent. """
+
+        self.request_finished()
+        self.write_ack({"id" : request_id, "status" : "ok",
+                        "result" : result})
+
+    def request_failed(self, failure, request_id):
+        """ Acknowledges a request which could not be sent. """
+
+        self.request_finished()
+        self.factory.metrics.increment("ingest.failed_requests")
+        self.write_ack({"id" : request_id, "status" : "error",
+                        "error" : getattr(failure.value, "error_text",
+                                          failure.getErrorMessage())})
+
+    def request_finished(self):
+        """ Resumes reading once enough outstanding requests have
+            finished. """
+
+        self.outstanding -= 1
+        if self.paused_by_requests is True and \
+                self.outstanding <= self.factory.max_outstanding / 2:
+            self.paused_by_requests = False
+            self._update_paused()
+
+    def write_ack(self, ack):
+        """ Writes an acknowledgement, if the client is still connected. """
+
+        if self.connected_to_client is False:
+            return
+
+        try:
+            line = json.dumps(ack)
+        except (TypeError, ValueError):
+            ack["result"] = None
+            line = json.dumps(ack)
+
+        self.transport.write(line + self.delimiter)
+        self.factory.metrics.increment("ingest.acks")
+
+    def _update_paused(self):
+        """ Pauses reading while either the router or the number of
+            outstanding requests requires it. """
+
+        if self.connected_to_client is False:
+            return
+
+        if self.paused_by_router is True or self.paused_by_requests is True:
+            self.transport.pauseProducing()
+        else:
+            self.transport.resumeProducing()
+
+    def pauseProducing(self):
+        """ Called by the router when it cannot accept more messages. """
+
+        self.paused_by_router = True
+        self._update_paused()
+
+    def resumeProducing(self):
+        """ Called by the router once it can accept messages again. """
+
+        self.paused_by_router = False
+        self._update_paused()
+
+    def stopProducing(self):
+        """ Closes the connection. """
+
+        self.transport.loseConnection()
+
+class IngestFactory(Factory):
+    """ Creates an IngestProtocol for each client connection. router is a
+        cluster.ProviderRouter, to send with providers in this process, or a
+        cluster.Supervisor, to send from worker processes. """
+
+    protocol = IngestProtocol
+
+    def __init__(self, router, metrics_registry=None,
+                 max_outstanding=MAX_OUTSTANDING_REQUESTS):
+        self.router = router
+        self.max_outstanding = max_outstanding
+        self.connections = set()
+
+        if metrics_registry is None:
+            metrics_registry = metrics.REGISTRY
+        self.metrics = metrics_registry
+        self.metrics.register_gauge("ingest.connections",
+                                    lambda: len(self.connections), owner=self)
+        self.metrics.register_gauge("ingest.outstanding_requests",
+            lambda: sum(connection.outstanding
+                        for connection in self.connections), owner=self)
+        self.metrics.register_gauge("ingest.paused_connections",
+            lambda: sum(1 for connection in self.connections
+                        if connection.paused_by_router is True or
+                        connection.paused_by_requests is True), owner=self)
+
+    def unregister_metrics(self):
+        """ Removes the gauges registered by this factory from the metrics
+            registry, for use when it is being replaced by a new one. """
+
+        self.metrics.unregister(self)
+
+    def connection_made(self, connection):
+        """ Records a new client connection. """
+
+        log.msg("Ingest client connected")
+        self.connections.add(connection)
+        self.metrics.increment("ingest.connections_accepted")
+
+    def connection_lost(self, connection):
+        """ Records a client connection which has closed. """
+
+        log.msg("Ingest client disconnected")
+        self.connections.discard(connection)
+
+class IngestService(service.Service):
+    """ Service which accepts push requests on the port, by default only on
+        the local interface, for use in a .tac file. """
+
+    def __init__(self, port, router, interface=INGEST_INTERFACE,
+                 metrics_registry=None,
+                 max_outstanding=MAX_OUTSTANDING_REQUESTS):
+        self.port = port
+        self.interface = interface
+        self.factory = IngestFactory(router, metrics_registry,
+                                     max_outstanding)
+        self.listening_port = None
+
+    def startService(self):
+        """ Starts listening for connections. """
+
+        service.Service.startService(self)
+        self.listening_port = reactor.listenTCP(self.port, self.factory,
+                                                interface=self.interface)
+        log.msg("Accepting push requests on {0}:{1}".format(self.interface,
+                self.listening_port.getHost().port))
+
+    def stopService(self):
+        """ Stops listening for connections, returning a Deferred which fires
+            once the port has closed. """
+
+        service.Service.stopService(self)
+        listening_port = self.listening_port
+        self.listening_port = None
+
+        return listening_port.stopListening()
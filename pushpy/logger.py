@@ -0,0 +1,141 @@
+"""logger.py: Module which contains the logging layer used on the per
+message paths of pushpy. Messages are only formatted if their level is
+enabled, frequent events can be sampled, and counted events are written out
+as periodic summaries rather than one line per message. """
+
+from twisted.python import log
+from twisted.internet import task
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+SUMMARY_INTERVAL = 10
+
+class PushLogger(object):
+    """ Wraps twisted's log with levels, lazy formatting, sampling and
+        aggregate summaries. """
+
+    def __init__(self, level=INFO, summary_interval=SUMMARY_INTERVAL):
+        self.level = level
+        self.summary_interval = summary_interval
+        self.sample_counts = {}
+        self.event_counts = {}
+        self.summary_loop = None
+
+    def set_level(self, level):
+        """ Sets the minimum level of the messages which are logged. """
+
+        self.level = level
+
+    def is_enabled(self, level):
+        """ Returns True if messages at the level provided are logged. Used
+            to avoid preparing arguments which are expensive to compute. """
+
+        return level >= self.level
+
+    def _write(self, level, message, args):
+        """ Formats and logs the message if its level is enabled. """
+
+        if level < self.level:
+            return
+
+        if args:
+            message = message.format(*args)
+
+        if level >= ERROR:
+            log.err(message)
+        else:
+            log.msg(message)
+
+    def debug(self, message, *args):
+        """ Logs a debug message, formatted with the arguments provided. """
+
+        self._write(DEBUG, message, args)
+
+    def info(self, message, *args):
+        """ Logs an informational message. """
+
+        self._write(INFO, message, args)
+
+    def warning(self, message, *args):
+        """ Logs a warning message. """
+
+        self._write(WARNING, message, args)
+
+    def error(self, message, *args):
+        """ Logs an error message. """
+
+        self._write(ERROR, message, args)
+
+    def sampled(self, event, rate, level, message, *args):
+        """ Logs only one in every rate occurrences of the event, noting how
+            many occurrences the logged message represents. """
+
+        if level < self.level:
+            return
+
+        occurrences = self.sample_counts.get(event, 0) + 1
+        if occurrences < rate:
+            self.sample_counts[event] = occurrences
+            return
+
+        self.sample_counts[event] = 0
+        if args:
+            message = message.format(*args)
+        self._write(level, "{0} (1 of {1} occurrences)".format(message,
+                                                               occurrences),
+                    None)
+
+    def count(self, event, amount=1):
+        """ Adds to the count of the event, which is logged as part of the
+            next summary. """
+
+        try:
+            self.event_counts[event] += amount
+        except KeyError:
+            self.event_counts[event] = amount
+            if self.summary_loop is None:
+                self.start_summaries()
+
+    def start_summaries(self):
+        """ Starts logging a summary of the counted events at the end of
+            every summary interval. """
+
+        if self.summary_loop is None:
+            self.summary_loop = task.LoopingCall(self.log_summary)
+            self.summary_loop.start(self.summary_interval, now=False)
+
+    def stop_summaries(self):
+        """ Logs the final summary and stops logging summaries. """
+
+        if self.summary_loop is not None:
+            if self.summary_loop.running:
+                self.summary_loop.stop()
+            self.summary_loop = None
+        self.log_summary()
+
+    def log_summary(self):
+        """ Logs the number of times each event occurred since the last
+            summary, then resets the counts. """
+
+        event_counts = self.event_counts
+        self.event_counts = {}
+
+        for event in sorted(event_counts):
+            if event_counts[event] > 0:
+                self._write(INFO, "{0}: {1:,} in the last {2}s", (event,
+                            event_counts[event], self.summary_interval))
+
+# The logger shared by all of the pushpy modules. Applications can change
+# its level using set_level.
+LOGGER = PushLogger()
+
+set_level = LOGGER.set_level
+is_enabled = LOGGER.is_enabled
+debug = LOGGER.debug
+info = LOGGER.info
+warning = LOGGER.warning
+error = LOGGER.error
+sampled = LOGGER.sampled
+count = LOGGER.count
@@ -0,0 +1,283 @@
+"""metrics.py: Module which contains the metrics registry updated by the
+pushpy providers, and an optional HTTP endpoint which exposes a snapshot
+of the metrics as text or JSON. """
+
+import json
+import time
+import bisect
+from twisted.internet import reactor
+from twisted.web import resource, server
+
+# Upper bounds, in seconds, of the buckets used for latency histograms
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0, 30.0)
+METRICS_INTERFACE = "127.0.0.1"
+
+class Histogram(object):
+    """ Counts observed values in fixed buckets, allowing percentiles to be
+        estimated without storing every value. """
+
+    __slots__ = ('buckets', 'counts', 'count', 'total')
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, value):
+        """ Records a single value. """
+
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.total += value
+
+    def percentile(self, fraction):
+        """ Returns the upper bound of the bucket containing the specified
+            percentile (e.g. 0.99), or None if nothing has been observed.
+            Values larger than every bucket are reported as infinite. """
+
+        if self.count == 0:
+            return None
+
+        target = fraction * self.count
+        cumulative = 0
+        for index, bucket_count in enumerate(self.counts):
+            cumulative += bucket_count
+            if cumulative >= target:
+                if index < len(self.buckets):
+                    return self.buckets[index]
+                break
+
+        return float("inf")
+
+    def snapshot(self):
+        """ Returns a dict describing the histogram. """
+
+        if self.count > 0:
+            mean = self.total / self.count
+        else:
+            mean = None
+
+        return {"count" : self.count,
+                "mean" : mean,
+                "p50" : self.percentile(0.5),
+                "p90" : self.percentile(0.9),
+                "p99" : self.percentile(0.99),
+                "buckets" : dict(zip([str(bucket) for bucket in self.buckets] +
+                                     ["+Inf"], self.counts))}
+
+def _add_values(totals, values):
+    """ Adds each of the named values to the totals. """
+
+    for name, value in values.iteritems():
+        totals[name] = totals.get(name, 0) + value
+
+class RateTracker(object):
+    """ Computes the rate per second of each counter between the snapshots
+        seen by one consumer (for example the HTTP endpoint), so that
+        consumers reading the same registry do not affect each other's
+        rates. """
+
+    def __init__(self, start_time=None):
+        if start_time is None:
+            start_time = time.time()
+
+        self.last_time = start_time
+        self.last_counters = {}
+
+    def rates(self, snapshot):
+        """ Returns the rate of each counter in the snapshot since the
+            previous snapshot passed to this tracker. """
+
+        elapsed = snapshot["time"] - self.last_time
+        counters = snapshot["counters"]
+
+        rates = {}
+        if elapsed > 0:
+            for name, value in counters.iteritems():
+                rates[name] = (value - self.last_counters.get(name, 0)) / \
+                    elapsed
+
+        self.last_time = snapshot["time"]
+        self.last_counters = counters
+
+        return rates
+
+class MetricsRegistry(object):
+    """ Holds the counters, gauges and histograms reported by the providers.
+        Counters only ever increase; rates are computed from successive
+        snapshots by a RateTracker. Gauges are functions which are called
+        when a snapshot is taken, and several functions may be registered
+        with the same name, in which case their values are added together
+        (for example the backlog depth of each connection in a pool).
+        Sources are functions which return counters and gauges recorded
+        elsewhere (for example by worker processes), which are added to the
+        registry's own in every snapshot. Gauges and sources registered
+        with an owner can be removed together with unregister, for example
+        when the provider which registered them is replaced. """
+
+    def __init__(self):
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.sources = []
+        self.owners = {}
+        self.created = time.time()
+
+    def increment(self, name, amount=1):
+        """ Adds to the named counter. """
+
+        try:
+            self.counters[name] += amount
+        except KeyError:
+            self.counters[name] = amount
+
+    def register_gauge(self, name, function, owner=None):
+        """ Registers a function which returns the current value of the
+            named gauge. """
+
+        self.gauges.setdefault(name, []).append(function)
+        if owner is not None:
+            self.owners.setdefault(id(owner), []).append((name, function))
+
+    def unregister_gauge(self, name, function):
+        """ Removes a function previously registered for the named gauge. """
+
+        functions = self.gauges.get(name, [])
+        if function in functions:
+            functions.remove(function)
+        if len(functions) == 0:
+            self.gauges.pop(name, None)
+
+    def register_source(self, function, owner=None):
+        """ Registers a function which returns a dict of "counters" and
+            "gauges" to be added to every snapshot. Any other sections it
+            returns are copied into the snapshot unchanged. """
+
+        self.sources.append(function)
+        if owner is not None:
+            self.owners.setdefault(id(owner), []).append((None, function))
+
+    def unregister_source(self, function):
+        """ Removes a previously registered source. """
+
+        if function in self.sources:
+            self.sources.remove(function)
+
+    def unregister(self, owner):
+        """ Removes every gauge and source registered with the owner. """
+
+        for name, function in self.owners.pop(id(owner), []):
+            if name is None:
+                self.unregister_source(function)
+            else:
+                self.unregister_gauge(name, function)
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS):
+        """ Records a value in the named histogram. """
+
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram(buckets)
+
+        histogram.observe(value)
+
+    def snapshot(self):
+        """ Returns the current value of every metric. Taking a snapshot
+            has no side effects, so any number of consumers may take them;
+            each consumer which reports rates uses its own RateTracker. """
+
+        now = time.time()
+        counters = dict(self.counters)
+
+        sections = {}
+        source_gauges = {}
+        for source in self.sources:
+            for section, values in source().iteritems():
+                if section == "counters":
+                    _add_values(counters, values)
+                elif section == "gauges":
+                    _add_values(source_gauges, values)
+                else:
+                    sections[section] = values
+
+        gauges = {}
+        for name, functions in self.gauges.iteritems():
+            gauges[name] = sum(function() for function in functions)
+        _add_values(gauges, source_gauges)
+
+        histograms = {}
+        for name, histogram in self.histograms.iteritems():
+            histograms[name] = histogram.snapshot()
+
+        sections.update({"time" : now,
+                         "counters" : counters,
+                         "gauges" : gauges,
+                         "histograms" : histograms})
+
+        return sections
+
+    def render_text(self, snapshot=None):
+        """ Returns a snapshot formatted as one "name value" line per
+            metric, including the rate of each counter if the snapshot has
+            had rates added to it. """
+
+        if snapshot is None:
+            snapshot = self.snapshot()
+
+        rates = snapshot.get("rates", {})
+        lines = []
+        for name in sorted(snapshot["counters"]):
+            lines.append("{0} {1}".format(name, snapshot["counters"][name]))
+            if name in rates:
+                lines.append("{0}.per_second {1:.2f}".format(name,
+                                                             rates[name]))
+
+        for name in sorted(snapshot["gauges"]):
+            lines.append("{0} {1}".format(name, snapshot["gauges"][name]))
+
+        for name in sorted(snapshot["histograms"]):
+            histogram = snapshot["histograms"][name]
+            for key in ("count", "mean", "p50", "p90", "p99"):
+                lines.append("{0}.{1} {2}".format(name, key, histogram[key]))
+
+        return "\n".join(lines) + "\n"
+
+class MetricsResource(resource.Resource):
+    """ Web resource which returns a snapshot of the registry, as text by
+        default or as JSON if requested with ?format=json. The rates are
+        those since the endpoint was last read. """
+
+    isLeaf = True
+
+    def __init__(self, registry):
+        resource.Resource.__init__(self)
+        self.registry = registry
+        self.rate_tracker = RateTracker(registry.created)
+
+    def render_GET(self, request):
+        """ Renders the snapshot. """
+
+        snapshot = self.registry.snapshot()
+        snapshot["rates"] = self.rate_tracker.rates(snapshot)
+
+        if request.args.get("format") == ["json"]:
+            request.setHeader("Content-Type", "application/json")
+            return json.dumps(snapshot)
+
+        request.setHeader("Content-Type", "text/plain")
+        return self.registry.render_text(snapshot)
+
+def listen(port, registry=None, interface=METRICS_INTERFACE):
+    """ Starts serving the registry over HTTP on the port specified, by
+        default only on the local interface. Returns the listening port. """
+
+    if registry is None:
+        registry = REGISTRY
+
+    return reactor.listenTCP(port, server.Site(MetricsResource(registry)),
+                             interface=interface)
+
+# The registry used by the providers unless they are given another one
+REGISTRY = MetricsRegistry()
@@ -0,0 +1,117 @@
+"""pacing.py: Module which contains the token buckets used to limit the
+rate at which messages are written to the push services. """
+
+import time
+
+class TokenBucket(object):
+    """ Allows rate messages per second on average, with bursts of up to
+        burst messages (by default one second's worth). A bucket may have a
+        parent, for example a limit shared by every connection of a service,
+        in which case a message is only allowed if both buckets have a token
+        and takes a token from each. A bucket without a rate never limits
+        messages itself. The bucket starts full. """
+
+    def __init__(self, rate=None, burst=None, parent=None):
+        self.parent = parent
+        self.rate = None
+        self.burst = None
+        self.tokens = 0.0
+        self.last_update = time.time()
+        self.set_rate(rate, burst)
+
+    def set_rate(self, rate, burst=None):
+        """ Changes the rate and burst, which can be done while messages are
+            being sent. A rate of None removes the limit. The tokens already
+            earned are kept (up to the new burst), so that changing the rate
+            does not allow an extra burst of messages; a bucket which had no
+            limit starts full. """
+
+        if rate is not None and rate <= 0:
+            raise ValueError("The rate must be greater than zero")
+
+        if burst is None and rate is not None:
+            burst = max(rate, 1)
+
+        if rate is not None and burst < 1:
+            raise ValueError("The burst must be at least one message")
+
+        if self.rate is None:
+            tokens = burst
+        else:
+            self._refill()
+            tokens = self.tokens
+            if burst is not None:
+                tokens = min(tokens, burst)
+
+        self.rate = rate
+        self.burst = burst
+        self.tokens = tokens if tokens is not None else 0.0
+        self.last_update = time.time()
+
+    def _refill(self):
+        """ Adds the tokens earned since the bucket was last updated. """
+
+        now = time.time()
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.last_update) * self.rate)
+        self.last_update = now
+
+    def available(self):
+        """ Returns the number of messages which may be sent now, which is
+            infinite if neither this bucket nor its parents limit them. """
+
+        if self.rate is None:
+            tokens = float("inf")
+        else:
+            self._refill()
+            tokens = max(int(self.tokens), 0)
+
+        if self.parent is not None:
+            tokens = min(tokens, self.parent.available())
+
+        return tokens
+
+    def ready(self):
+        """ Returns True if a message may be sent now. """
+
+        return self.available() >= 1
+
+    def take(self, count=1):
+        """ Takes tokens for messages which are being sent. Messages sent
+            without checking first (for example resends) may take the bucket
+            below zero, delaying the messages which follow. """
+
+        if self.rate is not None:
+            self._refill()
+            self.tokens -= count
+
+        if self.parent is not None:
+            self.parent.take(count)
+
+    def delay(self, count=1):
+        """ Returns the number of seconds until count messages may be
+            sent. """
+
+        delay = 0.0
+        if self.rate is not None:
+            self._refill()
+            if self.tokens < count:
+                delay = (count - self.tokens) / self.rate
+
+        if self.parent is not None:
+            delay = max(delay, self.parent.delay(count))
+
+        return delay
+
+    def state(self):
+        """ Returns a dict describing the bucket, for reporting. """
+
+        if self.rate is None:
+            tokens = None
+        else:
+            self._refill()
+            tokens = self.tokens
+
+        return {"rate" : self.rate,
+                "burst" : self.burst,
+                "tokens" : tokens}
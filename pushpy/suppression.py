@@ -0,0 +1,197 @@
+"""suppression.py: Module which contains the index of device tokens which
+are known to be invalid, which the providers add to as the push services
+report dead tokens and check before sending. """
+
+import os
+import array
+import bisect
+import struct
+import hashlib
+import itertools
+from twisted.python import log
+from twisted.internet import reactor, task
+
+# Tokens are stored as hashes of the size of an unsigned long, which is
+# 64 bits on the platforms pushpy is deployed to
+HASH_TYPECODE = "L"
+HASH_BYTES = array.array(HASH_TYPECODE).itemsize
+HASH_STRUCT = struct.Struct("<" + {4 : "I", 8 : "Q"}[HASH_BYTES])
+
+# New hashes are held in a set until there are this many, when they are
+# merged into the sorted array
+MERGE_THRESHOLD = 10000
+
+# Snapshots start with a magic string and the size of the hashes
+SNAPSHOT_MAGIC = "PSI1"
+SNAPSHOT_HEADER = struct.Struct("!4sB")
+SNAPSHOT_INTERVAL = 300
+
+def token_hash(token):
+    """ Returns the hash of a token, which for APNS is the decoded 32 byte
+        token and for GCM the registration id. """
+
+    if isinstance(token, unicode):
+        token = token.encode("utf-8")
+
+    return HASH_STRUCT.unpack_from(hashlib.md5(token).digest())[0]
+
+class SuppressionIndex(object):
+    """ A set of invalid tokens, held as hashes in a sorted array so that
+        each token takes HASH_BYTES bytes however long it is. Recently added
+        hashes are held in a set and merged into the array in batches. A
+        snapshot of the index can be saved to a file, which is loaded when
+        the index is created and saved every snapshot_interval seconds and
+        when the reactor shuts down. """
+
+    def __init__(self, snapshot_file=None, snapshot_interval=SNAPSHOT_INTERVAL,
+                 merge_threshold=MERGE_THRESHOLD):
+        self.hashes = array.array(HASH_TYPECODE)
+        self.recent = set()
+        self.merge_threshold = merge_threshold
+        self.snapshot_file = snapshot_file
+        self.changed = False
+        self.snapshot_loop = None
+
+        if snapshot_file is not None:
+            if os.path.exists(snapshot_file):
+                self.load(snapshot_file)
+
+            if snapshot_interval > 0:
+                self.snapshot_loop = task.LoopingCall(self.save)
+                reactor.callWhenRunning(self.snapshot_loop.start,
+                                        snapshot_interval, now=False)
+            reactor.addSystemEventTrigger("before", "shutdown", self.save)
+
+    def __len__(self):
+        return len(self.hashes) + len(self.recent)
+
+    def __contains__(self, token):
+        return self._contains_hash(token_hash(token))
+
+    def _contains_hash(self, value):
+        """ Returns whether the hash is in the index. """
+
+        if value in self.recent:
+            return True
+
+        hashes = self.hashes
+        index = bisect.bisect_left(hashes, value)
+
+        return index < len(hashes) and hashes[index] == value
+
+    def add(self, token):
+        """ Adds a token to the index, returning True if it was not already
+            in it. """
+
+        value = token_hash(token)
+        if self._contains_hash(value) is True:
+            return False
+
+        self.recent.add(value)
+        self.changed = True
+
+        if len(self.recent) >= self.merge_threshold:
+            self._merge()
+
+        return True
+
+    def discard(self, token):
+        """ Removes a token from the index, for example when a device which
+            was unregistered registers again with the same token. """
+
+        value = token_hash(token)
+        if value in self.recent:
+            self.recent.remove(value)
+            self.changed = True
+            return
+
+        hashes = self.hashes
+        index = bisect.bisect_left(hashes, value)
+        if index < len(hashes) and hashes[index] == value:
+            del hashes[index]
+            self.changed = True
+
+    def unsuppressed(self, tokens):
+        """ Returns an iterator over the tokens which are not in the index. """
+
+        return itertools.ifilterfalse(self.__contains__, tokens)
+
+    def _merge(self):
+        """ Merges the recently added hashes into the sorted array. The runs
+            of the array between the new hashes are copied as slices, so the
+            cost in Python is proportional to the number of new hashes. """
+
+        hashes = self.hashes
+        merged = array.array(HASH_TYPECODE)
+        start = 0
+
+        for value in sorted(self.recent):
+            end = bisect.bisect_left(hashes, value, start)
+            merged.extend(hashes[start:end])
+            merged.append(value)
+            start = end
+
+        merged.extend(hashes[start:])
+
+        self.hashes = merged
+        self.recent = set()
+
+    def save(self, path=None):
+        """ Writes a snapshot of the index to the file, by default the
+            snapshot file, if it has changed since it was last saved. The
+            snapshot is written to a temporary file which then replaces
+            the previous one, so an interrupted save leaves it intact. """
+
+        if path is None:
+            path = self.snapshot_file
+            if path is None or self.changed is False:
+                return
+
+        self._merge()
+
+        temporary_path = path + ".tmp"
+        try:
+            with open(temporary_path, "wb") as snapshot:
+                snapshot.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC,
+                                                    HASH_BYTES))
+                self.hashes.tofile(snapshot)
+            os.rename(temporary_path, path)
+        except (IOError, OSError) as e:
+            log.err("Unable to save the suppression index to {0}: {1}".
+                    format(path, e))
+            return
+
+        self.changed = False
+        log.msg("Saved {0} suppressed tokens to {1}".format(len(self.hashes),
+                                                            path))
+
+    def load(self, path=None):
+        """ Adds the tokens in a snapshot written by save to the index. """
+
+        if path is None:
+            path = self.snapshot_file
+
+        try:
+            with open(path, "rb") as snapshot:
+                magic, hash_bytes = SNAPSHOT_HEADER.unpack(
+                    snapshot.read(SNAPSHOT_HEADER.size))
+                if magic != SNAPSHOT_MAGIC or hash_bytes != HASH_BYTES:
+                    log.err("Ignoring suppression index snapshot {0}, which " \
+                            "was written in a different format".format(path))
+                    return
+
+                hashes = array.array(HASH_TYPECODE)
+                hashes.fromstring(snapshot.read())
+        except (IOError, OSError, struct.error, ValueError) as e:
+            log.err("Unable to load the suppression index from {0}: {1}".
+                    format(path, e))
+            return
+
+        self.recent.update(value for value in hashes
+                           if self._contains_hash(value) is False)
+        self._merge()
+        log.msg("Loaded {0} suppressed tokens from {1}".format(len(hashes),
+                                                               path))
+
+# The index used by the providers unless they are given another one
+INDEX = SuppressionIndex()
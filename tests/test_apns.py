@@ -0,0 +1,527 @@
+# -*- coding: utf-8 -*-
+""" Tests for packing APNS messages. """
+
+import struct
+from twisted.internet import address, error, task
+from twisted.python import failure
+from twisted.test.proto_helpers import StringTransport
+from twisted.trial import unittest
+from pushpy import apns, backlog, logger, metrics, suppression
+
+TOKEN = "\x01" * apns.DEVICE_TOKEN_LENGTH
+UNICODE_PAYLOAD = u'{"aps":{"alert":"Caf\xe9 ☕"}}'
+
+class APNSMessagePackerTests(unittest.TestCase):
+
+    def assert_packs_encoded_payload(self, use_frame_format):
+        packer = apns.APNSMessagePacker(use_frame_format)
+        encoded = UNICODE_PAYLOAD.encode("utf-8")
+
+        message = packer.pack(1000, 0, TOKEN, UNICODE_PAYLOAD)
+
+        self.assertIsInstance(message, str)
+        self.assertEqual(message, packer.pack(1000, 0, TOKEN, encoded))
+        self.assertEqual(packer.compile(UNICODE_PAYLOAD).pack(1000, 0, TOKEN),
+                         message)
+
+    def test_pack_unicode_payload(self):
+        self.assert_packs_encoded_payload(False)
+
+    def test_pack_unicode_payload_frame_format(self):
+        self.assert_packs_encoded_payload(True)
+
+    def test_length_prefix_counts_bytes(self):
+        encoded = UNICODE_PAYLOAD.encode("utf-8")
+        message = apns.APNSMessagePacker().pack(1000, 0, TOKEN,
+                                                UNICODE_PAYLOAD)
+
+        # command, identifier, expiry, token length and token come first
+        offset = struct.calcsize("!ciLH32s")
+        self.assertEqual(struct.unpack_from("!H", message, offset)[0],
+                         len(encoded))
+        self.assertEqual(message[offset + 2:], encoded)
+
+    def test_size_limit_counts_bytes(self):
+        # Under the limit in characters, but over it once encoded
+        payload = u"☕" * (apns.MAX_MESSAGE_SIZE_BYTES / 2)
+
+        self.assertRaises(apns.APNSException,
+                          apns.APNSMessagePacker().compile, payload)
+
+    def test_decode_token_checks_length(self):
+        packer = apns.APNSMessagePacker()
+
+        self.assertEqual(packer.decode_token(TOKEN.encode("base64")), TOKEN)
+        self.assertRaises(apns.APNSException, packer.decode_token,
+                          TOKEN[1:].encode("base64"))
+        self.assertRaises(apns.APNSException, packer.decode_token,
+                          (TOKEN + "\x01").encode("base64"))
+
+class APNSClientFactoryTests(unittest.TestCase):
+
+    def setUp(self):
+        self.metrics = metrics.MetricsRegistry()
+        self.factory = apns.APNSClientFactory(lambda error: None,
+                                              backlog_queue_size=100,
+                                              metrics_registry=self.metrics)
+        self.transport = StringTransport()
+        self.factory.protocol.factory = self.factory
+        self.factory.protocol.transport = self.transport
+        self.addCleanup(self.factory.protocol.shutdown)
+        self.addCleanup(logger.LOGGER.stop_summaries)
+
+    def cancel_drain(self):
+        if self.factory.drain_trigger is not None and \
+                self.factory.drain_trigger.active():
+            self.factory.drain_trigger.cancel()
+
+    def test_sends_while_paused_are_delayed_not_dropped(self):
+        # The default factory keeps one queued message per lane while
+        # disconnected, which must not limit the backlog while connected
+        factory = apns.APNSClientFactory(lambda error: None,
+                                         metrics_registry=self.metrics)
+        factory.protocol.factory = factory
+        factory.protocol.transport = self.transport
+        factory._connected = True
+        self.addCleanup(factory.protocol.shutdown)
+
+        factory.pauseProducing()
+        for _ in range(100):
+            factory.send_decoded_message(TOKEN, "{}")
+        self.assertEqual(self.transport.value(), "")
+
+        factory.resumeProducing()
+
+        self.assertEqual(self.metrics.counters["apns.messages_sent"], 100)
+        self.assertEqual(self.metrics.counters.get("apns.messages_dropped"),
+                         None)
+        self.assertEqual(len(self.transport.value()),
+                         100 * len(factory.packer.pack(1000, 0, TOKEN, "{}")))
+
+    def test_disconnected_queue_is_limited(self):
+        self.factory.message_queue = backlog.PriorityBacklog(
+            max_items=2)
+        for _ in range(5):
+            self.factory.send_decoded_message(TOKEN, "{}")
+
+        self.assertEqual(len(self.factory.message_queue), 2)
+        self.assertEqual(self.metrics.counters["apns.messages_dropped"], 3)
+
+    def test_template_sends_are_counted_once(self):
+        template = self.factory.packer.compile("{}")
+
+        # Queued while disconnected, then written once connected
+        self.factory.send_template(TOKEN, template)
+        self.assertEqual(self.metrics.counters.get("apns.messages_sent"),
+                         None)
+
+        self.factory._connected = True
+        self.factory.process_queue()
+        self.factory.send_template(TOKEN, template)
+        self.factory.send_decoded_message(TOKEN, "{}")
+
+        self.assertEqual(self.metrics.counters["apns.messages_sent"], 3)
+        self.assertEqual(len(self.factory.sent_messages), 3)
+
+    def test_resend_history_overflow_is_counted(self):
+        factory = apns.APNSClientFactory(lambda error: None,
+                                         sent_message_capacity=2,
+                                         metrics_registry=self.metrics)
+        factory.protocol.factory = factory
+        factory.protocol.transport = StringTransport()
+        factory._connected = True
+        self.addCleanup(factory.protocol.shutdown)
+        for i in range(4):
+            factory.send_decoded_message(TOKEN, "{}")
+
+        factory.message_error = apns.MIN_MESSAGE_ID
+        factory.process_failed_sent_messages()
+
+        self.assertEqual(
+            self.metrics.counters["apns.resend_history_overflows"], 1)
+        self.assertEqual(self.metrics.counters["apns.resends"], 1)
+
+    def test_token_length_is_checked(self):
+        self.factory._connected = True
+        template = self.factory.packer.compile("{}")
+
+        self.assertRaises(apns.APNSException,
+                          self.factory.send_decoded_message, TOKEN[1:], "{}")
+        self.assertRaises(apns.APNSException, self.factory.send_template,
+                          TOKEN + "\x01", template)
+        self.assertEqual(self.transport.value(), "")
+
+    def test_unregister_metrics(self):
+        self.factory.unregister_metrics()
+
+        self.assertEqual(self.metrics.snapshot()["gauges"], {})
+
+    def test_capacity_waiters_released_per_lane(self):
+        self.addCleanup(self.cancel_drain)
+        self.factory.drain_batch_size = 1
+        for i in range(3):
+            self.factory.enque_message(TOKEN, "{}", backlog.LANE_BULK)
+
+        self.factory._connected = True
+        self.factory.paused = True
+        high = self.factory.wait_for_capacity(backlog.LANE_HIGH)
+        bulk = self.factory.wait_for_capacity(backlog.LANE_BULK)
+        self.assertNoResult(high)
+
+        # The bulk lane still has messages waiting after this batch, but
+        # nothing is held ahead of the high lane
+        self.factory.paused = False
+        self.factory.process_queue()
+
+        self.successResultOf(high)
+        self.assertNoResult(bulk)
+        self.assertEqual(list(self.factory.capacity_waiters),
+                         [backlog.LANE_BULK])
+
+class LoadedFactory(object):
+    """ Stands in for an APNSClientFactory with a fixed load. """
+
+    def __init__(self, load):
+        self.current_load = load
+
+    def load(self):
+        return self.current_load
+
+class APNSConnectionPoolTests(unittest.TestCase):
+
+    def test_least_loaded(self):
+        factories = [LoadedFactory(load) for load in (3, 1, 2)]
+        pool = apns.APNSConnectionPool(factories)
+
+        self.assertIs(pool.select(TOKEN), factories[1])
+        factories[1].current_load = 5
+        self.assertIs(pool.select(TOKEN), factories[2])
+
+    def test_ties_are_rotated(self):
+        factories = [LoadedFactory(0) for _ in range(3)]
+        pool = apns.APNSConnectionPool(factories)
+
+        self.assertEqual([pool.select(TOKEN) for _ in range(6)],
+                         factories * 2)
+
+    def test_token_hash(self):
+        factories = [LoadedFactory(0) for _ in range(4)]
+        pool = apns.APNSConnectionPool(factories,
+                                       apns.POOL_POLICY_TOKEN_HASH)
+        tokens = [struct.pack("!32B", *([index] * 32))
+                  for index in range(200)]
+        selected = [pool.select(token) for token in tokens]
+
+        # Each token always uses the same connection, whatever the load,
+        # and every connection is used
+        factories[0].current_load = 100
+        self.assertEqual([pool.select(token) for token in tokens], selected)
+        self.assertEqual(set(selected), set(factories))
+
+        # The mapping does not depend on the process
+        other_pool = apns.APNSConnectionPool(
+            [LoadedFactory(0) for _ in range(4)], apns.POOL_POLICY_TOKEN_HASH)
+        self.assertEqual(
+            [other_pool.factories.index(other_pool.select(token))
+             for token in tokens],
+            [factories.index(factory) for factory in selected])
+
+    def test_unknown_policy(self):
+        self.assertRaises(apns.APNSException, apns.APNSConnectionPool,
+                          [LoadedFactory(0)], "random")
+
+    def test_factory_load(self):
+        factory = apns.APNSClientFactory(lambda error: None,
+            backlog_queue_size=10, metrics_registry=metrics.MetricsRegistry())
+        self.addCleanup(factory.protocol.shutdown)
+        self.addCleanup(logger.LOGGER.stop_summaries)
+        factory.enque_message(TOKEN, "{}")
+
+        disconnected = factory.load()
+        factory._connected = True
+        factory.paused = True
+        paused = factory.load()
+        factory.paused = False
+
+        self.assertEqual(factory.load(), 1)
+        self.assertTrue(disconnected > paused > 1)
+
+class BulkService(object):
+    """ Stands in for an APNSService using the connections provided. """
+
+    def __init__(self, factories):
+        self.packer = factories[0].packer
+        self.pool = apns.APNSConnectionPool(factories)
+        self.suppression = suppression.SuppressionIndex()
+        self.suppressed = 0
+
+    def count_suppressed(self, message_count=1):
+        self.suppressed += message_count
+
+class APNSBulkSendTests(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.patch(apns, "reactor", self.clock)
+        self.addCleanup(logger.LOGGER.stop_summaries)
+        self.metrics = metrics.MetricsRegistry()
+        self.transports = []
+        factories = [self.create_factory() for _ in range(2)]
+        self.service = BulkService(factories)
+
+    def create_factory(self):
+        factory = apns.APNSClientFactory(lambda error: None,
+                                         backlog_queue_size=100,
+                                         metrics_registry=self.metrics)
+        transport = StringTransport()
+        factory.protocol.factory = factory
+        factory.protocol.transport = transport
+        factory._connected = True
+        self.addCleanup(factory.protocol.shutdown)
+        self.transports.append(transport)
+        return factory
+
+    def written(self):
+        return sum(len(transport.value()) for transport in self.transports)
+
+    def test_sends_to_every_token(self):
+        tokens = [struct.pack("!32B", *([index] * 32)) for index in range(5)]
+        self.service.suppression.add(tokens[0])
+        encoded = [token.encode("base64") for token in tokens]
+        bulk = apns.APNSBulkSend(self.service, encoded + ["not base64!"],
+                                 "{}")
+
+        self.assertEqual(self.successResultOf(bulk.start()), 4)
+        self.assertEqual(bulk.invalid, 1)
+        self.assertEqual(self.service.suppressed, 1)
+        self.assertEqual(self.written(), 4 * len(
+            self.service.packer.pack(1000, 0, TOKEN, "{}")))
+
+    def test_decoded_tokens(self):
+        bulk = apns.APNSBulkSend(self.service, [TOKEN, TOKEN[1:], TOKEN],
+                                 "{}", decoded=True)
+
+        self.assertEqual(self.successResultOf(bulk.start()), 2)
+        self.assertEqual(bulk.invalid, 1)
+
+    def test_payload_packed_once(self):
+        bulk = apns.APNSBulkSend(self.service, [TOKEN] * 3, "{}",
+                                 decoded=True)
+        self.successResultOf(bulk.start())
+
+        message = self.service.packer.pack(1000, 0, TOKEN, "{}")
+        self.assertEqual(bulk.template.payload, "{}")
+        self.assertEqual(self.written(), 3 * len(message))
+
+    def test_sent_in_chunks(self):
+        bulk = apns.APNSBulkSend(self.service, [TOKEN] * 5, "{}",
+                                 chunk_size=2, decoded=True)
+        deferred = bulk.start()
+        self.assertEqual(bulk.sent, 2)
+        self.assertNoResult(deferred)
+
+        # The rest are sent once the reactor has had a chance to run
+        self.clock.advance(0)
+        self.assertEqual(self.successResultOf(deferred), 5)
+
+    def test_waits_for_capacity(self):
+        for factory in self.service.pool.factories:
+            factory.pauseProducing()
+
+        bulk = apns.APNSBulkSend(self.service, [TOKEN] * 3, "{}",
+                                 decoded=True)
+        deferred = bulk.start()
+        self.assertEqual(self.written(), 0)
+        self.assertNoResult(deferred)
+
+        for factory in self.service.pool.factories:
+            factory.resumeProducing()
+
+        self.assertEqual(self.successResultOf(deferred), 3)
+        self.assertEqual(self.metrics.counters["apns.messages_sent"], 3)
+
+class APNSBatchedWriteTests(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.patch(apns, "reactor", self.clock)
+        self.metrics = metrics.MetricsRegistry()
+        self.factory = apns.APNSClientFactory(lambda error: None,
+                                              use_frame_format=True,
+                                              batch_writes=True,
+                                              flush_threshold_bytes=1024,
+                                              metrics_registry=self.metrics)
+        self.transport = StringTransport()
+        self.connect(self.transport)
+        self.addCleanup(self.factory.protocol.shutdown)
+        self.addCleanup(logger.LOGGER.stop_summaries)
+
+    def connect(self, transport):
+        protocol = self.factory.buildProtocol(
+            address.IPv4Address("TCP", "127.0.0.1", apns.APNS_PORT))
+        protocol.makeConnection(transport)
+
+        # The tests reconnect the factory themselves
+        self.factory.continueTrying = False
+
+    def test_frame_layout(self):
+        message = self.factory.packer.pack(1000, 1234, TOKEN, "{}")
+        frame_length = apns.FRAME_ITEM_OVERHEAD_BYTES + len("{}")
+
+        self.assertEqual(struct.unpack(apns.FRAME_FORMAT_STRING % 2, message),
+                         (apns.FRAME_COMMAND_TYPE, frame_length,
+                          apns.DEVICE_TOKEN_ITEM, 32, TOKEN,
+                          apns.PAYLOAD_ITEM, 2, "{}",
+                          apns.NOTIFICATION_ID_ITEM, 4, 1000,
+                          apns.EXPIRY_ITEM, 4, 1234,
+                          apns.PRIORITY_ITEM, 1, apns.DEFAULT_PRIORITY))
+
+    def test_writes_are_batched(self):
+        for _ in range(3):
+            self.factory.send_decoded_message(TOKEN, "{}")
+        self.assertEqual(self.transport.value(), "")
+
+        self.clock.advance(0)
+
+        self.assertEqual(self.transport.value(),
+                         self.factory.sent_messages.messages_after(0))
+        self.assertEqual(self.metrics.counters["apns.messages_sent"], 3)
+
+    def test_full_buffer_is_flushed(self):
+        message_size = len(self.factory.packer.pack(1000, 0, TOKEN, "{}"))
+        count = 1024 // message_size + 1
+        for _ in range(count):
+            self.factory.send_decoded_message(TOKEN, "{}")
+
+        self.assertEqual(len(self.transport.value()), count * message_size)
+        self.assertEqual(self.factory.flush_trigger, None)
+
+    def test_batch_is_written_after_reconnecting(self):
+        for _ in range(3):
+            self.factory.send_decoded_message(TOKEN, "{}")
+
+        self.factory.clientConnectionLost(None,
+            failure.Failure(error.ConnectionLost()))
+        self.clock.advance(0)
+        self.assertEqual(self.transport.value(), "")
+
+        transport = StringTransport()
+        self.connect(transport)
+        self.clock.advance(0)
+
+        self.assertEqual(transport.value(),
+                         self.factory.sent_messages.messages_after(0))
+        self.assertEqual(self.metrics.counters["apns.messages_sent"], 3)
+
+    def test_batch_is_resent_once_after_error(self):
+        for _ in range(3):
+            self.factory.send_decoded_message(TOKEN, "{}")
+
+        self.factory.message_error = apns.MIN_MESSAGE_ID
+        self.factory.clientConnectionLost(None,
+            failure.Failure(error.ConnectionLost()))
+
+        transport = StringTransport()
+        self.connect(transport)
+        self.clock.advance(0)
+
+        self.assertEqual(transport.value(),
+            self.factory.sent_messages.messages_after(apns.MIN_MESSAGE_ID))
+
+class APNSErrorResponseTests(unittest.TestCase):
+
+    def setUp(self):
+        self.errors = []
+        self.metrics = metrics.MetricsRegistry()
+        self.factory = apns.APNSClientFactory(self.errors.append,
+                                              metrics_registry=self.metrics)
+        self.protocol = self.factory.protocol
+        self.protocol.factory = self.factory
+        self.protocol.transport = StringTransport()
+        self.addCleanup(self.protocol.shutdown)
+        self.addCleanup(logger.LOGGER.stop_summaries)
+
+    def frame(self, status, identifier):
+        return apns.ERROR_RESPONSE_STRUCT.pack(apns.ERROR_RESPONSE_COMMAND,
+                                               status, identifier)
+
+    def test_frame_split_across_reads(self):
+        data = self.frame(8, 1234)
+        for index in range(len(data)):
+            self.protocol.dataReceived(data[index])
+
+        self.assertEqual(self.errors, [(8, 1234)])
+        self.assertEqual(len(self.protocol.receive_buffer), 0)
+
+    def test_frames_in_one_read(self):
+        data = self.frame(8, 1000) + self.frame(7, 1001) + self.frame(8, 2)
+        self.protocol.dataReceived(data[:-3])
+        self.protocol.dataReceived(data[-3:])
+
+        self.assertEqual(self.errors, [(8, 1000), (7, 1001), (8, 2)])
+        self.assertEqual(self.metrics.counters["apns.errors.8"], 2)
+
+    def test_malformed_bytes_are_skipped(self):
+        self.protocol.dataReceived("\x01\x02\x03" + self.frame(8, 1000))
+
+        self.assertEqual(self.errors, [(8, 1000)])
+        self.assertEqual(self.protocol.malformed_frames, 1)
+        self.assertEqual(
+            self.metrics.counters["apns.malformed_error_frames"], 1)
+
+    def test_identifier_zero_is_not_resent(self):
+        self.protocol.dataReceived(self.frame(8, 0))
+
+        self.assertEqual(self.errors, [])
+        self.assertEqual(self.factory.message_error, None)
+
+class SentMessageHistoryTests(unittest.TestCase):
+
+    def fill(self, capacity, first, count):
+        history = apns.SentMessageHistory(capacity)
+        for index in range(count):
+            sequence_number = first + index
+            if sequence_number > apns.MAX_MESSAGE_ID:
+                sequence_number -= apns.MESSAGE_ID_RANGE
+            history.append(sequence_number, str(index), "m{0};".format(index))
+
+        return history
+
+    def test_messages_after(self):
+        history = self.fill(5, 1000, 3)
+
+        self.assertEqual(history.messages_after(1000), "m1;m2;")
+        self.assertEqual(history.messages_after(1002), "")
+        self.assertEqual(history.token(1001), "1")
+
+    def test_wraps_around_buffer(self):
+        history = self.fill(4, 1000, 7)
+
+        self.assertEqual(len(history), 4)
+        self.assertEqual(history.messages_after(1003), "m4;m5;m6;")
+        self.assertNotIn(1002, history)
+        self.assertIn(1003, history)
+
+    def test_wraps_around_message_ids(self):
+        history = self.fill(4, apns.MAX_MESSAGE_ID - 1, 4)
+
+        self.assertEqual(history.messages_after(apns.MAX_MESSAGE_ID),
+                         "m2;m3;")
+        self.assertEqual(history.token(apns.MIN_MESSAGE_ID), "2")
+
+    def test_evicted_returns_whole_history(self):
+        history = self.fill(3, 1000, 6)
+
+        self.assertEqual(history.messages_after(1001), "m3;m4;m5;")
+        self.assertEqual(history.token(1001), None)
+
+    def test_invalid_capacity(self):
+        self.assertRaises(apns.APNSException, apns.SentMessageHistory, 0)
+
+    def test_size_from_send_rate(self):
+        self.assertEqual(apns.sent_message_history_size(100000, 0.5), 50000)
+        self.assertEqual(apns.sent_message_history_size(10),
+                         apns.SENT_MESSAGE_HISTORY_SIZE)
+        self.assertEqual(apns.sent_message_history_size(),
+                         apns.UNPACED_SEND_RATE *
+                         apns.ERROR_ROUND_TRIP_SECONDS)
@@ -0,0 +1,76 @@
+""" Tests for parsing the APNS feedback stream. """
+
+import binascii
+from twisted.trial import unittest
+from pushpy import apns_feedback, logger, metrics, suppression
+
+TOKENS = [chr(index) * 32 for index in range(1, 6)]
+
+def feedback_stream(tokens):
+    return "".join(apns_feedback.FEEDBACK_HEADER.pack(1000 + index,
+                                                      len(token)) + token
+                   for index, token in enumerate(tokens))
+
+def expected_tuples(tokens):
+    return [(1000 + index, binascii.b2a_base64(token)[:-1])
+            for index, token in enumerate(tokens)]
+
+class FeedbackParserTests(unittest.TestCase):
+
+    def setUp(self):
+        self.batches = []
+
+    def test_any_chunking(self):
+        data = feedback_stream(TOKENS)
+        for chunk_size in (1, 5, 37, len(data)):
+            del self.batches[:]
+            parser = apns_feedback.FeedbackParser(self.batches.append)
+            for start in range(0, len(data), chunk_size):
+                parser.feed(data[start:start + chunk_size])
+
+            self.assertEqual(parser.finish(), 0)
+            self.assertEqual(self.batches, [expected_tuples(TOKENS)])
+
+    def test_batches(self):
+        parser = apns_feedback.FeedbackParser(self.batches.append,
+                                              batch_size=2)
+        parser.feed(feedback_stream(TOKENS))
+
+        # Full batches are delivered as they are decoded
+        self.assertEqual([len(batch) for batch in self.batches], [2, 2])
+
+        parser.finish()
+        self.assertEqual([len(batch) for batch in self.batches], [2, 2, 1])
+        self.assertEqual(parser.token_count, len(TOKENS))
+
+    def test_empty_stream_delivers_empty_list(self):
+        parser = apns_feedback.FeedbackParser(self.batches.append)
+
+        self.assertEqual(parser.finish(), 0)
+        self.assertEqual(self.batches, [[]])
+
+    def test_truncated_stream(self):
+        parser = apns_feedback.FeedbackParser(self.batches.append)
+        parser.feed(feedback_stream(TOKENS[:2])[:-4])
+
+        self.assertEqual(parser.finish(), apns_feedback.FEEDBACK_HEADER.size
+                         + 28)
+        self.assertEqual(self.batches, [expected_tuples(TOKENS[:1])])
+
+class FeedbackFactoryTests(unittest.TestCase):
+
+    def test_tokens_suppressed_and_parse_errors_counted(self):
+        self.addCleanup(logger.LOGGER.stop_summaries)
+        received = []
+        registry = metrics.MetricsRegistry()
+        index = suppression.SuppressionIndex()
+        factory = apns_feedback.APNFeedbackClientFactory(received.extend,
+            metrics_registry=registry, suppression_index=index)
+
+        factory.process_list(feedback_stream(TOKENS) + "\x00")
+
+        self.assertEqual(received, expected_tuples(TOKENS))
+        self.assertTrue(all(token in index for token in TOKENS))
+        self.assertEqual(registry.counters["apns_feedback.tokens_suppressed"],
+                         len(TOKENS))
+        self.assertEqual(registry.counters["apns_feedback.parse_errors"], 1)
@@ -0,0 +1,178 @@
+""" Tests for the APNS HTTP/2 engine. """
+
+import binascii
+from twisted.internet import defer, reactor, task
+from twisted.trial import unittest
+from pushpy import apns, apns_http2, logger, metrics, pacing, suppression
+from benchmarks import fake_servers
+
+TOKEN = "\x01" * apns.DEVICE_TOKEN_LENGTH
+
+class RecordingProtocol(object):
+    """ Stands in for APNSHTTP2Protocol, accepting every notification. """
+
+    def __init__(self):
+        self.sent = []
+
+    def can_send(self, notification):
+        return True
+
+    def send_notification(self, notification, headers):
+        self.sent.append(notification)
+
+    def flush(self):
+        pass
+
+class UnstartedEngine(apns_http2.APNSHTTP2Engine):
+    """ An engine which does not connect when the service starts it. """
+
+    def start(self):
+        pass
+
+class HTTP2PacingTests(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.patch(apns_http2, "reactor", self.clock)
+        self.patch(pacing.time, "time", self.clock.seconds)
+        self.engine = UnstartedEngine("topic", use_tls=False,
+            metrics_registry=metrics.MetricsRegistry())
+        self.engine.protocol = RecordingProtocol()
+
+    def create_service(self, **kwargs):
+        return apns.APNSService(None, None, http2_engine=self.engine,
+            metrics_registry=self.engine.metrics,
+            suppression_index=suppression.SuppressionIndex(), **kwargs)
+
+    def test_service_rate_paces_engine(self):
+        service = self.create_service(send_rate=10, send_burst=2)
+
+        for _ in range(5):
+            service.send_decoded_message(TOKEN, "{}")
+        self.assertEqual(len(self.engine.protocol.sent), 2)
+
+        self.clock.advance(0.1)
+        self.assertEqual(len(self.engine.protocol.sent), 3)
+
+        self.clock.advance(1)
+        self.assertEqual(len(self.engine.protocol.sent), 5)
+
+    def test_pacing_state_and_rate_changes(self):
+        service = self.create_service(send_rate=10, send_burst=1)
+        for _ in range(3):
+            service.send_decoded_message(TOKEN, "{}")
+
+        state = service.pacing_state()
+        self.assertEqual(state["service"]["rate"], 10)
+        self.assertEqual(len(state["connections"]), 1)
+
+        service.set_send_rate(None)
+        self.assertEqual(len(self.engine.protocol.sent), 3)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_rate_changes_keep_limits_not_passed(self):
+        service = self.create_service(send_rate=10, send_burst=2,
+                                      connection_send_rate=5,
+                                      connection_send_burst=3)
+
+        service.set_send_rate(send_burst=4)
+        state = service.pacing_state()
+        self.assertEqual(state["service"]["rate"], 10)
+        self.assertEqual(state["service"]["burst"], 4)
+        self.assertEqual(state["connections"][0]["rate"], 5)
+        self.assertEqual(state["connections"][0]["burst"], 3)
+
+        service.set_send_rate(connection_send_rate=None)
+        state = service.pacing_state()
+        self.assertEqual(state["service"]["rate"], 10)
+        self.assertEqual(state["connections"][0]["rate"], None)
+
+class HTTP2ErrorTests(unittest.TestCase):
+
+    def setUp(self):
+        self.addCleanup(logger.LOGGER.stop_summaries)
+        self.errors = []
+        self.index = suppression.SuppressionIndex()
+        self.engine = UnstartedEngine("topic", use_tls=False,
+            metrics_registry=metrics.MetricsRegistry())
+        self.engine.protocol = RecordingProtocol()
+        self.service = apns.APNSService(None, None, self.errors.append,
+            http2_engine=self.engine, metrics_registry=self.engine.metrics,
+            suppression_index=self.index)
+
+    def respond(self, status, reason):
+        self.service.send_decoded_message(TOKEN, "{}")
+        self.engine.notification_complete(self.engine.protocol.sent.pop(),
+                                          status, reason)
+
+    def test_invalid_token_is_suppressed(self):
+        self.respond(410, "Unregistered")
+
+        self.assertEqual(self.errors[0][0], apns.INVALID_TOKEN_ERROR)
+        self.assertIn(TOKEN, self.index)
+
+    def test_token_for_another_topic_is_not_suppressed(self):
+        self.respond(400, "DeviceTokenNotForTopic")
+
+        self.assertEqual(self.errors[0][0], apns_http2.UNKNOWN_ERROR_CODE)
+        self.assertNotIn(TOKEN, self.index)
+
+class FakeAPNSHTTP2Tests(unittest.TestCase):
+    """ Sends through a real engine to the fake APNS HTTP/2 API, which
+        accepts the first notification, answers the second with 410
+        Unregistered and the third with 400 BadDeviceToken. """
+
+    def setUp(self):
+        self.addCleanup(logger.LOGGER.stop_summaries)
+        self.server = fake_servers.FakeAPNSHTTP2Factory(error_every=3,
+                                                        unregistered_every=2)
+        self.listener = reactor.listenTCP(0, self.server,
+            interface=fake_servers.LISTEN_INTERFACE)
+        self.addCleanup(self.listener.stopListening)
+
+        self.metrics = metrics.MetricsRegistry()
+        self.errors = []
+        self.engine = apns_http2.APNSHTTP2Engine("topic",
+            hostname=fake_servers.LISTEN_INTERFACE,
+            port=self.listener.getHost().port, use_tls=False,
+            metrics_registry=self.metrics)
+        self.service = apns.APNSService(None, None, self.errors.append,
+            http2_engine=self.engine, metrics_registry=self.metrics,
+            suppression_index=suppression.SuppressionIndex())
+
+    def tearDown(self):
+        self.engine.factory.stopTrying()
+        if self.engine.protocol is None:
+            return
+
+        lost = defer.Deferred()
+        self.engine.connection_lost = lambda protocol: lost.callback(None)
+        self.engine.protocol.transport.loseConnection()
+
+        return lost
+
+    @defer.inlineCallbacks
+    def test_responses_and_suppression(self):
+        tokens = [chr(index) * apns.DEVICE_TOKEN_LENGTH
+                  for index in range(1, 4)]
+
+        responses = []
+        for token in tokens:
+            response = yield self.service.send_decoded_message(token, "{}")
+            responses.append(response)
+
+        self.assertEqual(responses, [(200, None), (410, "Unregistered"),
+                                     (400, "BadDeviceToken")])
+        self.assertEqual([error[0] for error in self.errors],
+                         [apns.INVALID_TOKEN_ERROR] * 2)
+        self.assertEqual(self.server.rejected_tokens,
+                         set(binascii.hexlify(token) for token in tokens[1:]))
+
+        # Tokens the APNS rejected are not sent to again
+        for token in tokens[1:]:
+            response = yield self.service.send_decoded_message(token, "{}")
+            self.assertEqual(response, None)
+
+        self.assertEqual(self.server.stats.received, 3)
+        self.assertEqual(self.metrics.counters["apns.messages_suppressed"], 2)
+        self.assertEqual(self.metrics.counters["apns.tokens_suppressed"], 2)
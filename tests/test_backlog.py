@@ -0,0 +1,119 @@
+""" Tests for the message backlogs. """
+
+from twisted.trial import unittest
+from pushpy import backlog
+
+# Bytes held for a message of size 0
+ITEM = backlog.ITEM_OVERHEAD_BYTES
+
+class MessageBacklogTests(unittest.TestCase):
+
+    def fill(self, overflow_policy):
+        queue = backlog.MessageBacklog(max_bytes=10 * ITEM, max_items=2,
+                                       overflow_policy=overflow_policy)
+        queue.put("first", 0)
+        queue.put("second", 0)
+
+        return queue
+
+    def test_fifo(self):
+        queue = self.fill(backlog.OVERFLOW_DROP_OLDEST)
+
+        self.assertEqual(queue.get(), "first")
+        self.assertEqual(queue.get(), "second")
+        self.assertRaises(IndexError, queue.get)
+        self.assertEqual(queue.size_bytes, 0)
+
+    def test_drop_oldest(self):
+        queue = self.fill(backlog.OVERFLOW_DROP_OLDEST)
+
+        self.assertTrue(queue.put("third", 0))
+        self.assertEqual([queue.get(), queue.get()], ["second", "third"])
+        self.assertEqual(queue.dropped, 1)
+
+    def test_drop_newest(self):
+        queue = self.fill(backlog.OVERFLOW_DROP_NEWEST)
+
+        self.assertFalse(queue.put("third", 0))
+        self.assertEqual([queue.get(), queue.get()], ["first", "second"])
+        self.assertEqual(queue.dropped, 1)
+
+    def test_reject(self):
+        queue = self.fill(backlog.OVERFLOW_REJECT)
+
+        self.assertRaises(backlog.BacklogFullException, queue.put, "third", 0)
+        self.assertEqual(len(queue), 2)
+        self.assertEqual(queue.dropped, 0)
+
+    def test_byte_limit(self):
+        queue = backlog.MessageBacklog(max_bytes=3 * ITEM)
+        queue.put("first", ITEM)
+        queue.put("second", ITEM)
+
+        self.assertEqual(queue.get(), "second")
+        self.assertEqual(queue.dropped, 1)
+        self.assertFalse(queue.put("huge", 3 * ITEM))
+
+    def test_item_limit_can_be_skipped(self):
+        queue = self.fill(backlog.OVERFLOW_DROP_OLDEST)
+
+        self.assertTrue(queue.put("third", 0, limit_items=False))
+        self.assertEqual(len(queue), 3)
+        self.assertEqual(queue.dropped, 0)
+
+        # The byte budget still applies
+        queue.max_bytes = 3 * ITEM
+        self.assertTrue(queue.put("fourth", 0, limit_items=False))
+        self.assertEqual(queue.get(), "second")
+        self.assertEqual(queue.dropped, 1)
+
+    def test_unknown_policy(self):
+        self.assertRaises(ValueError, backlog.MessageBacklog,
+                          overflow_policy="drop_random")
+
+class PriorityBacklogTests(unittest.TestCase):
+
+    def test_weighted_order(self):
+        queue = backlog.PriorityBacklog(lanes=(("a", 2), ("b", 1)))
+        for i in range(4):
+            queue.put(("a", i), 0, "a")
+            queue.put(("b", i), 0, "b")
+
+        lanes = [queue.get()[0] for i in range(6)]
+
+        self.assertEqual(lanes.count("a"), 4)
+        self.assertEqual(lanes.count("b"), 2)
+        self.assertEqual(lanes[:3].count("a"), 2)
+        # Once a lane is empty the others take all of the sends
+        self.assertEqual([queue.get()[0], queue.get()[0]], ["b", "b"])
+        self.assertEqual(len(queue), 0)
+
+    def test_limits_apply_per_lane(self):
+        queue = backlog.PriorityBacklog(max_items=2,
+                                        lane_limits={backlog.LANE_BULK:
+                                                     (10 * ITEM, 1)})
+        for i in range(3):
+            queue.put(i, 0, backlog.LANE_BULK)
+            queue.put(i, 0, backlog.LANE_HIGH)
+            queue.put(i, 0, backlog.LANE_NORMAL)
+
+        self.assertEqual(queue.depths(), {backlog.LANE_HIGH: 2,
+                                          backlog.LANE_NORMAL: 2,
+                                          backlog.LANE_BULK: 1})
+        self.assertEqual(len(queue), 5)
+        self.assertEqual(queue.dropped, 4)
+
+    def test_unknown_lane_uses_default(self):
+        queue = backlog.PriorityBacklog()
+        queue.put("message", 0, "unknown")
+
+        self.assertEqual(queue.depths()[backlog.LANE_NORMAL], 1)
+
+    def test_waiting_ahead(self):
+        queue = backlog.PriorityBacklog()
+        queue.put("bulk", 0, backlog.LANE_BULK)
+        queue.put("normal", 0, backlog.LANE_NORMAL)
+
+        self.assertEqual(queue.waiting_ahead(backlog.LANE_HIGH), 0)
+        self.assertEqual(queue.waiting_ahead(backlog.LANE_NORMAL), 1)
+        self.assertEqual(queue.waiting_ahead(backlog.LANE_BULK), 2)
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+""" Tests for building Blackberry PAP pushes. """
+
+from twisted.internet import defer, reactor
+from twisted.test.proto_helpers import StringTransport
+from twisted.trial import unittest
+from twisted.web import resource, server
+from twisted.web.client import HTTPConnectionPool
+from pushpy import blackberry, logger, metrics
+
+UNICODE_TEXT = u"Caf\xe9 ☕"
+
+class PAPBodyProducerTests(unittest.TestCase):
+
+    def produce(self, producer):
+        consumer = StringTransport()
+        deferred = producer.startProducing(consumer)
+        self.successResultOf(deferred)
+
+        return consumer.value()
+
+    def test_length_counts_encoded_bytes(self):
+        producer = blackberry.PAPBodyProducer(u"<header>", ["a", "b"],
+                                              UNICODE_TEXT)
+        body = self.produce(producer)
+
+        self.assertIsInstance(body, str)
+        self.assertEqual(producer.length, len(body))
+        self.assertTrue(body.endswith(UNICODE_TEXT.encode("utf-8")))
+
+    def test_chunked_body_matches_length(self):
+        producer = blackberry.PAPBodyProducer("<header>",
+            [str(index) for index in range(25)], UNICODE_TEXT, chunk_size=10)
+
+        consumer = StringTransport()
+        deferred = producer.startProducing(consumer)
+        while not deferred.called:
+            reactor.iterate()
+
+        self.assertEqual(producer.length, len(consumer.value()))
+        self.assertEqual(consumer.value().count(blackberry.ADDRESS_PREFIX),
+                         25)
+
+    def test_create_body_with_unicode_message(self):
+        service = blackberry.BlackberryService("http://127.0.0.1/",
+            "application", "password",
+            metrics_registry=metrics.MetricsRegistry(),
+            connection_pool=HTTPConnectionPool(reactor, persistent=False))
+        producer = service.create_body(["a"], UNICODE_TEXT)
+
+        body = self.produce(producer)
+
+        self.assertEqual(producer.length, len(body))
+        self.assertIn(UNICODE_TEXT.encode("utf-8"), body)
+
+class RecordingResource(resource.Resource):
+    """ Records the Content-Type and body of each push. """
+
+    isLeaf = True
+
+    def __init__(self):
+        resource.Resource.__init__(self)
+        self.pushes = []
+
+    def render_POST(self, request):
+        self.pushes.append((request.getHeader("content-type"),
+                            request.content.read()))
+        return ""
+
+class BlackberryServiceTests(unittest.TestCase):
+
+    @defer.inlineCallbacks
+    def test_push_declares_utf8(self):
+        self.addCleanup(logger.LOGGER.stop_summaries)
+        pushes = RecordingResource()
+        port = reactor.listenTCP(0, server.Site(pushes),
+                                 interface="127.0.0.1")
+        self.addCleanup(port.stopListening)
+        service = blackberry.BlackberryService(
+            "http://127.0.0.1:{0}/".format(port.getHost().port),
+            "application", "password",
+            metrics_registry=metrics.MetricsRegistry(),
+            connection_pool=HTTPConnectionPool(reactor, persistent=False))
+
+        yield service.send_message(["a"], UNICODE_TEXT)
+
+        content_type, body = pushes.pushes[0]
+        self.assertIn("charset=utf-8", content_type)
+        self.assertNotIn("us-ascii", content_type)
+        self.assertIn("Content-Type: text/html; charset=utf-8\n\n" +
+                      UNICODE_TEXT.encode("utf-8"), body)
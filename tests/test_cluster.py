@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+""" Tests for the requests handled by worker processes. """
+
+import json
+from twisted.test.proto_helpers import StringTransport
+from twisted.trial import unittest
+from pushpy import apns, cluster, metrics
+
+class RecordingAPNSProvider(object):
+    """ Stands in for APNSService, packing the payload it is sent. """
+
+    def __init__(self):
+        self.packer = apns.APNSMessagePacker()
+        self.sent = []
+
+    def send_bulk(self, device_tokens, payload):
+        template = self.packer.compile(payload)
+        for device_token in device_tokens:
+            self.sent.append((device_token, payload, template.pack(
+                1000, 0, self.packer.decode_token(device_token))))
+
+        return len(device_tokens)
+
+class EncodeStringsTests(unittest.TestCase):
+
+    def test_encodes_nested_strings(self):
+        value = cluster.load_request(json.dumps(
+            {"tokens" : [u"t\xe9"], "message" : {"payload" : u"☕"},
+             "id" : 3}))
+
+        self.assertEqual(value, {"tokens" : ["t\xc3\xa9"],
+                                 "message" : {"payload" : "\xe2\x98\x95"},
+                                 "id" : 3})
+        self.assertIsInstance(value.keys()[0], str)
+
+class WorkerProtocolTests(unittest.TestCase):
+
+    def setUp(self):
+        self.provider = RecordingAPNSProvider()
+        self.protocol = cluster.WorkerProtocol({"apns" : self.provider},
+                                               metrics.MetricsRegistry())
+        self.transport = StringTransport()
+        self.protocol.transport = self.transport
+
+    def test_apns_request_with_unicode_payload(self):
+        payload = u'{"aps":{"alert":"Caf\xe9 ☕"}}'
+        token = "AQEB" * 10 + "AQE="
+
+        self.protocol.lineReceived(json.dumps({"id" : 7,
+            "provider" : "apns", "tokens" : [token],
+            "message" : {"payload" : payload}}))
+
+        self.assertEqual(json.loads(self.transport.value()),
+                         {"id" : 7, "result" : 1})
+        sent_token, sent_payload, message = self.provider.sent[0]
+        self.assertIsInstance(sent_payload, str)
+        self.assertEqual(sent_payload, payload.encode("utf-8"))
+        self.assertTrue(message.endswith(payload.encode("utf-8")))
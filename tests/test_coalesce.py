@@ -0,0 +1,105 @@
+""" Tests for the coalescing stage. """
+
+from twisted.internet import defer, task
+from twisted.trial import unittest
+from pushpy import coalesce, metrics
+
+class ShutdownClock(task.Clock):
+    """ A Clock which also accepts the shutdown trigger the coalescer adds. """
+
+    def addSystemEventTrigger(self, phase, event, function, *args):
+        pass
+
+class CoalescerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = ShutdownClock()
+        self.patch(coalesce, "reactor", self.clock)
+        self.patch(coalesce.time, "time", self.clock.seconds)
+        self.sent = []
+        self.metrics = metrics.MetricsRegistry()
+
+    def create(self, **kwargs):
+        return coalesce.Coalescer(self.send, window=1.0,
+                                  metrics_registry=self.metrics, **kwargs)
+
+    def send(self, messages):
+        self.sent.append(messages)
+        return ["sent {0}".format(token) for token, _, _ in messages]
+
+    def test_merges_within_window(self):
+        coalescer = self.create()
+        first = coalescer.submit("a", 1)
+        self.clock.advance(0.5)
+        second = coalescer.submit("a", 2, context="high")
+        coalescer.submit("b", 3, collapse_key="other")
+
+        self.clock.advance(0.5)
+
+        self.assertEqual(self.sent, [[("a", 2, "high")]])
+        self.assertEqual(self.successResultOf(first), "sent a")
+        self.assertEqual(self.successResultOf(second), "sent a")
+        self.assertEqual(self.metrics.counters["coalesce.merged"], 1)
+
+        # The window of a later message is not cut short
+        self.clock.advance(0.5)
+        self.assertEqual(len(self.sent), 2)
+        self.assertEqual(len(coalescer), 0)
+
+    def test_window_not_extended_by_updates(self):
+        coalescer = self.create()
+        coalescer.submit("a", 1)
+        for _ in range(3):
+            self.clock.advance(0.3)
+            coalescer.submit("a", 2)
+
+        self.clock.advance(0.2)
+
+        self.assertEqual(self.sent, [[("a", 2, None)]])
+
+    def test_custom_merge(self):
+        coalescer = self.create(merge=lambda held, new: held + new)
+        coalescer.submit("a", 1)
+        coalescer.submit("a", 2)
+        coalescer.flush()
+
+        self.assertEqual(self.sent, [[("a", 3, None)]])
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_full_sends_oldest_early(self):
+        coalescer = self.create(max_held=2)
+        coalescer.submit("a", 1)
+        coalescer.submit("b", 2)
+        coalescer.submit("c", 3)
+
+        self.assertEqual(self.sent, [[("a", 1, None)]])
+        self.assertEqual(self.metrics.counters["coalesce.sent_early"], 1)
+        self.assertEqual(len(coalescer), 2)
+
+    def test_shared_deferred_results(self):
+        request = defer.Deferred()
+        coalescer = coalesce.Coalescer(lambda messages: [request] *
+                                       len(messages),
+                                       metrics_registry=self.metrics)
+        first = coalescer.submit("a", 1)
+        second = coalescer.submit("b", 2)
+        coalescer.flush()
+        self.assertNoResult(first)
+
+        request.callback("response")
+
+        self.assertEqual(self.successResultOf(first), "response")
+        self.assertEqual(self.successResultOf(second), "response")
+
+    def test_send_failure_fails_waiters(self):
+        def fail(messages):
+            raise RuntimeError("unable to send")
+
+        coalescer = coalesce.Coalescer(fail, metrics_registry=self.metrics)
+        waiter = coalescer.submit("a", 1)
+        coalescer.flush()
+
+        self.failureResultOf(waiter, RuntimeError)
+
+    def test_invalid_window(self):
+        self.assertRaises(ValueError, coalesce.Coalescer, self.send, 0)
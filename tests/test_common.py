@@ -0,0 +1,80 @@
+""" Tests for the HTTP connection pool shared by the providers. """
+
+from twisted.internet import defer, reactor
+from twisted.trial import unittest
+from twisted.web import resource, server
+from twisted.web.client import Agent
+from pushpy import blackberry, common, gcm, logger, metrics
+
+class CountingResource(resource.Resource):
+    """ Answers every request with an empty body, counting the requests
+        and the connections they arrive on. """
+
+    isLeaf = True
+
+    def __init__(self):
+        resource.Resource.__init__(self)
+        self.methods = []
+        self.connections = set()
+
+    def render(self, request):
+        self.methods.append(request.method)
+        self.connections.add(request.transport)
+        return ""
+
+class ConnectionPoolTests(unittest.TestCase):
+
+    def setUp(self):
+        self.patch(common, "SHARED_CONNECTION_POOL", None)
+        self.addCleanup(logger.LOGGER.stop_summaries)
+
+    def test_create_connection_pool(self):
+        pool = common.create_connection_pool(max_per_host=4, idle_timeout=30)
+
+        self.assertTrue(pool.persistent)
+        self.assertEqual(pool.maxPersistentPerHost, 4)
+        self.assertEqual(pool.cachedConnectionTimeout, 30)
+
+    def test_providers_share_pool(self):
+        gcm_service = gcm.GCMService("http://127.0.0.1/", "application",
+            "key", None, None, metrics_registry=metrics.MetricsRegistry())
+        blackberry_service = blackberry.BlackberryService(
+            "http://127.0.0.1/", "application", "password",
+            metrics_registry=metrics.MetricsRegistry())
+
+        pool = common.shared_connection_pool()
+        self.assertIs(gcm_service.connection_pool, pool)
+        self.assertIs(blackberry_service.connection_pool, pool)
+
+    @defer.inlineCallbacks
+    def test_warm_up_connections(self):
+        counting = CountingResource()
+        port = reactor.listenTCP(0, server.Site(counting),
+                                 interface="127.0.0.1")
+        self.addCleanup(port.stopListening)
+        pool = common.create_connection_pool()
+        self.addCleanup(pool.closeCachedConnections)
+        agent = Agent(reactor, pool=pool)
+        url = "http://127.0.0.1:{0}/".format(port.getHost().port)
+
+        opened = yield common.warm_up_connections(agent, url, 3)
+
+        self.assertEqual(opened, 3)
+        self.assertEqual(counting.methods, ["HEAD"] * 3)
+
+        # The request which follows reuses one of the warmed connections
+        response = yield agent.request("GET", url)
+        yield common.discard_body(response)
+        self.assertEqual(len(counting.connections), 3)
+
+    @defer.inlineCallbacks
+    def test_warm_up_failures_are_not_counted(self):
+        port = reactor.listenTCP(0, server.Site(CountingResource()),
+                                 interface="127.0.0.1")
+        url = "http://127.0.0.1:{0}/".format(port.getHost().port)
+        yield port.stopListening()
+        agent = Agent(reactor, pool=common.create_connection_pool())
+
+        opened = yield common.warm_up_connections(agent, url, 2)
+
+        self.assertEqual(opened, 0)
@@ -0,0 +1,260 @@
+""" Tests for the GCM provider, run against a local HTTP server. """
+
+import json
+from twisted.internet import defer, reactor, task
+from twisted.trial import unittest
+from twisted.web import resource, server
+from twisted.web.client import HTTPConnectionPool
+from pushpy import gcm, logger, metrics, suppression
+
+class ScriptedGCMResource(resource.Resource):
+    """ Answers each request with the next of a list of status codes, or
+        200 with results from result_for(token) once the list runs out.
+        Responses are held back for delay seconds, if set. """
+
+    isLeaf = True
+
+    def __init__(self, codes=(), result_for=None):
+        resource.Resource.__init__(self)
+        self.codes = list(codes)
+        self.result_for = result_for or (lambda token: {"message_id" : 1})
+        self.requests = []
+        self.delay = 0
+        self.active = 0
+        self.max_active = 0
+
+    def render_POST(self, request):
+        if self.delay <= 0:
+            return self.respond(request)
+
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        reactor.callLater(self.delay, self._finish, request)
+        return server.NOT_DONE_YET
+
+    def _finish(self, request):
+        self.active -= 1
+        request.write(self.respond(request))
+        request.finish()
+
+    def respond(self, request):
+        message = json.loads(request.content.read())
+        self.requests.append(message["registration_ids"])
+
+        if len(self.codes) > 0:
+            request.setResponseCode(self.codes.pop(0))
+            return ""
+
+        results = [self.result_for(token)
+                   for token in message["registration_ids"]]
+        failure = sum(1 for result in results if "error" in result)
+        return json.dumps({"success" : len(results) - failure,
+                           "failure" : failure, "canonical_ids" : 0,
+                           "results" : results})
+
+class GCMServiceTests(unittest.TestCase):
+
+    def setUp(self):
+        self.resource = ScriptedGCMResource()
+        self.port = reactor.listenTCP(0, server.Site(self.resource),
+                                      interface="127.0.0.1")
+        self.pool = HTTPConnectionPool(reactor, persistent=False)
+        self.errors = []
+        self.abandoned = []
+        self.service = self.create_service()
+        self.service.retry_scheduler.initial_delay = 0.01
+        self.addCleanup(logger.LOGGER.stop_summaries)
+
+    def create_service(self, **kwargs):
+        return gcm.GCMService(
+            "http://127.0.0.1:{0}/".format(self.port.getHost().port),
+            "application", "key", self.errors.append, None,
+            metrics_registry=metrics.MetricsRegistry(),
+            connection_pool=self.pool, retry_attempts=3,
+            retry_failed_callback=self.abandoned.extend,
+            suppression_index=suppression.SuppressionIndex(), **kwargs)
+
+    def tearDown(self):
+        return self.port.stopListening()
+
+    def wait_for_retries(self):
+        """ Returns a Deferred which fires once no retries are pending. """
+
+        def check():
+            if self.service.retry_scheduler.pending_devices == 0 and \
+                    self.service.in_flight == 0:
+                loop.stop()
+
+        loop = task.LoopingCall(check)
+        return loop.start(0.05, now=False)
+
+    @defer.inlineCallbacks
+    def test_send_message_retries_server_errors(self):
+        self.resource.codes = [503, 503]
+
+        yield self.service.send_message(["a", "b"], "h", "x")
+        yield self.wait_for_retries()
+
+        self.assertEqual(self.resource.requests,
+                         [["a", "b"], ["a", "b"], ["a", "b"]])
+        self.assertEqual(self.abandoned, [])
+
+    @defer.inlineCallbacks
+    def test_send_message_abandons_after_max_attempts(self):
+        self.resource.codes = [503] * 10
+
+        yield self.service.send_message(["a"], "h", "x")
+        yield self.wait_for_retries()
+
+        self.assertEqual(len(self.resource.requests), 4)
+        self.assertEqual(self.abandoned, ["a"])
+
+    @defer.inlineCallbacks
+    def test_callback_exception_does_not_resend(self):
+        self.resource.result_for = lambda token: \
+            {"error" : "NotRegistered"} if token == "dead" else \
+            {"message_id" : 1}
+
+        def failing_callback(token):
+            raise RuntimeError("database unavailable")
+        self.service.error_callback = failing_callback
+
+        results = yield self.service.send_message(["dead", "alive"], "h",
+                                                  "x")
+        yield self.wait_for_retries()
+
+        self.assertEqual(self.resource.requests, [["dead", "alive"]])
+        self.assertEqual(results.errors, {0 : "NotRegistered"})
+        self.assertEqual(len(self.flushLoggedErrors(RuntimeError)), 1)
+
+    @defer.inlineCallbacks
+    def test_concurrency_limited_across_send_methods(self):
+        self.service = self.create_service(max_concurrent_requests=2)
+        self.resource.delay = 0.05
+
+        sends = [self.service.send_message([str(index)], "h", "x")
+                 for index in range(3)]
+        sends.append(self.service.send_bulk(
+            (str(index) for index in range(3, 9)), "h", "x", batch_size=2,
+            concurrency=3))
+        self.assertEqual(
+            self.service.metrics.snapshot()["gauges"]["gcm.requests_waiting"],
+            1)
+
+        yield defer.gatherResults(sends)
+
+        self.assertEqual(len(self.resource.requests), 6)
+        self.assertEqual(self.resource.max_active, 2)
+
+class GCMResultsTests(unittest.TestCase):
+
+    def setUp(self):
+        self.addCleanup(logger.LOGGER.stop_summaries)
+        self.removed = []
+        self.updated = []
+        self.metrics = metrics.MetricsRegistry()
+        self.index = suppression.SuppressionIndex()
+        self.service = gcm.GCMService("http://127.0.0.1/", "application",
+            "key", self.removed.append,
+            lambda token, new_token: self.updated.append((token, new_token)),
+            metrics_registry=self.metrics,
+            connection_pool=HTTPConnectionPool(reactor, persistent=False),
+            suppression_index=self.index)
+
+    def test_accepted(self):
+        results = self.service.process_response(json.dumps({
+            "multicast_id" : 1, "success" : 2, "failure" : 0,
+            "canonical_ids" : 0, "results" : [{"message_id" : "1"},
+                                              {"message_id" : "2"}]}),
+            ["a", "b"])
+
+        self.assertEqual(results.success, 2)
+        self.assertEqual(results.tokens(gcm.RESULT_SUCCESS), ["a", "b"])
+        self.assertEqual(results.errors, {})
+
+    def test_result_for_each_device(self):
+        response = ('{"success": 1, "failure": 2, "canonical_ids": 1, '
+                    '"dry_run": false, "extra": null, "results": ['
+                    '{"message_id": "1"}, {"error": "NotRegistered"}, '
+                    '{"error": "Unavailable"}, '
+                    '{"message_id": "2", "registration_id": "e2"}]}')
+        device_list = ["a", "b", "c", "d", "e"]
+
+        results = self.service.process_response(response, device_list)
+
+        self.assertEqual(list(results.codes),
+                         [gcm.RESULT_SUCCESS, gcm.RESULT_REMOVE,
+                          gcm.RESULT_ERROR, gcm.RESULT_UPDATED,
+                          gcm.RESULT_MISSING])
+        self.assertEqual(results.errors, {1 : "NotRegistered",
+                                          2 : "Unavailable"})
+        self.assertEqual(results.canonical_ids, {3 : "e2"})
+        self.assertEqual(results.tokens(gcm.RESULT_MISSING), ["e"])
+        self.assertEqual((results.success, results.failure,
+                          results.canonical_id_count), (1, 2, 1))
+
+        self.assertEqual(self.removed, ["b"])
+        self.assertEqual(self.updated, [("d", "e2")])
+        self.assertIn("b", self.index)
+        self.assertEqual(self.metrics.counters["gcm.tokens_removed"], 1)
+        self.assertEqual(self.metrics.counters["gcm.token_errors"], 1)
+        self.assertEqual(self.metrics.counters["gcm.tokens_missing"], 1)
+
+    def test_unparseable_response(self):
+        self.assertEqual(self.service.process_response("<html>", ["a"]),
+                         None)
+        self.assertEqual(self.metrics.counters["gcm.parse_errors"], 1)
+
+    def test_response_body_is_joined(self):
+        received = defer.Deferred()
+        protocol = gcm.GCMResponse(received)
+        for chunk in ('{"success"', ': 1', '}'):
+            protocol.dataReceived(chunk)
+        protocol.connectionLost(None)
+
+        self.assertEqual(self.successResultOf(received), '{"success": 1}')
+
+class GCMMessagePackerTests(unittest.TestCase):
+
+    def test_payload_matches_full_serialization(self):
+        template = gcm.GCMMessagePacker().compile(u"h\xe9", u'say "hi"',
+                                                  "12:00.00")
+        device_list = ["a", u"b\xe9", 'c"d\\e']
+
+        self.assertEqual(json.loads(template.payload(device_list)),
+                         {"data" : {u"h\xe9" : u'say "hi"',
+                                    "time" : "12:00.00"},
+                          "registration_ids" : device_list})
+
+    def test_template_reused_for_batches(self):
+        template = gcm.GCMMessagePacker().compile("h", "x")
+        data = json.loads(template.payload(["a"]))["data"]
+
+        for device_list in (["b", "c"], [], ["a"] * 3):
+            payload = json.loads(template.payload(device_list))
+            self.assertEqual(payload["data"], data)
+            self.assertEqual(payload["registration_ids"], device_list)
+
+    def test_token_fragments_are_cached(self):
+        packer = gcm.GCMMessagePacker(token_cache_size=4)
+
+        self.assertEqual(packer.token_fragments(["a", "b"]), ['"a"', '"b"'])
+        self.assertIn("a", packer.recent_fragments)
+
+        # Once the recent generation is full it becomes the previous one,
+        # whose fragments are still used
+        packer.token_fragments(["c", "d"])
+        self.assertIn("a", packer.previous_fragments)
+        self.assertEqual(packer.token_fragment("a"), '"a"')
+        self.assertIn("a", packer.recent_fragments)
+
+    def test_construct_message_uses_template(self):
+        service = gcm.GCMService("http://127.0.0.1/", "application", "key",
+            None, None, metrics_registry=metrics.MetricsRegistry(),
+            connection_pool=HTTPConnectionPool(reactor, persistent=False))
+
+        payload = json.loads(service.construct_message(["a", "b"], "h", "x"))
+
+        self.assertEqual(payload["registration_ids"], ["a", "b"])
+        self.assertEqual(payload["data"]["h"], "x")
+        self.assertIn("time", payload["data"])
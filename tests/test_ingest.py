@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+""" Round trip tests for the ingest service, sending requests over TCP. """
+
+import json
+from twisted.internet import defer, protocol, reactor
+from twisted.protocols.basic import LineReceiver
+from twisted.trial import unittest
+from pushpy import cluster, ingest, metrics
+from tests.test_cluster import RecordingAPNSProvider
+
+class AckClient(LineReceiver):
+    """ Writes requests and collects the acknowledgements. """
+
+    delimiter = "\n"
+
+    def __init__(self, expected):
+        self.expected = expected
+        self.acks = []
+        self.finished = defer.Deferred()
+
+    def lineReceived(self, line):
+        self.acks.append(json.loads(line))
+        if len(self.acks) == self.expected:
+            self.transport.loseConnection()
+            self.finished.callback(self.acks)
+
+class IngestRoundTripTests(unittest.TestCase):
+
+    def setUp(self):
+        self.provider = RecordingAPNSProvider()
+        self.factory = ingest.IngestFactory(
+            cluster.ProviderRouter({"apns" : self.provider}),
+            metrics.MetricsRegistry())
+        self.port = reactor.listenTCP(0, self.factory, interface="127.0.0.1")
+
+    def tearDown(self):
+        return self.port.stopListening()
+
+    @defer.inlineCallbacks
+    def send_requests(self, requests):
+        """ Writes the requests on one connection, without waiting for
+            their acknowledgements, and returns the acknowledgements. """
+
+        client = AckClient(len(requests))
+        yield protocol.ClientCreator(reactor, lambda: client).connectTCP(
+            "127.0.0.1", self.port.getHost().port)
+        for request in requests:
+            client.sendLine(json.dumps(request))
+
+        acks = yield client.finished
+        defer.returnValue(acks)
+
+    @defer.inlineCallbacks
+    def test_apns_requests_with_unicode_payloads(self):
+        token = "AQEB" * 10 + "AQE="
+        payloads = [u'{"aps":{"alert":"Caf\xe9"}}', u'{"aps":{"alert":"☕"}}',
+                    u'{"aps":{"badge":1}}']
+
+        acks = yield self.send_requests([{"id" : index, "provider" : "apns",
+                                          "tokens" : [token],
+                                          "message" : {"payload" : payload}}
+                                         for index, payload
+                                         in enumerate(payloads)])
+
+        self.assertEqual(acks, [{"id" : index, "status" : "ok", "result" : 1}
+                                for index in range(len(payloads))])
+        self.assertEqual([sent[1] for sent in self.provider.sent],
+                         [payload.encode("utf-8") for payload in payloads])
+
+    @defer.inlineCallbacks
+    def test_invalid_request_is_acknowledged(self):
+        acks = yield self.send_requests([{"id" : 1, "provider" : "apns"}])
+
+        self.assertEqual(acks[0]["status"], "error")
@@ -0,0 +1,101 @@
+""" Tests for the per message logging layer. """
+
+from twisted.internet import task
+from twisted.trial import unittest
+from pushpy import logger
+
+class RecordingLog(object):
+    """ Stands in for twisted's log, recording the messages written. """
+
+    def __init__(self):
+        self.messages = []
+        self.errors = []
+
+    def msg(self, message):
+        self.messages.append(message)
+
+    def err(self, message):
+        self.errors.append(message)
+
+class ClockTask(object):
+    """ Stands in for twisted.internet.task, running looping calls on a
+        Clock. """
+
+    def __init__(self, clock):
+        self.clock = clock
+
+    def LoopingCall(self, function):
+        loop = task.LoopingCall(function)
+        loop.clock = self.clock
+        return loop
+
+class PushLoggerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.log = RecordingLog()
+        self.clock = task.Clock()
+        self.patch(logger, "log", self.log)
+        self.patch(logger, "task", ClockTask(self.clock))
+        self.logger = logger.PushLogger(summary_interval=10)
+        self.addCleanup(self.logger.stop_summaries)
+
+    def test_levels(self):
+        self.logger.debug("hidden {0}", 1)
+        self.logger.info("shown {0}", 2)
+        self.logger.error("failed {0}", 3)
+
+        self.assertEqual(self.log.messages, ["shown 2"])
+        self.assertEqual(self.log.errors, ["failed 3"])
+        self.assertFalse(self.logger.is_enabled(logger.DEBUG))
+
+        self.logger.set_level(logger.DEBUG)
+        self.logger.debug("hidden {0}", 1)
+        self.assertEqual(self.log.messages[-1], "hidden 1")
+
+    def test_disabled_messages_are_not_formatted(self):
+        # Formatting this message would raise an IndexError
+        self.logger.debug("{0} {1}", 1)
+
+        self.assertEqual(self.log.messages, [])
+
+    def test_sampled(self):
+        for index in range(7):
+            self.logger.sampled("event", 3, logger.WARNING, "event {0}",
+                                index)
+
+        self.assertEqual(self.log.messages,
+                         ["event 2 (1 of 3 occurrences)",
+                          "event 5 (1 of 3 occurrences)"])
+
+    def test_sampled_below_level_is_not_counted(self):
+        for _ in range(3):
+            self.logger.sampled("event", 3, logger.DEBUG, "event")
+
+        self.assertEqual(self.log.messages, [])
+        self.assertEqual(self.logger.sample_counts, {})
+
+    def test_summaries(self):
+        self.logger.count("sent", 1000)
+        self.logger.count("sent")
+        self.logger.count("dropped", 2)
+        self.assertEqual(self.log.messages, [])
+
+        self.clock.advance(10)
+
+        self.assertEqual(self.log.messages,
+                         ["dropped: 2 in the last 10s",
+                          "sent: 1,001 in the last 10s"])
+
+        # Nothing is logged for events which did not occur again
+        del self.log.messages[:]
+        self.logger.count("sent")
+        self.clock.advance(10)
+        self.assertEqual(self.log.messages, ["sent: 1 in the last 10s"])
+
+    def test_stop_logs_final_summary(self):
+        self.logger.count("sent")
+        self.logger.stop_summaries()
+
+        self.assertEqual(self.log.messages, ["sent: 1 in the last 10s"])
+        self.assertEqual(self.logger.summary_loop, None)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
@@ -0,0 +1,69 @@
+""" Tests for the metrics registry. """
+
+from twisted.trial import unittest
+from pushpy import metrics
+
+class Owner(object):
+    pass
+
+class MetricsRegistryTests(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1000.0
+        self.patch(metrics.time, "time", lambda: self.now)
+        self.registry = metrics.MetricsRegistry()
+
+    def test_snapshot_has_no_side_effects(self):
+        self.registry.increment("sent", 10)
+        self.now += 1
+        first = self.registry.snapshot()
+        second = self.registry.snapshot()
+
+        self.assertEqual(first["counters"], second["counters"])
+        self.assertNotIn("rates", first)
+
+    def test_rate_trackers_are_independent(self):
+        endpoint = metrics.RateTracker(self.registry.created)
+        reporter = metrics.RateTracker(self.registry.created)
+
+        self.registry.increment("sent", 10)
+        self.now += 1
+        self.assertEqual(endpoint.rates(self.registry.snapshot()),
+                         {"sent" : 10.0})
+
+        self.registry.increment("sent", 10)
+        self.now += 1
+        self.assertEqual(reporter.rates(self.registry.snapshot()),
+                         {"sent" : 10.0})
+        self.assertEqual(endpoint.rates(self.registry.snapshot()),
+                         {"sent" : 10.0})
+
+    def test_gauges_with_the_same_name_are_summed(self):
+        self.registry.register_gauge("depth", lambda: 2)
+        self.registry.register_gauge("depth", lambda: 3)
+
+        self.assertEqual(self.registry.snapshot()["gauges"], {"depth" : 5})
+
+    def test_unregister_owner(self):
+        old = Owner()
+        new = Owner()
+        self.registry.register_gauge("depth", lambda: 2, owner=old)
+        self.registry.register_source(lambda: {"gauges" : {"workers" : 1}},
+                                      owner=old)
+        self.registry.register_gauge("depth", lambda: 3, owner=new)
+
+        self.registry.unregister(old)
+
+        self.assertEqual(self.registry.snapshot()["gauges"], {"depth" : 3})
+        self.registry.unregister(new)
+        self.assertEqual(self.registry.snapshot()["gauges"], {})
+
+    def test_render_text_includes_rates(self):
+        self.registry.increment("sent", 4)
+        self.now += 2
+        snapshot = self.registry.snapshot()
+        snapshot["rates"] = metrics.RateTracker(
+            self.registry.created).rates(snapshot)
+
+        self.assertEqual(self.registry.render_text(snapshot),
+                         "sent 4\nsent.per_second 2.00\n")
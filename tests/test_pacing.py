@@ -0,0 +1,62 @@
+""" Tests for the token buckets used to pace writes. """
+
+from twisted.trial import unittest
+from pushpy import pacing
+
+class TokenBucketTests(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1000.0
+        self.patch(pacing.time, "time", lambda: self.now)
+
+    def test_unlimited(self):
+        bucket = pacing.TokenBucket()
+        bucket.take(1000000)
+
+        self.assertEqual(bucket.available(), float("inf"))
+        self.assertEqual(bucket.delay(), 0.0)
+
+    def test_starts_full_and_refills_at_rate(self):
+        bucket = pacing.TokenBucket(10, 5)
+        self.assertEqual(bucket.available(), 5)
+
+        bucket.take(5)
+        self.assertFalse(bucket.ready())
+        self.assertAlmostEqual(bucket.delay(), 0.1)
+
+        self.now += 0.25
+        self.assertEqual(bucket.available(), 2)
+
+        self.now += 10
+        self.assertEqual(bucket.available(), 5)
+
+    def test_parent_limits_child(self):
+        parent = pacing.TokenBucket(10, 2)
+        child = pacing.TokenBucket(100, 50, parent)
+
+        self.assertEqual(child.available(), 2)
+        child.take(2)
+        self.assertEqual(parent.available(), 0)
+        self.assertAlmostEqual(child.delay(), 0.1)
+
+    def test_rate_change_does_not_refill(self):
+        bucket = pacing.TokenBucket(10, 10)
+        bucket.take(10)
+
+        bucket.set_rate(20, 20)
+        self.assertEqual(bucket.available(), 0)
+
+        bucket.set_rate(20, 4)
+        self.now += 10
+        self.assertEqual(bucket.available(), 4)
+
+    def test_limiting_an_unlimited_bucket_starts_full(self):
+        bucket = pacing.TokenBucket()
+        bucket.set_rate(10, 3)
+
+        self.assertEqual(bucket.available(), 3)
+
+    def test_invalid_limits(self):
+        self.assertRaises(ValueError, pacing.TokenBucket, 0)
+        self.assertRaises(ValueError, pacing.TokenBucket, 10, 0.5)
+        self.assertRaises(ValueError, pacing.TokenBucket(10).set_rate, 10, 0)
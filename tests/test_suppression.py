@@ -0,0 +1,132 @@
+""" Tests for the index of suppressed device tokens. """
+
+import os
+from twisted.internet import task
+from twisted.trial import unittest
+from pushpy import suppression
+
+TOKENS = ["token {0}".format(index) for index in range(10)]
+
+class FakeReactor(task.Clock):
+    """ A Clock which runs callWhenRunning calls straight away and records
+        the shutdown triggers added. """
+
+    def __init__(self):
+        task.Clock.__init__(self)
+        self.shutdown_triggers = []
+
+    def callWhenRunning(self, function, *args, **kwargs):
+        function(*args, **kwargs)
+
+    def addSystemEventTrigger(self, phase, event, function, *args):
+        self.shutdown_triggers.append(function)
+
+class ClockTask(object):
+    """ Stands in for twisted.internet.task, running looping calls on a
+        Clock. """
+
+    def __init__(self, clock):
+        self.clock = clock
+
+    def LoopingCall(self, function):
+        loop = task.LoopingCall(function)
+        loop.clock = self.clock
+        return loop
+
+class SuppressionIndexTests(unittest.TestCase):
+
+    def setUp(self):
+        self.reactor = FakeReactor()
+        self.patch(suppression, "reactor", self.reactor)
+        self.patch(suppression, "task", ClockTask(self.reactor))
+        self.path = self.mktemp()
+
+    def test_add_and_contains(self):
+        index = suppression.SuppressionIndex()
+
+        self.assertTrue(index.add(TOKENS[0]))
+        self.assertFalse(index.add(TOKENS[0]))
+        self.assertTrue(index.add(u"t\xe9"))
+
+        self.assertIn(TOKENS[0], index)
+        self.assertIn(u"t\xe9", index)
+        self.assertNotIn(TOKENS[1], index)
+        self.assertEqual(len(index), 2)
+        self.assertEqual(list(index.unsuppressed(TOKENS[:3])), TOKENS[1:3])
+
+    def test_merge(self):
+        index = suppression.SuppressionIndex(merge_threshold=3)
+        for token in TOKENS[:5]:
+            index.add(token)
+
+        self.assertEqual(len(index.hashes), 3)
+        self.assertEqual(len(index.recent), 2)
+        self.assertEqual(list(index.hashes), sorted(index.hashes))
+        self.assertTrue(all(token in index for token in TOKENS[:5]))
+        self.assertFalse(index.add(TOKENS[0]))
+
+        index._merge()
+        self.assertEqual(len(index.hashes), 5)
+        self.assertEqual(list(index.hashes), sorted(index.hashes))
+
+    def test_discard(self):
+        index = suppression.SuppressionIndex(merge_threshold=2)
+        for token in TOKENS[:3]:
+            index.add(token)
+
+        # The first two have been merged, the third is recent
+        index.discard(TOKENS[0])
+        index.discard(TOKENS[2])
+        index.discard(TOKENS[5])
+
+        self.assertEqual([token in index for token in TOKENS[:3]],
+                         [False, True, False])
+        self.assertEqual(len(index), 1)
+
+    def test_save_and_load(self):
+        index = suppression.SuppressionIndex(merge_threshold=4)
+        for token in TOKENS[:6]:
+            index.add(token)
+        index.save(self.path)
+
+        loaded = suppression.SuppressionIndex()
+        loaded.add(TOKENS[0])
+        loaded.add(TOKENS[9])
+        loaded.load(self.path)
+
+        # Loading merges the snapshot into the tokens already held
+        self.assertEqual(len(loaded), 7)
+        self.assertTrue(all(token in loaded for token in TOKENS[:6]))
+        self.assertIn(TOKENS[9], loaded)
+
+    def test_load_ignores_other_formats(self):
+        with open(self.path, "wb") as snapshot:
+            snapshot.write("XXXX\x08" + "\x00" * 16)
+
+        index = suppression.SuppressionIndex()
+        index.load(self.path)
+        index.load(self.path + ".missing")
+
+        self.assertEqual(len(index), 0)
+
+    def test_snapshot_file(self):
+        index = suppression.SuppressionIndex(self.path, snapshot_interval=60)
+        self.addCleanup(index.snapshot_loop.stop)
+        self.assertEqual(self.reactor.shutdown_triggers, [index.save])
+
+        # Nothing is saved until the index has changed
+        self.reactor.advance(60)
+        self.assertFalse(os.path.exists(self.path))
+
+        index.add(TOKENS[0])
+        self.reactor.advance(60)
+        self.assertFalse(index.changed)
+
+        index.add(TOKENS[1])
+        self.reactor.shutdown_triggers[0]()
+
+        reloaded = suppression.SuppressionIndex(self.path,
+                                                snapshot_interval=0)
+        self.assertIn(TOKENS[0], reloaded)
+        self.assertIn(TOKENS[1], reloaded)
+        self.assertEqual(reloaded.snapshot_loop, None)